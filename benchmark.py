@@ -0,0 +1,333 @@
+# Офлайн-бенчмарк bot.py.
+# Поднимает локальные заглушки Binance Futures REST и Telegram API с настраиваемой задержкой,
+# запускает Flask-приложение бота на локальном порту и подаёт на /webhook поток сигналов
+# (N символов, M сигналов/сек, с разворотами и дубликатами). Вместо веб-сокета User Data Stream
+# заглушка биржи сама доставляет события ORDER_TRADE_UPDATE / ACCOUNT_UPDATE в bot.handle_user_data
+# с задержкой --ws-latency, а марк-цены (как !markPrice@arr@1s) – в bot.handle_market_data.
+#
+# Пример: python benchmark.py --symbols 20 --rate 50 --duration 10 --binance-latency 0.02
+import argparse
+import collections
+import itertools
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))] if samples else 0.0
+
+
+# --------------------------
+# Заглушка Binance Futures REST
+class FakeBinance:
+    def __init__(self, symbols, latency, ws_latency):
+        self.latency = latency
+        self.ws_latency = ws_latency
+        self.symbols = symbols
+        self.prices = {s: 100.0 + i for i, s in enumerate(symbols)}
+        self.positions = {s: {"amt": 0.0, "entry": 0.0} for s in symbols}
+        self.trades = collections.defaultdict(list)
+        self.order_ids = itertools.count(1)
+        self.trade_ids = itertools.count(1)
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        self.event_handler = None  # bot.handle_user_data
+
+    def exchange_info(self):
+        return {"symbols": [{
+            "symbol": s,
+            "quantityPrecision": 3,
+            "pricePrecision": 2,
+            "filters": [
+                {"filterType": "LOT_SIZE", "stepSize": "0.001", "minQty": "0.001"},
+                {"filterType": "PRICE_FILTER", "tickSize": "0.01"},
+                {"filterType": "MIN_NOTIONAL", "notional": "5"},
+            ],
+        } for s in self.symbols]}
+
+    def position_risk(self, symbol=None):
+        with self.lock:
+            return [{
+                "symbol": s,
+                "positionAmt": str(p["amt"]),
+                "entryPrice": str(p["entry"]),
+                "breakEvenPrice": str(p["entry"]),
+                "initialMargin": str(abs(p["amt"]) * p["entry"] / 20),
+                "liquidationPrice": str(p["entry"] * 0.9),
+            # Как Position Information V3: только символы с позицией (открытые ордера заглушка не хранит)
+            } for s, p in self.positions.items() if symbol in (None, s) and p["amt"]]
+
+    def fill_market_order(self, params):
+        symbol = params["symbol"]
+        qty = float(params["quantity"])
+        signed_qty = qty if params["side"] == "BUY" else -qty
+        with self.lock:
+            price = self.prices[symbol] = self.prices[symbol] * (1 + random.uniform(-0.001, 0.001))
+            pos = self.positions[symbol]
+            realized = 0.0
+            if pos["amt"] and (pos["amt"] > 0) != (signed_qty > 0):
+                closed = min(abs(pos["amt"]), qty)
+                realized = closed * (price - pos["entry"]) * (1 if pos["amt"] > 0 else -1)
+            new_amt = round(pos["amt"] + signed_qty, 6)
+            if params.get("reduceOnly") in (True, "true", "True") and abs(new_amt) > abs(pos["amt"]):
+                new_amt = 0.0
+            pos["entry"] = price if new_amt and (not pos["amt"] or (pos["amt"] > 0) != (new_amt > 0)) else pos["entry"]
+            pos["amt"] = new_amt
+            order_id = next(self.order_ids)
+            trade = {
+                "id": next(self.trade_ids), "orderId": order_id, "symbol": symbol, "qty": str(qty),
+                "price": str(price), "commission": str(qty * price * 0.0004), "realizedPnl": str(realized),
+            }
+            self.trades[symbol].append(trade)
+            position_event = {"s": symbol, "pa": str(pos["amt"]), "ep": str(pos["entry"]), "bep": str(pos["entry"]),
+                              "up": "0", "mt": "cross", "iw": "0", "ps": "BOTH"}
+        threading.Timer(self.ws_latency, self.push_events, args=(params, order_id, trade, position_event)).start()
+        return {"orderId": order_id, "symbol": symbol, "status": "NEW", "type": "MARKET", "side": params["side"]}
+
+    def mark_price_feed(self, handler, interval=1.0):
+        while True:
+            with self.lock:
+                update = [{"e": "markPriceUpdate", "s": s, "p": str(p)} for s, p in self.prices.items()]
+            handler(update)
+            time.sleep(interval)
+
+    def push_events(self, params, order_id, trade, position_event):
+        if self.event_handler is None:
+            return
+        now = int(time.time() * 1000)
+        self.event_handler({"e": "ACCOUNT_UPDATE", "E": now, "a": {"B": [{"a": "USDT", "wb": "10000", "cw": "10000"}], "P": [position_event]}})
+        self.event_handler({"e": "ORDER_TRADE_UPDATE", "E": now, "o": {
+            "s": trade["symbol"], "i": order_id, "c": "", "S": params["side"], "o": "MARKET", "ot": "MARKET",
+            "x": "TRADE", "X": "FILLED", "t": trade["id"], "l": trade["qty"], "z": trade["qty"], "q": trade["qty"],
+            "L": trade["price"], "ap": trade["price"], "n": trade["commission"], "rp": trade["realizedPnl"], "ps": "BOTH",
+        }})
+
+    def handle(self, method, path, params):
+        self.calls[f"{method} {path}"] += 1
+        time.sleep(self.latency)
+        endpoint = path.split("/fapi/", 1)[-1].split("/", 1)[-1]
+        if endpoint in ("ping", "positionMargin", "leverage", "algoOrder") or (endpoint == "listenKey" and method == "PUT"):
+            return {"listenKey": "bench"} if endpoint == "listenKey" else {"algoId": next(self.order_ids)}
+        if endpoint == "listenKey":
+            return {"listenKey": "bench"}
+        if endpoint == "time":
+            return {"serverTime": int(time.time() * 1000)}
+        if endpoint == "exchangeInfo":
+            return self.exchange_info()
+        if endpoint == "positionRisk":
+            return self.position_risk(params.get("symbol"))
+        if endpoint == "balance":
+            return [{"asset": "USDT", "balance": "10000", "crossWalletBalance": "10000"}]
+        if endpoint in ("openOrders", "openAlgoOrders"):
+            return []
+        if endpoint in ("allOpenOrders", "algoOpenOrders"):
+            return {"code": 200, "msg": "ok"}
+        if endpoint == "ticker/price":
+            return {"symbol": params["symbol"], "price": str(self.prices[params["symbol"]])}
+        if endpoint == "premiumIndex":
+            return {"symbol": params["symbol"], "markPrice": str(self.prices[params["symbol"]])}
+        if endpoint == "order" and method == "POST":
+            return self.fill_market_order(params)
+        if endpoint == "order":
+            return {"orderId": int(params["orderId"]), "status": "FILLED", "avgPrice": "0", "executedQty": "0"}
+        if endpoint == "batchOrders":
+            return [self.fill_market_order(o) for o in json.loads(params["batchOrders"])]
+        if endpoint == "userTrades":
+            trades = self.trades[params["symbol"]]
+            if "orderId" in params:
+                return [t for t in trades if t["orderId"] == int(params["orderId"])]
+            if "fromId" in params:
+                return [t for t in trades if t["id"] >= int(params["fromId"])]
+            return trades[-500:]
+        return {"code": -1000, "msg": f"unknown endpoint {path}"}
+
+
+# --------------------------
+# Заглушка Telegram Bot API
+class FakeTelegram:
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = collections.Counter()
+
+    def handle(self, method, path, params):
+        api_method = path.rsplit("/", 1)[-1]
+        self.calls[api_method] += 1
+        time.sleep(self.latency)
+        if api_method == "getUpdates":
+            time.sleep(min(float(params.get("timeout", 0)), 1.0))
+            return {"ok": True, "result": []}
+        return {"ok": True, "result": {"message_id": self.calls[api_method]}}
+
+
+def serve(backend):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True  # заголовки и тело пишутся отдельно, без этого +40 мс на delayed ACK
+
+        def _dispatch(self):
+            url = urllib.parse.urlparse(self.path)
+            params = dict(urllib.parse.parse_qsl(url.query))
+            length = int(self.headers.get("Content-Length", 0))
+            if length:
+                params.update(urllib.parse.parse_qsl(self.rfile.read(length).decode()))
+            body = json.dumps(backend.handle(self.command, url.path, params)).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# --------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк bot.py на локальных заглушках Binance и Telegram")
+    parser.add_argument("--symbols", type=int, default=10, help="число символов")
+    parser.add_argument("--rate", type=float, default=20, help="сигналов в секунду (суммарно)")
+    parser.add_argument("--duration", type=float, default=10, help="длительность подачи сигналов, сек")
+    parser.add_argument("--flip-prob", type=float, default=0.5, help="вероятность разворота позиции")
+    parser.add_argument("--dup-prob", type=float, default=0.1, help="вероятность повторной отправки того же сигнала")
+    parser.add_argument("--binance-latency", type=float, default=0.02, help="задержка ответа Binance REST, сек")
+    parser.add_argument("--ws-latency", type=float, default=0.01, help="задержка событий User Data Stream, сек")
+    parser.add_argument("--telegram-latency", type=float, default=0.05, help="задержка ответа Telegram, сек")
+    parser.add_argument("--drain-timeout", type=float, default=30, help="сколько ждать обработки очереди, сек")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    symbols = [f"BENCH{i}USDT" for i in range(args.symbols)]
+    fake_binance = FakeBinance(symbols, args.binance_latency, args.ws_latency)
+    fake_telegram = FakeTelegram(args.telegram_latency)
+    state_dir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.environ.update({
+        "TELEGRAM_TOKEN": "bench",
+        "TELEGRAM_CHAT_ID": "1",
+        "BINANCE_API_KEY": "bench",
+        "BINANCE_API_SECRET": "bench",
+        "BINANCE_FUTURES_URL": serve(fake_binance),
+        "TELEGRAM_API_BASE": serve(fake_telegram),
+        "STATE_DB_PATH": os.path.join(state_dir, "state.db"),
+        "JOURNAL_PATH": os.path.join(state_dir, "journal.bin"),
+    })
+    os.environ.setdefault("TELEGRAM_MIN_INTERVAL", "0")
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    # Время от отправки сигнала до первого рыночного ордера по нему (в потоке воркера)
+    current = threading.local()
+    order_latencies = []
+    processed = []
+    process_signal = bot.process_signal
+    create_order = bot.accounts[0].client.futures_create_order
+
+    def timed_process_signal(data):
+        current.sent_at = data.get("bench_sent_at")
+        try:
+            return process_signal(data)
+        finally:
+            processed.append(time.time())
+            current.sent_at = None
+
+    def timed_create_order(**params):
+        sent_at = getattr(current, "sent_at", None)
+        if sent_at and params.get("type") == "MARKET":
+            order_latencies.append(time.time() - sent_at)
+            current.sent_at = None
+        return create_order(**params)
+
+    bot.process_signal = timed_process_signal
+    bot.accounts[0].client.futures_create_order = timed_create_order
+    fake_binance.event_handler = bot.handle_user_data
+    threading.Thread(target=fake_binance.mark_price_feed, args=(bot.handle_market_data,), daemon=True).start()
+
+    # Фоновые сервисы, как в bot.__main__, кроме веб-сокета (его заменяет заглушка)
+    bot.load_state()
+    threading.Thread(target=bot.state_writer_worker, daemon=True).start()
+    bot.prewarm_connections()
+    bot.refresh_symbol_filters()
+    bot.start_signal_workers()
+    threading.Thread(target=bot.telegram_sender_worker, daemon=True).start()
+    bot.reconcile_account_state()
+    bot.trading_enabled = True
+
+    from werkzeug.serving import make_server
+    http_server = make_server("127.0.0.1", 0, bot.app, threaded=True)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    webhook_url = f"http://127.0.0.1:{http_server.server_port}/webhook"
+
+    tracemalloc.start()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    direction = {s: "long" for s in symbols}
+    session = requests.Session()
+    statuses = collections.Counter()
+    http_latencies = []
+    sent = 0
+    last_payload = None
+    started = time.time()
+    while time.time() - started < args.duration:
+        if last_payload is not None and random.random() < args.dup_prob:
+            payload = last_payload
+        else:
+            symbol = random.choice(symbols)
+            if random.random() < args.flip_prob:
+                direction[symbol] = "short" if direction[symbol] == "long" else "long"
+            payload = {"signal": direction[symbol], "symbol": f"{symbol}.P", "quantity": 0.1, "leverage": 20,
+                       "tp_perc": 1, "sl_perc": 1, "time": sent, "bench_sent_at": time.time()}
+        t0 = time.time()
+        response = session.post(webhook_url, json=payload)
+        http_latencies.append(time.time() - t0)
+        statuses[response.json().get("status")] += 1
+        last_payload = payload
+        sent += 1
+        time.sleep(max(0.0, started + sent / args.rate - time.time()))
+    send_finished = time.time()
+
+    deadline = time.time() + args.drain_timeout
+    while time.time() < deadline and (statuses["queued"] > len(processed) or any(q.unfinished_tasks for q in bot.signal_queues)):
+        time.sleep(0.05)
+    elapsed = (processed[-1] if processed else send_finished) - started
+    current_mem, peak_mem = tracemalloc.get_traced_memory()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    binance_calls = sum(fake_binance.calls.values())
+    print(f"Сигналов отправлено: {sent} за {send_finished - started:.1f} сек; ответы: {dict(statuses)}")
+    print(f"Обработано сигналов: {len(processed)}; пропускная способность: {len(processed) / elapsed:.1f} сигн./сек")
+    print("Ответ /webhook, мс: p50 {:.2f} / p95 {:.2f} / p99 {:.2f}".format(
+        *(percentile(http_latencies, q) * 1000 for q in (0.5, 0.95, 0.99))))
+    print("Сигнал -> ордер, мс: p50 {:.1f} / p95 {:.1f} / p99 {:.1f} (n={})".format(
+        *(percentile(order_latencies, q) * 1000 for q in (0.5, 0.95, 0.99)), len(order_latencies)))
+    print(f"Вызовов Binance: {binance_calls} ({binance_calls / max(len(processed), 1):.1f} на сигнал)")
+    for call, count in fake_binance.calls.most_common():
+        print(f"  {call}: {count}")
+    print(f"Вызовов Telegram: {dict(fake_telegram.calls)}")
+    print(f"Память (tracemalloc): текущая {current_mem / 1e6:.1f} МБ, пик {peak_mem / 1e6:.1f} МБ; "
+          f"прирост max RSS: {(rss_after - rss_before) / 1024:.1f} МБ")
+
+
+if __name__ == "__main__":
+    main()
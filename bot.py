@@ -3,14 +3,88 @@ import os
 import requests
 import time
 import threading
+import math
+import hashlib
+import hmac
+import bisect
+import contextlib
+import urllib.parse
+import collections
+import queue
+import zlib
+import array
+import json
+import sqlite3
+import struct
+import mmap
+from concurrent.futures import ThreadPoolExecutor
 from binance.client import Client as BinanceClient
+from binance.exceptions import BinanceAPIException
 from binance import ThreadedWebsocketManager
 import logging
+import logging.handlers
+import atexit
 
 app = Flask(__name__)
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Настройка логирования.
+# Записи кладутся в очередь, а форматирование и запись в stderr выполняет фоновый QueueListener:
+# вебхук и колбэки стримов тратят на лог только постановку в очередь. Поэтому аргументы записи
+# не должны меняться после вызова (ответы биржи и сообщения не меняются).
+# Поля log_event (symbol, order_id, payload ...) сериализуются тоже в потоке записи;
+# LOG_FORMAT=json – одна JSON-строка на запись вместо текстового формата.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE_INTERVAL = float(os.getenv("LOG_SAMPLE_INTERVAL", 300))
+
+class StructuredLogFormatter(logging.Formatter):
+    def __init__(self, as_json=False):
+        super().__init__('%(asctime)s - %(levelname)s - %(message)s')
+        self.as_json = as_json
+
+    def format(self, record):
+        fields = getattr(record, "fields", None)
+        if not self.as_json:
+            text = super().format(record)
+            return f"{text} {json.dumps(fields, ensure_ascii=False, default=str)}" if fields else text
+        entry = {"ts": record.created, "level": record.levelname, "thread": record.threadName, "msg": record.getMessage()}
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # Стандартный QueueHandler форматирует запись ещё в вызывающем потоке
+    def prepare(self, record):
+        return record
+
+log_queue = queue.SimpleQueue()
+log_output = logging.StreamHandler()
+log_output.setFormatter(StructuredLogFormatter(as_json=LOG_FORMAT == "json"))
+log_listener = logging.handlers.QueueListener(log_queue, log_output)
+logging.basicConfig(level=LOG_LEVEL, handlers=[DeferredQueueHandler(log_queue)])
+log_listener.start()
+atexit.register(log_listener.stop)
+
+def log_event(level, message, **fields):
+    # Структурированная запись: поля попадают в лог как есть и сериализуются в потоке записи
+    if logging.getLogger().isEnabledFor(level):
+        logging.log(level, message, extra={"fields": fields})
+
+log_samples = {}  # ключ -> [monotonic-время последней записи, подавлено с тех пор]
+
+def log_sampled(key, level, message, **fields):
+    # Частые однотипные события (автоочистка, keepalive) – не чаще раза в LOG_SAMPLE_INTERVAL сек на ключ
+    now = time.monotonic()
+    sample = log_samples.setdefault(key, [-LOG_SAMPLE_INTERVAL, 0])
+    if now - sample[0] < LOG_SAMPLE_INTERVAL:
+        sample[1] += 1
+        return
+    if sample[1]:
+        fields["suppressed"] = sample[1]
+    sample[0], sample[1] = now, 0
+    log_event(level, message, **fields)
 
 # Глобальная переменная для управления торговлей (если False – сигналы игнорируются)
 trading_enabled = False
@@ -24,46 +98,1175 @@ if not TELEGRAM_TOKEN or not TELEGRAM_CHAT_ID:
 # Получаем ключи для Binance из переменных окружения
 BINANCE_API_KEY = os.getenv("BINANCE_API_KEY")
 BINANCE_API_SECRET = os.getenv("BINANCE_API_SECRET")
-if not BINANCE_API_KEY or not BINANCE_API_SECRET:
-    raise Exception("❌ BINANCE_API_KEY и BINANCE_API_SECRET должны быть заданы в переменных окружения")
 
-# Инициализируем Binance API-клиента
-binance_client = BinanceClient(BINANCE_API_KEY, BINANCE_API_SECRET)
+# Базовые URL API (переопределяются для тестовых стендов и benchmark.py)
+BINANCE_FUTURES_URL = os.getenv("BINANCE_FUTURES_URL", "https://fapi.binance.com")
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org")
+
+# --------------------------
+# Планировщик бюджета API Binance.
+# Все REST-запросы проходят через токен-бакеты веса (REQUEST_WEIGHT) и числа ордеров (ORDERS),
+# которые синхронизируются по заголовкам X-MBX-USED-WEIGHT-1M / X-MBX-ORDER-COUNT-1M.
+# Ордера и отмены имеют высший приоритет; служебные и отчётные запросы (PRIORITY_LOW) ждут,
+# пока в бюджете есть запас, а при его нехватке отбрасываются. 429/418 блокируют все запросы на Retry-After.
+API_WEIGHT_LIMIT = int(os.getenv("API_WEIGHT_LIMIT", 2400))   # вес в минуту
+API_ORDER_LIMIT = int(os.getenv("API_ORDER_LIMIT", 1200))     # ордеров в минуту
+API_LOW_PRIORITY_WAIT = float(os.getenv("API_LOW_PRIORITY_WAIT", 5))
+API_MAX_WAIT = 60
+PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW = 0, 1, 2
+# Доля бюджета, которая должна оставаться свободной, чтобы запрос с данным приоритетом прошёл
+API_PRIORITY_RESERVE = {PRIORITY_HIGH: 0.0, PRIORITY_NORMAL: 0.1, PRIORITY_LOW: 0.5}
+# Вес эндпоинтов (по документации Binance Futures); неизвестные считаются весом 1
+API_ENDPOINT_WEIGHTS = {
+    "exchangeInfo": 1, "positionRisk": 5, "balance": 5, "userTrades": 5, "openOrders": 40,
+    "openAlgoOrders": 40, "batchOrders": 5, "ticker/price": 2, "time": 1, "ping": 1,
+}
+API_ORDER_ENDPOINTS = ("order", "batchOrders", "algoOrder")
+API_HIGH_PRIORITY_ENDPOINTS = ("order", "batchOrders", "algoOrder", "allOpenOrders", "algoOpenOrders", "leverage", "positionMargin")
+
+api_budget = {
+    "weight": float(API_WEIGHT_LIMIT),
+    "orders": float(API_ORDER_LIMIT),
+    "refilled_at": time.monotonic(),
+    "blocked_until": 0.0,
+}
+api_budget_cond = threading.Condition()
+_api_priority = threading.local()
+
+class ApiBudgetError(Exception):
+    pass
+
+@contextlib.contextmanager
+def api_priority(priority):
+    previous = getattr(_api_priority, "value", None)
+    _api_priority.value = priority
+    try:
+        yield
+    finally:
+        _api_priority.value = previous
+
+def _api_endpoint(uri):
+    return urllib.parse.urlparse(uri).path.split("/fapi/", 1)[-1].split("/", 1)[-1]
+
+def _refill_api_budget():
+    now = time.monotonic()
+    elapsed = now - api_budget["refilled_at"]
+    api_budget["refilled_at"] = now
+    api_budget["weight"] = min(API_WEIGHT_LIMIT, api_budget["weight"] + elapsed * API_WEIGHT_LIMIT / 60)
+    api_budget["orders"] = min(API_ORDER_LIMIT, api_budget["orders"] + elapsed * API_ORDER_LIMIT / 60)
+
+def acquire_api_budget(method, uri):
+    endpoint = _api_endpoint(uri)
+    priority = getattr(_api_priority, "value", None)
+    if priority is None:
+        priority = PRIORITY_HIGH if endpoint in API_HIGH_PRIORITY_ENDPOINTS else PRIORITY_NORMAL
+    weight = API_ENDPOINT_WEIGHTS.get(endpoint, 1)
+    orders = 1 if method.upper() == "POST" and endpoint in API_ORDER_ENDPOINTS else 0
+    reserve = API_PRIORITY_RESERVE[priority]
+    deadline = time.monotonic() + (API_LOW_PRIORITY_WAIT if priority == PRIORITY_LOW else API_MAX_WAIT)
+    with api_budget_cond:
+        while True:
+            _refill_api_budget()
+            now = time.monotonic()
+            if now >= api_budget["blocked_until"] \
+                    and api_budget["weight"] - weight >= API_WEIGHT_LIMIT * reserve \
+                    and api_budget["orders"] - orders >= API_ORDER_LIMIT * reserve:
+                api_budget["weight"] -= weight
+                api_budget["orders"] -= orders
+                return
+            if now >= deadline:
+                inc_counter("bot_binance_requests_shed_total", endpoint=endpoint, priority=priority)
+                raise ApiBudgetError(f"Бюджет API исчерпан, запрос {method.upper()} {endpoint} (приоритет {priority}) отброшен")
+            wait_until = max(api_budget["blocked_until"], now + 0.05)
+            api_budget_cond.wait(min(wait_until, deadline) - now)
+
+def update_api_budget(response):
+    headers = {k.lower(): v for k, v in response.headers.items()}
+    with api_budget_cond:
+        _refill_api_budget()
+        if "x-mbx-used-weight-1m" in headers:
+            api_budget["weight"] = min(api_budget["weight"], API_WEIGHT_LIMIT - float(headers["x-mbx-used-weight-1m"]))
+        if "x-mbx-order-count-1m" in headers:
+            api_budget["orders"] = min(api_budget["orders"], API_ORDER_LIMIT - float(headers["x-mbx-order-count-1m"]))
+        if response.status_code in (418, 429):
+            retry_after = float(headers.get("retry-after", 60))
+            api_budget["blocked_until"] = max(api_budget["blocked_until"], time.monotonic() + retry_after)
+            logging.error(f"🛑 Binance ответил {response.status_code}, запросы приостановлены на {retry_after} сек.")
+        api_budget_cond.notify_all()
+
+def api_budget_status():
+    with api_budget_cond:
+        _refill_api_budget()
+        return {
+            "weight": round(api_budget["weight"], 1),
+            "orders": round(api_budget["orders"], 1),
+            "blocked_for": round(max(0.0, api_budget["blocked_until"] - time.monotonic()), 1),
+        }
+
+# --------------------------
+# Единый клиент REST-запросов Binance.
+# Через него идут все запросы бота, включая подписанные (positionMargin и т.д.):
+# бюджет веса, пул keep-alive соединений, HMAC-ключ, подготовленный один раз, recvWindow
+# и смещение часов относительно сервера (timestamp_offset), которое периодически калибруется.
+# При -1021 (timestamp вне recvWindow) часы пересинхронизируются и запрос повторяется один раз.
+BINANCE_RECV_WINDOW = int(os.getenv("BINANCE_RECV_WINDOW", 5000))
+BINANCE_POOL_SIZE = int(os.getenv("BINANCE_POOL_SIZE", 32))  # соединений на аккаунт; по умолчанию у requests – 10
+BINANCE_PREWARM_CONNECTIONS = int(os.getenv("BINANCE_PREWARM_CONNECTIONS", 4))
+TIME_SYNC_INTERVAL = int(os.getenv("TIME_SYNC_INTERVAL", 300))
+
+class BudgetedBinanceClient(BinanceClient):
+    REQUEST_RECVWINDOW = BINANCE_RECV_WINDOW
+
+    def __init__(self, api_key, api_secret, **kwargs):
+        super().__init__(api_key, api_secret, **kwargs)
+        # Ключ HMAC подготавливается один раз, на каждый запрос – только copy() и update()
+        self._hmac_key = hmac.new(api_secret.encode(), digestmod=hashlib.sha256)
+
+    def _init_session(self):
+        session = super()._init_session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=BINANCE_POOL_SIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def _hmac_signature(self, query_string):
+        mac = self._hmac_key.copy()
+        mac.update(query_string.encode())
+        return mac.hexdigest()
+
+    def _request(self, method, uri, signed, force_params=False, **kwargs):
+        # Библиотека дописывает timestamp, recvWindow и signature прямо в словарь data,
+        # поэтому для повтора сохраняем исходные параметры
+        data = kwargs.get("data")
+        original = dict(data) if isinstance(data, dict) else None
+        acquire_api_budget(method, uri)
+        try:
+            return super()._request(method, uri, signed, force_params, **kwargs)
+        except BinanceAPIException as e:
+            if not signed or e.code != -1021:
+                raise
+            logging.warning(f"⏱ Binance отклонил запрос по времени (-1021), синхронизируем часы: {e}")
+        self.sync_server_time()
+        if original is not None:
+            kwargs["data"] = dict(original)
+        acquire_api_budget(method, uri)
+        return super()._request(method, uri, signed, force_params, **kwargs)
+
+    def sync_server_time(self):
+        # Смещение считается относительно середины запроса, чтобы компенсировать сетевую задержку
+        started_at = time.time()
+        server_time = self.futures_time()["serverTime"]
+        finished_at = time.time()
+        self.timestamp_offset = server_time - int((started_at + finished_at) * 500)
+        set_gauge("bot_binance_time_offset_ms", self.timestamp_offset)
+        return self.timestamp_offset
+
+# --------------------------
+# Метрики: гистограммы задержек по этапам и внешним вызовам, счётчики и
+# лимиты Binance из заголовков X-MBX-USED-WEIGHT / X-MBX-ORDER-COUNT.
+# Доступны на /metrics в формате Prometheus и через команду /latency.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LATENCY_SAMPLES = 1024  # последние замеры для перцентилей
+latency_stats = {}      # span -> {"count", "sum", "buckets", "samples"}
+metric_counters = collections.Counter()  # (name, labels) -> значение
+metric_gauges = {}                       # (name, labels) -> значение
+metrics_lock = threading.Lock()
+
+def record_stage(stage, seconds):
+    with metrics_lock:
+        stats = latency_stats.get(stage)
+        if stats is None:
+            stats = latency_stats[stage] = {
+                "count": 0,
+                "sum": 0.0,
+                "buckets": [0] * len(LATENCY_BUCKETS),
+                "samples": collections.deque(maxlen=LATENCY_SAMPLES),
+            }
+        stats["count"] += 1
+        stats["sum"] += seconds
+        stats["samples"].append(seconds)
+        index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        if index < len(LATENCY_BUCKETS):
+            stats["buckets"][index] += 1
+
+@contextlib.contextmanager
+def timed(stage):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.monotonic() - started)
+
+def inc_counter(name, value=1, **labels):
+    with metrics_lock:
+        metric_counters[(name, tuple(sorted(labels.items())))] += value
+
+def set_gauge(name, value, **labels):
+    with metrics_lock:
+        metric_gauges[(name, tuple(sorted(labels.items())))] = value
+
+def _percentile(samples, q):
+    return samples[min(len(samples) - 1, int(q * len(samples)))] if samples else 0.0
+
+def latency_summary():
+    with metrics_lock:
+        snapshot = {stage: (st["count"], st["sum"], sorted(st["samples"])) for stage, st in latency_stats.items()}
+    return {
+        stage: {
+            "count": count,
+            "avg_ms": round(total / count * 1000, 2),
+            "p50_ms": round(_percentile(samples, 0.5) * 1000, 2),
+            "p95_ms": round(_percentile(samples, 0.95) * 1000, 2),
+            "p99_ms": round(_percentile(samples, 0.99) * 1000, 2),
+        }
+        for stage, (count, total, samples) in snapshot.items()
+    }
+
+def _labels(labels):
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+
+def _binance_response_hook(response, *args, **kwargs):
+    path = urllib.parse.urlparse(response.request.url).path
+    record_stage(f"binance:{response.request.method} {path}", response.elapsed.total_seconds())
+    inc_counter("bot_binance_requests_total", path=path, status=response.status_code)
+    for header, value in response.headers.items():
+        header = header.lower()
+        if header.startswith("x-mbx-used-weight") or header.startswith("x-mbx-order-count"):
+            set_gauge("bot_binance_rate_limit", float(value), header=header)
+
+def _telegram_response_hook(response, *args, **kwargs):
+    method = urllib.parse.urlparse(response.request.url).path.rsplit("/", 1)[-1]
+    record_stage(f"telegram:{method}", response.elapsed.total_seconds())
+    inc_counter("bot_telegram_requests_total", method=method, status=response.status_code)
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    lines = ["# TYPE bot_latency_seconds histogram"]
+    with metrics_lock:
+        for stage, st in latency_stats.items():
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, st["buckets"]):
+                cumulative += count
+                lines.append(f'bot_latency_seconds_bucket{{span="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'bot_latency_seconds_bucket{{span="{stage}",le="+Inf"}} {st["count"]}')
+            lines.append(f'bot_latency_seconds_sum{{span="{stage}"}} {st["sum"]}')
+            lines.append(f'bot_latency_seconds_count{{span="{stage}"}} {st["count"]}')
+        counters = list(metric_counters.items())
+        gauges = list(metric_gauges.items())
+    lines.append("# TYPE bot_latency_quantile_seconds gauge")
+    for stage, summary in latency_summary().items():
+        for q in ("p50", "p95", "p99"):
+            lines.append(f'bot_latency_quantile_seconds{{span="{stage}",quantile="{q}"}} {summary[q + "_ms"] / 1000}')
+    for (name, labels), value in counters:
+        lines.append(f"{name}{_labels(labels)} {value}")
+    for (name, labels), value in gauges:
+        lines.append(f"{name}{_labels(labels)} {value}")
+    for shard, q in enumerate(signal_queues):
+        lines.append(f'bot_signal_queue_depth{{shard="{shard}"}} {q.qsize()}')
+    lines.append(f"bot_telegram_queue_depth {telegram_queue.qsize()}")
+    for key, value in api_budget_status().items():
+        lines.append(f'bot_binance_budget{{kind="{key}"}} {value}')
+    return "\n".join(lines) + "\n", 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+def format_latency_report():
+    summary = latency_summary()
+    if not summary:
+        return "ℹ️ Замеров задержек пока нет."
+    # Имена этапов содержат "_", поэтому отчёт отправляется блоком кода, чтобы не ломать Markdown
+    lines = ["⏱ Задержки (p50 / p95 / p99, мс):", "```"]
+    for stage, st in sorted(summary.items()):
+        lines.append(f"{stage}: {st['p50_ms']} / {st['p95_ms']} / {st['p99_ms']} (n={st['count']})")
+    with metrics_lock:
+        limits = [(dict(labels)["header"], value) for (name, labels), value in metric_gauges.items() if name == "bot_binance_rate_limit"]
+    for header, value in sorted(limits):
+        lines.append(f"{header}: {int(value)}")
+    lines.append("```")
+    return "\n".join(lines)
+
+# --------------------------
+# Аккаунты Binance.
+# Основной аккаунт ("main") берётся из BINANCE_API_KEY/BINANCE_API_SECRET. Дополнительные
+# (суб)аккаунты задаются в BINANCE_ACCOUNTS – JSON-список или путь к JSON-файлу вида
+# [{"name": "sub1", "api_key": "...", "api_secret": "...", "quantity_multiplier": 0.5, "leverage": 10}],
+# где quantity – фиксированный размер позиции, quantity_multiplier – множитель к quantity из сигнала,
+# leverage – плечо аккаунта вместо плеча из сигнала.
+# У каждого аккаунта свой клиент, User Data Stream и состояние; сигнал исполняется на всех
+# аккаунтах параллельно. Функции работают с «текущим» аккаунтом потока (см. use_account).
+class Account:
+    def __init__(self, name, api_key, api_secret, quantity=None, quantity_multiplier=1.0, leverage=None):
+        self.name = name
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.quantity = float(quantity) if quantity is not None else None
+        self.quantity_multiplier = float(quantity_multiplier)
+        self.leverage = int(leverage) if leverage is not None else None
+        self.client = BudgetedBinanceClient(api_key, api_secret, ping=False)
+        self.client.FUTURES_URL = f"{BINANCE_FUTURES_URL}/fapi"
+        self.client.session.hooks["response"].append(_on_binance_response)
+        # Данные открытых позиций по символам: signal, entry_price, quantity, leverage, used_margin,
+        # commission_entry, break_even_price, liq_price, tp_perc, sl_perc
+        self.positions_entry_data = {}
+        # Локальное зеркало аккаунта (см. update_account_state)
+        self.positions = {}      # symbol -> позиция в формате futures_position_information
+        self.balances = {}       # asset -> баланс в формате futures_account_balance
+        self.open_orders = {}    # orderId -> {"symbol", "side", "type", ...}
+        self.event_times = {}    # symbol/asset -> время последнего события (мс), чтобы сверка не затирала более свежие данные
+        self.synced = False
+        self.order_fills = collections.OrderedDict()  # orderId -> состояние исполнения
+        self.trade_ledger = {}   # symbol -> {"seen": id трейдов, "orders": orderId -> итоги}
+        self.listen_key = None
+        # User Data Stream и его супервизор (см. user_stream_supervisor)
+        self.user_twm = None
+        self.user_socket = None
+        self.user_data_lock = threading.Lock()
+        self.stream_broken = threading.Event()
+        self.stream_seen_at = 0.0       # monotonic-время последнего сообщения стрима
+        self.stream_last_event_ms = 0   # время биржи (E) последнего события
+        # Агрегаты для пре-трейд риск-контроля (см. _update_exposure и update_liquidation_risk)
+        self.exposure = {}       # symbol -> (номинал, маржа)
+        self.symbol_leverage = {}  # symbol -> плечо, установленное ботом
+        self.total_notional = 0.0
+        self.total_margin = 0.0
+        self.near_liquidation = set()
+
+    def size_signal(self, leverage, quantity):
+        # Плечо и размер позиции с учётом настроек аккаунта
+        if self.quantity is not None:
+            quantity = self.quantity
+        else:
+            quantity = quantity * self.quantity_multiplier
+        return self.leverage or leverage, quantity
+
+def _on_binance_response(response, *args, **kwargs):
+    update_api_budget(response)
+    _binance_response_hook(response)
+
+def _load_accounts():
+    loaded = []
+    if BINANCE_API_KEY and BINANCE_API_SECRET:
+        loaded.append(Account("main", BINANCE_API_KEY, BINANCE_API_SECRET))
+    raw = os.getenv("BINANCE_ACCOUNTS")
+    if raw:
+        if os.path.isfile(raw):
+            with open(raw) as f:
+                raw = f.read()
+        loaded.extend(Account(**cfg) for cfg in json.loads(raw))
+    if not loaded:
+        raise Exception("❌ BINANCE_API_KEY и BINANCE_API_SECRET (или BINANCE_ACCOUNTS) должны быть заданы в переменных окружения")
+    return loaded
+
+accounts = _load_accounts()
+_account_context = threading.local()
+
+def current_account():
+    return getattr(_account_context, "account", None) or accounts[0]
+
+@contextlib.contextmanager
+def use_account(account):
+    previous = getattr(_account_context, "account", None)
+    _account_context.account = account
+    try:
+        yield account
+    finally:
+        _account_context.account = previous
+
+def run_for_account(account, func, *args):
+    with use_account(account):
+        return func(*args)
+
+def account_label():
+    # Префикс сообщений в Telegram в мультиаккаунтном режиме
+    return f"[{current_account().name}] " if len(accounts) > 1 else ""
+
+# Пул для параллельного исполнения сигнала/закрытия на всех аккаунтах. Каждый из SIGNAL_WORKERS
+# шардов очереди сигналов (см. «Асинхронная обработка сигналов») может одновременно занять по потоку
+# на аккаунт, иначе сигнал одного символа задерживал бы сигналы остальных.
+SIGNAL_WORKERS = int(os.getenv("SIGNAL_WORKERS", 8))
+account_executor = ThreadPoolExecutor(max_workers=len(accounts) * SIGNAL_WORKERS, thread_name_prefix="accounts")
+
+def sync_server_time():
+    # Время сервера общее для всех аккаунтов – калибруем по первому и раздаём смещение остальным
+    offset = accounts[0].client.sync_server_time()
+    for account in accounts[1:]:
+        account.client.timestamp_offset = offset
+    logging.debug(f"DEBUG: Смещение часов относительно Binance: {offset} мс")
+    return offset
+
+def time_sync_worker():
+    while True:
+        time.sleep(TIME_SYNC_INTERVAL)
+        try:
+            with api_priority(PRIORITY_LOW):
+                sync_server_time()
+        except Exception as e:
+            logging.error(f"❌ Ошибка синхронизации времени с Binance: {e}")
+
+def prewarm_connections():
+    # Открываем TLS-соединения заранее, чтобы первые ордера не тратили время на handshake
+    started_at = time.monotonic()
+    with ThreadPoolExecutor(max_workers=BINANCE_PREWARM_CONNECTIONS) as pool:
+        for account in accounts:
+            results = pool.map(lambda _: account.client.futures_ping(), range(BINANCE_PREWARM_CONNECTIONS))
+            try:
+                list(results)
+            except Exception as e:
+                logging.error(f"❌ Ошибка прогрева соединений {account.name}: {e}")
+    logging.info(f"🔥 Соединения с Binance прогреты за {(time.monotonic() - started_at) * 1000:.0f} мс")
+
+# Бот работает только с фьючерсами, поэтому пингуем futures API и сразу калибруем часы
 try:
-    binance_client.ping()
-    logging.info("✅ Подключение к Binance успешно")
+    accounts[0].client.futures_ping()
+    sync_server_time()
+    logging.info(f"✅ Подключение к Binance успешно (аккаунтов: {len(accounts)})")
 except Exception as e:
     logging.error(f"❌ Ошибка подключения к Binance: {e}")
 
-# Глобальный словарь для хранения данных открытых позиций по символам.
-# Сохраняются: signal, entry_price, quantity, leverage, used_margin,
-# commission_entry, break_even_price, liq_price, tp_perc, sl_perc
-positions_entry_data = {}
+# --------------------------
+# Персистентное хранилище состояния (SQLite в режиме WAL).
+# positions_entry_data всех аккаунтов и trading_enabled переживают перезапуск. Запись идёт через очередь
+# в отдельном потоке, чтобы не задерживать торговый путь; при старте состояние
+# загружается и сверяется с биржей.
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "bot_state.db")
+state_write_queue = queue.Queue()
+
+def _open_state_db():
+    conn = sqlite3.connect(STATE_DB_PATH, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS entry_data (account TEXT NOT NULL, symbol TEXT NOT NULL, data TEXT NOT NULL, PRIMARY KEY (account, symbol))")
+    conn.execute("CREATE TABLE IF NOT EXISTS control (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    # Перенос записей из старой таблицы positions (до мультиаккаунтного режима) в основной аккаунт
+    if conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'positions'").fetchone():
+        conn.execute("INSERT OR IGNORE INTO entry_data (account, symbol, data) SELECT ?, symbol, data FROM positions", (accounts[0].name,))
+        conn.execute("DROP TABLE positions")
+    conn.commit()
+    return conn
+
+def persist_position(symbol, entry_data):
+    # entry_data=None – позиция закрыта, запись удаляется
+    key = (current_account().name, symbol)
+    state_write_queue.put(("entry_data", key, json.dumps(entry_data) if entry_data is not None else None))
+
+def persist_control(key, value):
+    state_write_queue.put(("control", key, json.dumps(value)))
+
+def state_writer_worker():
+    conn = _open_state_db()
+    while True:
+        writes = [state_write_queue.get()]
+        while True:
+            try:
+                writes.append(state_write_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            with conn:
+                for table, key, value in writes:
+                    if table == "entry_data":
+                        if value is None:
+                            conn.execute("DELETE FROM entry_data WHERE account = ? AND symbol = ?", key)
+                        else:
+                            conn.execute("INSERT OR REPLACE INTO entry_data (account, symbol, data) VALUES (?, ?, ?)", (*key, value))
+                    else:
+                        conn.execute("INSERT OR REPLACE INTO control (key, value) VALUES (?, ?)", (key, value))
+        except Exception as e:
+            logging.error(f"❌ Ошибка записи состояния в {STATE_DB_PATH}: {e}")
+
+def load_state():
+    global trading_enabled
+    try:
+        conn = _open_state_db()
+        rows = conn.execute("SELECT account, symbol, data FROM entry_data").fetchall()
+        control = {key: json.loads(value) for key, value in conn.execute("SELECT key, value FROM control")}
+        conn.close()
+    except Exception as e:
+        logging.error(f"❌ Ошибка загрузки состояния из {STATE_DB_PATH}: {e}")
+        open_journal()
+        return
+    by_name = {account.name: account for account in accounts}
+    for account_name, symbol, data in rows:
+        if account_name in by_name:
+            by_name[account_name].positions_entry_data[symbol] = json.loads(data)
+        else:
+            logging.warning(f"⚠️ В сохранённом состоянии есть позиция {symbol} неизвестного аккаунта {account_name}, пропускаем.")
+    trading_enabled = control.get("trading_enabled", trading_enabled)
+    open_journal(control.get("journal_rollups"))
+    logging.info(f"✅ Состояние восстановлено: {len(rows)} позиций, торговля {'включена' if trading_enabled else 'отключена'}.")
+
+def set_trading_enabled(enabled):
+    global trading_enabled
+    trading_enabled = enabled
+    if state_backend is not None:
+        state_backend.set_value("trading_enabled", enabled)
+    else:
+        persist_control("trading_enabled", enabled)
+
+# --------------------------
+# Многопроцессный режим (STATE_BACKEND=sqlite|redis, запуск через wsgi.py под gunicorn и т.п.).
+# Каждый процесс принимает HTTP-запросы, но торговое состояние и фоновые сервисы (исполнение сигналов,
+# опрос Telegram, User Data Stream, автоочистка, рыночные данные, движок выходов) живут только в одном
+# процессе – лидере, выбранном через аренду в общем хранилище. Остальные процессы проверяют флаг торговли
+# и дубликаты по общему хранилищу и передают сигналы и обновления Telegram лидеру через общую очередь.
+# Лидер, не сумевший продлить аренду, завершает процесс, чтобы не работать параллельно с новым лидером.
+# По умолчанию (STATE_BACKEND=local) бот работает в одном процессе, как раньше.
+STATE_BACKEND = os.getenv("STATE_BACKEND", "local")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", 15))
+SHARED_QUEUE_POLL = 0.005  # период опроса очереди в SQLite, сек
+PROCESS_ID = f"{os.uname().nodename}:{os.getpid()}:{os.urandom(4).hex()}"
+is_leader = False
+
+class SqliteStateBackend:
+    # Общие флаги – в таблице control того же файла состояния, что и persist_control
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=5, isolation_level=None)
+        self.lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS control (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS signal_keys (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS shared_queue (id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL)")
+
+    def get_value(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM control WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_value(self, key, value):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO control (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def acquire_lease(self, name, owner, ttl):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+                (name, owner, now + ttl, now))
+            row = self.conn.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()
+        return row is not None and row[0] == owner
+
+    def claim_key(self, key, ttl):
+        # True – ключ встречается впервые за ttl секунд
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT INTO signal_keys (key, expires_at) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET expires_at = excluded.expires_at WHERE signal_keys.expires_at < ?",
+                (key, now + ttl, now))
+            if cursor.rowcount and zlib.crc32(key.encode()) % 100 == 0:
+                self.conn.execute("DELETE FROM signal_keys WHERE expires_at < ?", (now,))
+        return cursor.rowcount == 1
+
+    def push(self, item):
+        with self.lock:
+            self.conn.execute("INSERT INTO shared_queue (payload) VALUES (?)", (json.dumps(item),))
+
+    def pop(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            # Пустая очередь проверяется обычным чтением, без блокировки записи в базе
+            with self.lock:
+                empty = self.conn.execute("SELECT 1 FROM shared_queue LIMIT 1").fetchone() is None
+            if empty:
+                if time.monotonic() >= deadline:
+                    return []
+                time.sleep(SHARED_QUEUE_POLL)
+                continue
+            with self.lock:
+                self.conn.execute("BEGIN IMMEDIATE")
+                try:
+                    rows = self.conn.execute("SELECT id, payload FROM shared_queue ORDER BY id LIMIT 100").fetchall()
+                    if rows:
+                        self.conn.execute("DELETE FROM shared_queue WHERE id <= ?", (rows[-1][0],))
+                    self.conn.execute("COMMIT")
+                except Exception:
+                    self.conn.execute("ROLLBACK")
+                    raise
+            if rows or time.monotonic() >= deadline:
+                return [json.loads(payload) for _, payload in rows]
+            time.sleep(SHARED_QUEUE_POLL)
+
+class RedisStateBackend:
+    # Подходит любой сервер с протоколом Redis (Redis, Valkey, KeyDB, Dragonfly)
+    RENEW_SCRIPT = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end "
+        "if redis.call('set', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then return 1 end return 0"
+    )
+
+    def __init__(self, url, prefix="bot:"):
+        try:
+            import redis
+        except ImportError:
+            raise Exception("❌ Для STATE_BACKEND=redis нужен пакет redis (pip install redis)")
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.renew = self.redis.register_script(self.RENEW_SCRIPT)
+
+    def get_value(self, key, default=None):
+        value = self.redis.get(self.prefix + key)
+        return json.loads(value) if value is not None else default
+
+    def set_value(self, key, value):
+        self.redis.set(self.prefix + key, json.dumps(value))
+
+    def acquire_lease(self, name, owner, ttl):
+        return bool(self.renew(keys=[f"{self.prefix}lease:{name}"], args=[owner, int(ttl * 1000)]))
+
+    def claim_key(self, key, ttl):
+        return bool(self.redis.set(f"{self.prefix}signal:{key}", 1, nx=True, ex=max(int(ttl), 1)))
+
+    def push(self, item):
+        self.redis.rpush(self.prefix + "queue", json.dumps(item))
+
+    def pop(self, timeout):
+        item = self.redis.blpop([self.prefix + "queue"], timeout=max(int(timeout), 1))
+        if item is None:
+            return []
+        items = [item[1]] + (self.redis.lpop(self.prefix + "queue", 99) or [])
+        return [json.loads(i) for i in items]
+
+if STATE_BACKEND == "sqlite":
+    state_backend = SqliteStateBackend(STATE_DB_PATH)
+elif STATE_BACKEND == "redis":
+    state_backend = RedisStateBackend(REDIS_URL)
+elif STATE_BACKEND == "local":
+    state_backend = None
+else:
+    raise Exception(f"❌ Неизвестный STATE_BACKEND: {STATE_BACKEND} (ожидается local, sqlite или redis)")
+
+def is_trading_enabled():
+    # В многопроцессном режиме флаг читается из общего хранилища: /pause действует на все процессы сразу
+    if state_backend is not None:
+        return state_backend.get_value("trading_enabled", False)
+    return trading_enabled
+
+def shared_queue_worker():
+    # Лидер: сигналы и команды Telegram, принятые любым процессом
+    while True:
+        try:
+            items = state_backend.pop(timeout=1)
+        except Exception as e:
+            logging.error(f"❌ Ошибка чтения общей очереди: {e}")
+            time.sleep(1)
+            continue
+        for item in items:
+            if item.get("kind") == "signal":
+                submit_signal(item["symbol"], item["data"])
+            elif item.get("kind") == "telegram":
+                dispatch_telegram_update(item["update"])
+            elif item.get("kind") == "targets":
+                threading.Thread(target=process_targets, args=(item["targets"],), daemon=True).start()
+
+def _start_leader_services():
+    start_services()
+    threading.Thread(target=shared_queue_worker, daemon=True).start()
+
+def leader_election_worker():
+    global is_leader
+    renewed_at = time.monotonic()
+    while True:
+        try:
+            acquired = state_backend.acquire_lease("leader", PROCESS_ID, LEADER_LEASE_TTL)
+            if acquired:
+                renewed_at = time.monotonic()
+        except Exception as e:
+            logging.error(f"❌ Ошибка продления аренды лидера: {e}")
+            acquired = is_leader and time.monotonic() - renewed_at < LEADER_LEASE_TTL
+        if acquired and not is_leader:
+            is_leader = True
+            logging.info(f"👑 Процесс {PROCESS_ID} стал лидером, запускаем фоновые сервисы.")
+            # Запуск сервисов ходит в сеть и может длиться дольше аренды – продление не ждёт его
+            threading.Thread(target=_start_leader_services, daemon=True).start()
+        elif not acquired and is_leader:
+            logging.critical(f"❌ Процесс {PROCESS_ID} потерял лидерство, завершаемся.")
+            os._exit(1)
+        time.sleep(LEADER_LEASE_TTL / 3)
+
+def start_worker():
+    # Точка входа процесса в многопроцессном режиме (см. wsgi.py)
+    if state_backend is None:
+        raise Exception("❌ Многопроцессный режим требует STATE_BACKEND=sqlite или redis")
+    threading.Thread(target=leader_election_worker, daemon=True).start()
+
+# --------------------------
+# Журнал сделок: бинарный файл только на дозапись (JOURNAL_PATH) с записями фиксированного размера –
+# сигналы, ордера, исполнения и закрытия сделок. Читается через mmap без разбора всего файла в память.
+# Статистика для /stats (в целом, по символам, дням UTC и способу закрытия) обновляется
+# инкрементально при каждом закрытии; снимок сводок вместе со смещением в журнале периодически
+# сохраняется в SQLite, поэтому при старте дочитывается только хвост журнала.
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "trade_journal.bin")
+JOURNAL_SNAPSHOT_EVERY = int(os.getenv("JOURNAL_SNAPSHOT_EVERY", 100))  # закрытий между снимками сводок
+# kind, method, side, ts(мс), symbol, account, order_id, qty, price, commission, pnl, net_pnl
+JOURNAL_RECORD = struct.Struct("<BBbq16s12sqddddd")
+JOURNAL_SIGNAL, JOURNAL_ORDER, JOURNAL_FILL, JOURNAL_CLOSE = 1, 2, 3, 4
+JOURNAL_METHODS = ("", "TP", "SL", "MANUAL", "TARGET")  # новые способы – только в конец, индекс хранится в записи
+journal_file = None
+journal_offset = 0
+journal_closes_since_snapshot = 0
+journal_rollups = {"all": {}, "symbol": {}, "day": {}, "method": {}}
+journal_lock = threading.Lock()
+
+def journal_write(kind, symbol, side=0, order_id=0, qty=0.0, price=0.0, commission=0.0, pnl=0.0, net_pnl=0.0, method="", ts=None):
+    global journal_offset, journal_closes_since_snapshot
+    if journal_file is None:
+        return
+    ts = int(time.time() * 1000) if ts is None else ts
+    record = JOURNAL_RECORD.pack(kind, JOURNAL_METHODS.index(method) if method in JOURNAL_METHODS else 0, side, ts,
+                                 symbol.encode()[:16], current_account().name.encode()[:12], int(order_id or 0),
+                                 qty, price, commission, pnl, net_pnl)
+    with journal_lock:
+        journal_file.write(record)
+        journal_file.flush()
+        journal_offset += len(record)
+        if kind != JOURNAL_CLOSE:
+            return
+        _update_rollups(JOURNAL_RECORD.unpack(record))
+        journal_closes_since_snapshot += 1
+        if journal_closes_since_snapshot >= JOURNAL_SNAPSHOT_EVERY:
+            journal_closes_since_snapshot = 0
+            persist_control("journal_rollups", {"offset": journal_offset, "rollups": journal_rollups})
+
+def read_journal(path=JOURNAL_PATH, start=0):
+    # Генератор записей журнала начиная со смещения start (неполная последняя запись пропускается)
+    if not os.path.exists(path) or os.path.getsize(path) <= start:
+        return
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        end = start + (len(mm) - start) // JOURNAL_RECORD.size * JOURNAL_RECORD.size
+        yield from JOURNAL_RECORD.iter_unpack(mm[start:end])
+
+def _update_rollups(record):
+    _, method, _, ts, symbol, _, _, _, _, commission, pnl, net_pnl = record
+    day = time.strftime("%Y-%m-%d", time.gmtime(ts / 1000))
+    keys = (
+        journal_rollups["all"].setdefault("all", {}),
+        journal_rollups["symbol"].setdefault(symbol.rstrip(b"\0").decode(), {}),
+        journal_rollups["day"].setdefault(day, {}),
+        journal_rollups["method"].setdefault(JOURNAL_METHODS[method] or "MANUAL", {}),
+    )
+    for stats in keys:
+        stats["trades"] = stats.get("trades", 0) + 1
+        stats["wins"] = stats.get("wins", 0) + (net_pnl > 0)
+        stats["pnl"] = stats.get("pnl", 0.0) + pnl
+        stats["commission"] = stats.get("commission", 0.0) + commission
+        stats["net_pnl"] = stats.get("net_pnl", 0.0) + net_pnl
+        stats["peak"] = max(stats.get("peak", 0.0), stats["net_pnl"])
+        stats["max_drawdown"] = max(stats.get("max_drawdown", 0.0), stats["peak"] - stats["net_pnl"])
+
+def open_journal(snapshot=None):
+    global journal_file, journal_offset, journal_rollups
+    size = os.path.getsize(JOURNAL_PATH) if os.path.exists(JOURNAL_PATH) else 0
+    # Хвост после последней полной записи (обрыв при падении) отбрасывается
+    size -= size % JOURNAL_RECORD.size
+    start = 0
+    if snapshot and snapshot.get("offset", 0) <= size:
+        journal_rollups = snapshot["rollups"]
+        start = snapshot["offset"]
+    replayed = 0
+    for record in read_journal(JOURNAL_PATH, start):
+        if record[0] == JOURNAL_CLOSE:
+            _update_rollups(record)
+            replayed += 1
+    journal_file = open(JOURNAL_PATH, "ab")
+    journal_file.truncate(size)
+    journal_offset = size
+    logging.info(f"📒 Журнал сделок открыт: {size // JOURNAL_RECORD.size} записей, дочитано закрытий: {replayed}.")
+
+def format_stats_report():
+    with journal_lock:
+        total = dict(journal_rollups["all"].get("all", {}))
+        by_method = {k: dict(v) for k, v in journal_rollups["method"].items()}
+        by_symbol = sorted(journal_rollups["symbol"].items(), key=lambda item: -item[1]["trades"])[:10]
+        by_symbol = [(k, dict(v)) for k, v in by_symbol]
+        days = sorted(journal_rollups["day"].items())[-7:]
+        days = [(k, dict(v)) for k, v in days]
+    if not total:
+        return "ℹ️ Закрытых сделок в журнале пока нет."
+
+    def line(name, s):
+        return (f"{name:<12} {s['trades']:>6} {s['wins'] / s['trades'] * 100:>5.1f}% "
+                f"{s['net_pnl']:>11.2f} {s['commission']:>9.2f}")
+    lines = ["📊 Статистика сделок (чистый PnL после комиссий):", "```",
+             f"{'':<12} {'сделок':>6} {'win':>6} {'чистый PnL':>11} {'комиссии':>9}",
+             line("Всего", total), f"Макс. просадка: {total['max_drawdown']:.2f}", "", "По способу закрытия:"]
+    lines += [line(k, v) for k, v in sorted(by_method.items())]
+    lines += ["", "По символам (топ-10):"] + [line(k, v) for k, v in by_symbol]
+    lines += ["", "По дням (UTC):"] + [line(k, v) for k, v in days]
+    lines.append("```")
+    return "\n".join(lines)
 
-# Глобальная переменная для listen_key
-listen_key = None
+# --------------------------
+# Отправка сообщений в Telegram.
+# send_telegram_message только кладёт текст в ограниченную очередь; отправкой занимается
+# фоновый поток с keep-alive сессией. Сообщения, накопившиеся за время ожидания лимита,
+# склеиваются в одно, ответ 429 обрабатывается по retry_after.
+TELEGRAM_API_URL = f"{TELEGRAM_API_BASE}/bot{TELEGRAM_TOKEN}"
+TELEGRAM_MIN_INTERVAL = float(os.getenv("TELEGRAM_MIN_INTERVAL", 1.0))  # лимит Telegram ~1 сообщение/сек в чат
+TELEGRAM_QUEUE_SIZE = int(os.getenv("TELEGRAM_QUEUE_SIZE", 1000))
+TELEGRAM_MAX_LENGTH = 4096
+TELEGRAM_MAX_RETRIES = 5
+telegram_queue = queue.Queue(maxsize=TELEGRAM_QUEUE_SIZE)
+telegram_session = requests.Session()
+telegram_session.hooks["response"].append(_telegram_response_hook)
 
-# Функция отправки сообщения в Telegram
 def send_telegram_message(text):
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+    try:
+        telegram_queue.put_nowait(text)
+    except queue.Full:
+        logging.error(f"❌ Очередь Telegram переполнена, сообщение отброшено: {text[:100]}")
+
+def _coalesce_messages(texts):
+    # Пачки сообщений: [(склеенный текст, исходные части)]
+    chunks, current, parts = [], "", []
+    for text in texts:
+        text = text[:TELEGRAM_MAX_LENGTH]
+        if current and len(current) + 2 + len(text) > TELEGRAM_MAX_LENGTH:
+            chunks.append((current, parts))
+            current, parts = text, [text]
+        else:
+            current = f"{current}\n\n{text}" if current else text
+            parts.append(text)
+    if current:
+        chunks.append((current, parts))
+    return chunks
+
+def _post_telegram_message(text, parse_mode="Markdown"):
+    # True – отправлено; False – Telegram отклонил запрос (4xx, кроме 429); None – прочие ошибки
     payload = {
         "chat_id": TELEGRAM_CHAT_ID,
         "text": text,
-        "parse_mode": "Markdown"
     }
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+    for _ in range(TELEGRAM_MAX_RETRIES):
+        try:
+            response = telegram_session.post(f"{TELEGRAM_API_URL}/sendMessage", data=payload, timeout=10)
+            # Ответ sendMessage повторяет весь текст сообщения – в INFO только статус и message_id
+            if response.ok:
+                log_event(logging.INFO, "📤 Отправлено в Telegram", status=response.status_code,
+                          message_id=response.json().get("result", {}).get("message_id"))
+            logging.debug("DEBUG: Ответ Telegram: %s %s", response.status_code, response.text)
+            if response.status_code == 429:
+                retry_after = response.json().get("parameters", {}).get("retry_after", 1)
+                logging.warning(f"⏳ Telegram лимит запросов, повтор через {retry_after} сек.")
+                time.sleep(retry_after)
+                continue
+            if 400 <= response.status_code < 500:
+                logging.error(f"❌ Telegram отклонил сообщение: {response.status_code} {response.text[:200]}")
+                return False
+            response.raise_for_status()
+            return True
+        except Exception as e:
+            logging.error(f"❌ Ошибка отправки в Telegram: {e}")
+        return None
+
+def _send_telegram_chunk(chunk, parts):
+    if _post_telegram_message(chunk) is not False:
+        return
+    # Склейка отклонена (ошибка разметки или обрезка внутри ```): шлём части по одной,
+    # а отклонённую и по отдельности – без разметки
+    for text in parts:
+        time.sleep(TELEGRAM_MIN_INTERVAL)
+        if len(parts) > 1 and _post_telegram_message(text) is not False:
+            continue
+        time.sleep(TELEGRAM_MIN_INTERVAL)
+        _post_telegram_message(text, parse_mode=None)
+
+def telegram_sender_worker():
+    while True:
+        texts = [telegram_queue.get()]
+        # Забираем всё, что накопилось, чтобы отправить пачкой
+        while True:
+            try:
+                texts.append(telegram_queue.get_nowait())
+            except queue.Empty:
+                break
+        for chunk, parts in _coalesce_messages(texts):
+            _send_telegram_chunk(chunk, parts)
+            time.sleep(TELEGRAM_MIN_INTERVAL)
+
+# --------------------------
+# Локальное зеркало аккаунта: позиции, балансы и открытые ордера.
+# Обновляется событиями ACCOUNT_UPDATE / ORDER_TRADE_UPDATE из User Data Stream
+# и периодически сверяется с REST, чтобы get_position и get_futures_balance
+# не ходили в API на каждый вызов.
+ACCOUNT_RECONCILE_INTERVAL = int(os.getenv("ACCOUNT_RECONCILE_INTERVAL", 60))
+account_state_lock = threading.Lock()
+
+def _apply_position_update(p, event_time):
+    account = current_account()
+    if p.get("ps", "BOTH") != "BOTH":
+        return
+    symbol = p["s"]
+    pos = account.positions.setdefault(symbol, {"symbol": symbol})
+    pos.update({
+        "positionAmt": p.get("pa", "0"),
+        "entryPrice": p.get("ep", "0"),
+        "breakEvenPrice": p.get("bep", pos.get("breakEvenPrice", "0")),
+        "unRealizedProfit": p.get("up", "0"),
+        "marginType": p.get("mt", pos.get("marginType")),
+        "isolatedWallet": p.get("iw", pos.get("isolatedWallet", "0")),
+    })
+    account.event_times[symbol] = event_time
+    _update_exposure(account, symbol)
+
+def _update_exposure(account, symbol):
+    # Инкрементальный пересчёт номинала и маржи аккаунта после изменения одной позиции (под account_state_lock)
+    pos = account.positions.get(symbol) or {}
+    notional = abs(float(pos.get("positionAmt", 0))) * float(pos.get("entryPrice", 0))
+    margin = float(pos.get("isolatedWallet", 0) or 0)
+    if notional and not margin:
+        entry_data = account.positions_entry_data.get(symbol) or {}
+        margin = notional / (entry_data.get("leverage") or account.leverage or DEFAULT_LEVERAGE)
+    old_notional, old_margin = account.exposure.pop(symbol, (0.0, 0.0))
+    if notional:
+        account.exposure[symbol] = (notional, margin)
+    account.total_notional += notional - old_notional
+    account.total_margin += margin - old_margin
+
+def _apply_order_update(o):
+    account = current_account()
+    order_id = o.get("i")
+    if o.get("X") in ("NEW", "PARTIALLY_FILLED"):
+        account.open_orders[order_id] = {
+            "orderId": order_id,
+            "clientOrderId": o.get("c"),
+            "symbol": o.get("s"),
+            "side": o.get("S"),
+            "type": o.get("ot", o.get("o")),
+            "status": o.get("X"),
+            "stopPrice": o.get("sp"),
+        }
+    else:
+        account.open_orders.pop(order_id, None)
+
+def update_account_state(msg):
+    account = current_account()
+    event = msg.get("e")
+    event_time = msg.get("E", 0)
+    with account_state_lock:
+        if event == "ACCOUNT_UPDATE":
+            data = msg.get("a", {})
+            for b in data.get("B", []):
+                bal = account.balances.setdefault(b["a"], {"asset": b["a"]})
+                bal.update({"balance": b.get("wb", "0"), "crossWalletBalance": b.get("cw", "0")})
+                account.event_times[b["a"]] = event_time
+            for p in data.get("P", []):
+                _apply_position_update(p, event_time)
+        elif event == "ORDER_TRADE_UPDATE":
+            _apply_order_update(msg.get("o", {}))
+
+def reconcile_account_state():
+    account = current_account()
+    started_at = int(time.time() * 1000)
     try:
-        response = requests.post(url, data=payload)
-        logging.info(f"📤 Отправка в Telegram: {response.status_code} - {response.text}")
-        response.raise_for_status()
+        with api_priority(PRIORITY_LOW):
+            positions = account.client.futures_position_information()
+            balances = account.client.futures_account_balance()
+            open_orders = account.client.futures_get_open_orders()
     except Exception as e:
-        logging.error(f"❌ Ошибка отправки в Telegram: {e}")
+        logging.error(f"❌ Ошибка сверки состояния аккаунта: {e}")
+        return False
+    with account_state_lock:
+        for p in positions:
+            if account.event_times.get(p["symbol"], 0) < started_at:
+                account.positions[p["symbol"]] = p
+                _update_exposure(account, p["symbol"])
+        # Position Information V3 не возвращает символы без позиции и ордеров – такие символы закрыты,
+        # если с начала сверки по ним не пришло более свежего события
+        returned = {p["symbol"] for p in positions}
+        for symbol in [s for s in account.positions if s not in returned]:
+            if account.event_times.get(symbol, 0) < started_at:
+                account.positions.pop(symbol)
+                _update_exposure(account, symbol)
+        for b in balances:
+            if account.event_times.get(b["asset"], 0) < started_at:
+                account.balances[b["asset"]] = b
+        # Полная сверка заодно убирает накопленную погрешность инкрементальных сумм
+        account.total_notional = sum(notional for notional, _ in account.exposure.values())
+        account.total_margin = sum(margin for _, margin in account.exposure.values())
+        account.open_orders.clear()
+        account.open_orders.update({o["orderId"]: o for o in open_orders})
+        account.synced = True
+    logging.debug(f"DEBUG: Состояние аккаунта сверено: {len(positions)} позиций, {len(open_orders)} открытых ордеров")
+    return True
+
+# Удаляет восстановленные после перезапуска записи, по которым на бирже уже нет позиции
+def reconcile_entry_data():
+    account = current_account()
+    if not account.synced:
+        return
+    for symbol in list(account.positions_entry_data):
+        pos = get_position(symbol)
+        if pos is None or abs(float(pos.get("positionAmt", 0))) == 0:
+            account.positions_entry_data.pop(symbol, None)
+            persist_position(symbol, None)
+            remove_exit(account, symbol)
+            logging.info(f"🧹 Позиция {symbol} закрыта, пока бот был остановлен – данные входа удалены.")
+
+def account_reconcile_worker():
+    while True:
+        time.sleep(ACCOUNT_RECONCILE_INTERVAL)
+        reconcile_account_state()
+
+# --------------------------
+# Журнал трейдов по символам: комиссия (n), реализованный PnL (rp) и объём исполнений
+# берутся прямо из ORDER_TRADE_UPDATE и агрегируются по orderId (учитывает частичные исполнения).
+# Догрузка из REST – только трейды конкретного ордера (orderId), без выкачивания истории:
+# userTrades отдаёт не больше 500 записей по возрастанию, и по времени нужный трейд можно не найти.
+TRADE_LEDGER_ORDERS_MAX = 500       # сколько последних ордеров хранить по символу
+TRADE_LEDGER_SEEN_MAX = 5000        # сколько последних id трейдов помнить для дедупликации
+trade_ledger_lock = threading.Lock()
+
+def _record_trade(symbol, order_id, trade_id, qty, price, commission, realized_pnl):
+    account = current_account()
+    book = account.trade_ledger.get(symbol)
+    if book is None:
+        book = account.trade_ledger[symbol] = {
+            "seen": collections.OrderedDict(),
+            "orders": collections.OrderedDict(),
+        }
+    if trade_id in book["seen"]:
+        return False
+    book["seen"][trade_id] = True
+    while len(book["seen"]) > TRADE_LEDGER_SEEN_MAX:
+        book["seen"].popitem(last=False)
+
+    totals = book["orders"].get(order_id)
+    if totals is None:
+        totals = book["orders"][order_id] = {"qty": 0.0, "notional": 0.0, "commission": 0.0, "realized_pnl": 0.0, "trades": 0}
+    totals["qty"] += qty
+    totals["notional"] += qty * price
+    totals["commission"] += commission
+    totals["realized_pnl"] += realized_pnl
+    totals["trades"] += 1
+    book["orders"].move_to_end(order_id)
+    while len(book["orders"]) > TRADE_LEDGER_ORDERS_MAX:
+        book["orders"].popitem(last=False)
+    return True
+
+def record_trade_event(o):
+    if o.get("x") != "TRADE":
+        return
+    with trade_ledger_lock:
+        _record_trade(o.get("s"), o.get("i"), int(o.get("t", 0)), float(o.get("l", 0)),
+                      float(o.get("L", 0)), float(o.get("n", 0)), float(o.get("rp", 0)))
+
+def _record_rest_trades(symbol, trades):
+    with trade_ledger_lock:
+        for t in trades:
+            _record_trade(symbol, t["orderId"], int(t["id"]), float(t.get("qty", 0)), float(t.get("price", 0)),
+                          float(t.get("commission", 0)), float(t.get("realizedPnl", 0)))
+
+def backfill_trade_ledger(symbol, order_id):
+    account = current_account()
+    try:
+        with api_priority(PRIORITY_LOW):
+            trades = account.client.futures_account_trades(symbol=symbol, orderId=order_id)
+    except Exception as e:
+        logging.error(f"❌ Ошибка догрузки трейдов ордера {order_id} для {symbol}: {e}")
+        return 0
+    _record_rest_trades(symbol, trades)
+    return len(trades)
+
+def get_order_totals(symbol, order_id):
+    with trade_ledger_lock:
+        totals = current_account().trade_ledger.get(symbol, {}).get("orders", {}).get(order_id)
+        return dict(totals) if totals else None
+
+# --------------------------
+# Отслеживание исполнения ордеров по событиям ORDER_TRADE_UPDATE.
+# Позволяет дождаться FILLED конкретного orderId вместо фиксированных time.sleep;
+# REST – только по таймауту. Комиссия берётся из журнала трейдов.
+ORDER_FILL_TIMEOUT = float(os.getenv("ORDER_FILL_TIMEOUT", 5))
+ORDER_FILLS_MAX = 1000
+ORDER_FINAL_STATUSES = ("FILLED", "CANCELED", "EXPIRED", "REJECTED", "EXPIRED_IN_MATCH")
+order_fills_lock = threading.Lock()
+
+def _order_fill_entry(order_id):
+    account = current_account()
+    entry = account.order_fills.get(order_id)
+    if entry is None:
+        entry = account.order_fills[order_id] = {
+            "status": None,
+            "avg_price": 0.0,
+            "filled_qty": 0.0,
+            "event": threading.Event(),
+        }
+        # Храним только последние ORDER_FILLS_MAX ордеров
+        while len(account.order_fills) > ORDER_FILLS_MAX:
+            account.order_fills.popitem(last=False)
+    return entry
+
+def track_order_update(o):
+    with order_fills_lock:
+        entry = _order_fill_entry(o.get("i"))
+        entry["status"] = o.get("X")
+        entry["avg_price"] = float(o.get("ap", 0))
+        entry["filled_qty"] = float(o.get("z", 0))
+        if entry["status"] in ORDER_FINAL_STATUSES:
+            entry["event"].set()
+
+def _fetch_order_fill(symbol, order_id):
+    account = current_account()
+    order = account.client.futures_get_order(symbol=symbol, orderId=order_id)
+    _record_rest_trades(symbol, account.client.futures_account_trades(symbol=symbol, orderId=order_id))
+    return {
+        "status": order.get("status"),
+        "avg_price": float(order.get("avgPrice", 0)),
+        "filled_qty": float(order.get("executedQty", 0)),
+    }
 
-# Функция для получения позиции по символу (на фьючерсном аккаунте)
-def get_position(symbol):
+def wait_for_fill(symbol, order, timeout=ORDER_FILL_TIMEOUT):
+    return wait_for_fills([(symbol, order)], timeout)[0]
+
+def wait_for_fills(orders, timeout=ORDER_FILL_TIMEOUT):
+    # Несколько ордеров [(symbol, order)] ждут в текущем потоке с общим дедлайном; результат – по каждому ордеру
+    with order_fills_lock:
+        entries = [_order_fill_entry(order.get("orderId")) for _, order in orders]
+    deadline = time.monotonic() + timeout
+    for entry in entries:
+        entry["event"].wait(max(0.0, deadline - time.monotonic()))
+    return [_collect_fill(symbol, order, entry, timeout) for (symbol, order), entry in zip(orders, entries)]
+
+def _collect_fill(symbol, order, entry, timeout):
+    order_id = order.get("orderId")
+    if entry["event"].is_set():
+        with order_fills_lock:
+            fill = {k: v for k, v in entry.items() if k != "event"}
+    else:
+        logging.warning(f"⏳ Нет события исполнения ордера {order_id} для {symbol} за {timeout} сек, запрашиваем REST.")
+        try:
+            fill = _fetch_order_fill(symbol, order_id)
+        except Exception as e:
+            logging.error(f"❌ Ошибка получения статуса ордера {order_id} для {symbol}: {e}")
+            return None
+    totals = get_order_totals(symbol, order_id) or {}
+    fill["commission"] = totals.get("commission", 0.0)
+    fill["realized_pnl"] = totals.get("realized_pnl", 0.0)
+    return fill
+
+# Функция для получения позиции по символу (на фьючерсном аккаунте).
+# По умолчанию читает локальное зеркало; fresh=True принудительно запрашивает REST
+# (нужно, например, для liquidationPrice/initialMargin сразу после входа).
+def get_position(symbol, fresh=False):
+    account = current_account()
+    if account.synced and not fresh:
+        with account_state_lock:
+            pos = account.positions.get(symbol)
+            return dict(pos) if pos else None
     try:
-        info = binance_client.futures_position_information(symbol=symbol)
+        info = account.client.futures_position_information(symbol=symbol)
         pos = next((p for p in info if p["symbol"] == symbol), None)
         logging.debug(f"DEBUG: get_position для {symbol}: {pos}")
+        with account_state_lock:
+            if pos:
+                account.positions[symbol] = dict(pos)
+            else:
+                # Пустой ответ V3 – позиции нет
+                account.positions.pop(symbol, None)
+            _update_exposure(account, symbol)
         return pos
     except Exception as e:
         logging.error(f"❌ Ошибка получения позиции для {symbol}: {e}")
@@ -71,8 +1274,14 @@ def get_position(symbol):
 
 # Функция для получения текущего Futures баланса (например, USDT)
 def get_futures_balance():
+    account = current_account()
+    if account.synced:
+        with account_state_lock:
+            usdt_balance = account.balances.get("USDT")
+        return float(usdt_balance["balance"]) if usdt_balance else None
     try:
-        balances = binance_client.futures_account_balance()
+        with api_priority(PRIORITY_LOW):
+            balances = account.client.futures_account_balance()
         usdt_balance = next((item for item in balances if item["asset"] == "USDT"), None)
         if usdt_balance:
             return float(usdt_balance["balance"])
@@ -81,36 +1290,635 @@ def get_futures_balance():
     return None
 
 # --------------------------
-# Функция закрытия всех открытых позиций с использованием reduceOnly=True
+# Реестр метаданных символов (exchangeInfo).
+# Загружается один раз при старте и обновляется в фоне раз в SYMBOL_INFO_TTL секунд,
+# чтобы вебхук не запрашивал тяжёлый futures_exchange_info на каждый сигнал.
+SYMBOL_INFO_TTL = int(os.getenv("SYMBOL_INFO_TTL", 3600))
+symbol_filters = {}
+symbol_filters_updated_at = 0.0
+symbol_filters_lock = threading.Lock()
+
+def _parse_symbol_filters(symbol_info):
+    filters = {f.get("filterType"): f for f in symbol_info.get("filters", [])}
+    lot_size = filters.get("LOT_SIZE", {})
+    price_filter = filters.get("PRICE_FILTER", {})
+    min_notional = filters.get("MIN_NOTIONAL", {})
+    return {
+        "step_size": float(lot_size.get("stepSize", 0)),
+        "min_qty": float(lot_size.get("minQty", 0)),
+        "tick_size": float(price_filter.get("tickSize", 0)),
+        # если фильтр не найден, используем 20 USDT по умолчанию
+        "min_notional": float(min_notional.get("notional", min_notional.get("minNotional", 20.0))),
+        "quantity_precision": int(symbol_info.get("quantityPrecision", 3)),
+        "price_precision": int(symbol_info.get("pricePrecision", 2)),
+    }
+
+def refresh_symbol_filters():
+    global symbol_filters, symbol_filters_updated_at
+    with symbol_filters_lock:
+        try:
+            with api_priority(PRIORITY_LOW):
+                exchange_info = current_account().client.futures_exchange_info()
+        except Exception as e:
+            logging.error(f"❌ Ошибка загрузки exchangeInfo: {e}")
+            symbol_filters_updated_at = time.time()
+            return False
+        # Подменяем словарь целиком, чтобы читатели никогда не видели его частично заполненным
+        symbol_filters = {s["symbol"]: _parse_symbol_filters(s) for s in exchange_info.get("symbols", [])}
+        symbol_filters_updated_at = time.time()
+    logging.info(f"✅ exchangeInfo загружен: {len(symbol_filters)} символов.")
+    return True
+
+def get_symbol_filters(symbol):
+    info = symbol_filters.get(symbol)
+    if info is None and time.time() - symbol_filters_updated_at > 60:
+        # Неизвестный символ (например, новый листинг) – обновляем реестр, но не чаще раза в минуту
+        refresh_symbol_filters()
+        info = symbol_filters.get(symbol)
+    return info
+
+def symbol_filters_worker():
+    while True:
+        time.sleep(SYMBOL_INFO_TTL)
+        refresh_symbol_filters()
+
+def round_quantity(symbol, quantity, round_up=False):
+    info = get_symbol_filters(symbol)
+    if not info:
+        return round(quantity, 3)
+    step = info["step_size"]
+    if step:
+        steps = quantity / step
+        steps = math.ceil(steps - 1e-9) if round_up else math.floor(steps + 1e-9)
+        quantity = steps * step
+    return round(quantity, info["quantity_precision"])
+
+def round_price(symbol, price):
+    info = get_symbol_filters(symbol)
+    if not info:
+        return round(price, 2)
+    tick = info["tick_size"]
+    if tick:
+        price = round(price / tick) * tick
+    return round(price, info["price_precision"])
+
+# --------------------------
+# Торговые решения по сигналу: действие, размер входа, уровни TP/SL и итог сделки.
+# Функции не обращаются к бирже – их же использует replay.py для прогона записанных сигналов.
+DEFAULT_LEVERAGE = int(os.getenv("DEFAULT_LEVERAGE", 20))
+DEFAULT_QUANTITY = float(os.getenv("DEFAULT_QUANTITY", 0.02))
+
+def signal_action(position_amt, signal):
+    # "open" – позиции нет, "switch" – открыта противоположная, "skip" – уже открыта в ту же сторону
+    if abs(position_amt) == 0:
+        return "open"
+    current_direction = "long" if position_amt > 0 else "short"
+    return "switch" if current_direction != signal else "skip"
+
+def size_entry_quantity(symbol, quantity, last_price):
+    symbol_info = get_symbol_filters(symbol)
+    if symbol_info:
+        min_qty_required = round_quantity(symbol, symbol_info["min_notional"] / last_price, round_up=True)
+        if quantity < min_qty_required:
+            logging.info(f"Количество {quantity} слишком мало, минимальное требуемое: {min_qty_required:.6f}. Автоматически устанавливаем минимальное количество.")
+            quantity = min_qty_required
+    # Округляем quantity по шагу LOT_SIZE и точности символа
+    return round_quantity(symbol, quantity)
+
+def protective_levels(signal, break_even_price, tp_perc, sl_perc):
+    # Уровни TP/SL считаются от цены безубыточности; None – уровень не задан
+    direction = 1 if signal == "long" else -1
+    tp_level = break_even_price * (1 + direction * tp_perc / 100) if tp_perc != 0 else None
+    sl_level = break_even_price * (1 - direction * sl_perc / 100) if sl_perc != 0 else None
+    return tp_level, sl_level
+
+def close_summary(pnl, commission_entry, commission_exit, break_even_price):
+    total_commission = commission_entry + commission_exit
+    return {
+        "total_commission": total_commission,
+        "net_pnl": pnl - total_commission,
+        "net_break_even": break_even_price + total_commission,
+    }
+
+# --------------------------
+# Пре-трейд риск-контроль: проверка входа до switch_position.
+# Работает только с локальными агрегатами аккаунта (номинал и маржа позиций обновляются
+# инкрементально в _update_exposure, близость к ликвидации – на каждом тике марк-цен) и кешами
+# цен и фильтров символов, поэтому проверка – несколько сравнений без обращений к бирже.
+# Лимит 0 – проверка отключена. Превышение плеча и номинальных лимитов уменьшает вход,
+# если уменьшенный вход ниже MIN_NOTIONAL или позиция аккаунта близка к ликвидации – сигнал отклоняется.
+RISK_MAX_LEVERAGE = int(os.getenv("RISK_MAX_LEVERAGE", 0))
+RISK_MAX_ORDER_NOTIONAL = float(os.getenv("RISK_MAX_ORDER_NOTIONAL", 0))      # USDT на один вход
+RISK_MAX_SYMBOL_NOTIONAL = float(os.getenv("RISK_MAX_SYMBOL_NOTIONAL", 0))    # USDT на символ
+RISK_MAX_TOTAL_NOTIONAL = float(os.getenv("RISK_MAX_TOTAL_NOTIONAL", 0))      # USDT на аккаунт
+RISK_MAX_MARGIN_UTILIZATION = float(os.getenv("RISK_MAX_MARGIN_UTILIZATION", 0))  # доля баланса кошелька под маржей
+RISK_MIN_LIQ_DISTANCE_PERC = float(os.getenv("RISK_MIN_LIQ_DISTANCE_PERC", 0))    # % от марк-цены до цены ликвидации
+
+def check_pre_trade_risk(account, symbol, leverage, quantity, adds_to_position=False, price=None):
+    # Возвращает (leverage, quantity, reasons); quantity == 0 – вход отклонён.
+    # adds_to_position – вход увеличивает текущую позицию по символу, а не заменяет её;
+    # price – цена, уже полученная вызывающим (get_last_price), иначе берётся из кеша
+    reasons = []
+    if RISK_MIN_LIQ_DISTANCE_PERC and account.near_liquidation:
+        reasons.append(f"позиции близки к ликвидации: {', '.join(sorted(account.near_liquidation))}")
+        return leverage, 0.0, reasons
+    if RISK_MAX_LEVERAGE and leverage > RISK_MAX_LEVERAGE:
+        reasons.append(f"плечо {leverage} снижено до {RISK_MAX_LEVERAGE}")
+        leverage = RISK_MAX_LEVERAGE
+    if price is None:
+        price = get_cached_price(symbol)
+    if price is None:
+        pos = account.positions.get(symbol) or {}
+        price = float(pos.get("entryPrice", 0)) or None
+    if price is None:
+        # Без цены номинал не оценить – не ходим за ней в сеть, лимиты номинала пропускаются
+        logging.debug(f"DEBUG: Нет цены {symbol} в кеше, номинальные лимиты риск-контроля не проверяются.")
+        return leverage, quantity, reasons
+    # При переключении текущая позиция по символу закрывается и её экспозиция освобождается,
+    # при добавлении к позиции – остаётся занятой
+    held_notional, held_margin = account.exposure.get(symbol, (0.0, 0.0))
+    freed_notional, freed_margin = (0.0, 0.0) if adds_to_position else (held_notional, held_margin)
+    if not adds_to_position:
+        held_notional = 0.0
+    margin_per_notional = 2 / leverage  # начальная маржа и такая же доливка после входа (см. execute_signal)
+    limits = []
+    if RISK_MAX_ORDER_NOTIONAL:
+        limits.append((RISK_MAX_ORDER_NOTIONAL, "номинал входа"))
+    if RISK_MAX_SYMBOL_NOTIONAL:
+        limits.append((RISK_MAX_SYMBOL_NOTIONAL - held_notional, f"номинал по {symbol}"))
+    if RISK_MAX_TOTAL_NOTIONAL:
+        limits.append((RISK_MAX_TOTAL_NOTIONAL - account.total_notional + freed_notional, "общий номинал"))
+    if RISK_MAX_MARGIN_UTILIZATION:
+        balance = account.balances.get("USDT")
+        wallet = float(balance["balance"]) if balance else 0.0
+        free_margin = RISK_MAX_MARGIN_UTILIZATION * wallet - account.total_margin + freed_margin
+        limits.append((free_margin / margin_per_notional, "загрузка маржи"))
+    notional = quantity * price
+    for allowed, name in limits:
+        if notional > allowed:
+            notional = max(allowed, 0.0)
+            reasons.append(f"{name}: лимит {allowed:.2f} USDT")
+    if notional < quantity * price:
+        quantity = round_quantity(symbol, notional / price)
+        filters = get_symbol_filters(symbol)
+        min_notional = filters["min_notional"] if filters else 0.0
+        if quantity <= 0 or quantity * price < min_notional:
+            reasons.append(f"уменьшенный вход ниже минимального номинала {min_notional} USDT")
+            return leverage, 0.0, reasons
+    return leverage, quantity, reasons
+
+def update_liquidation_risk(prices):
+    # На тике марк-цен: множество символов аккаунта, где до цены ликвидации меньше RISK_MIN_LIQ_DISTANCE_PERC %
+    if not RISK_MIN_LIQ_DISTANCE_PERC:
+        return
+    for account in accounts:
+        near = set()
+        for symbol, entry_data in list(account.positions_entry_data.items()):
+            liq_price = float(entry_data.get("liq_price") or 0)
+            price = prices.get(symbol) or get_mark_price(symbol)
+            if liq_price and price and abs(price - liq_price) / price * 100 < RISK_MIN_LIQ_DISTANCE_PERC:
+                near.add(symbol)
+        if near != account.near_liquidation:
+            if near - account.near_liquidation:
+                logging.warning(f"⚠️ {account.name}: позиции близки к ликвидации: {', '.join(sorted(near))}")
+            account.near_liquidation = near
+
+# --------------------------
+# Рыночные данные из веб-сокетов Binance.
+# Марк-цены всех символов приходят одним потоком !markPrice@arr@1s, лучшие bid/ask – потоками
+# <symbol>@bookTicker, на которые бот подписывается для торгуемых символов. Последние значения
+# хранятся кортежами в словарях: запись целиком заменяется одной операцией, поэтому чтение
+# обходится без блокировок. Значения старше MARKET_DATA_MAX_AGE секунд считаются устаревшими.
+MARKET_DATA_MAX_AGE = float(os.getenv("MARKET_DATA_MAX_AGE", 5))
+mark_prices = {}     # symbol -> (mark_price, monotonic-время получения)
+book_tickers = {}    # symbol -> (bid, ask, monotonic-время получения)
+book_ticker_symbols = set()
+book_ticker_lock = threading.Lock()
+market_data_twm = None
+
+def handle_market_data(msg):
+    # Мультиплекс-потоки оборачивают данные в {"stream", "data"}
+    if isinstance(msg, dict) and "data" in msg:
+        msg = msg["data"]
+    received_at = time.monotonic()
+    if isinstance(msg, list):
+        tick = {}
+        for item in msg:
+            if item.get("e") == "markPriceUpdate":
+                tick[item["s"]] = float(item["p"])
+                mark_prices[item["s"]] = (tick[item["s"]], received_at)
+        with timed("exit_engine:tick"):
+            evaluate_exits(tick)
+        update_liquidation_risk(tick)
+    elif msg.get("e") == "markPriceUpdate":
+        mark_prices[msg["s"]] = (float(msg["p"]), received_at)
+        evaluate_exits({msg["s"]: float(msg["p"])})
+    elif msg.get("e") == "bookTicker":
+        book_tickers[msg["s"]] = (float(msg["b"]), float(msg["a"]), received_at)
+    elif msg.get("e") == "error":
+        logging.error(f"❌ Ошибка потока рыночных данных: {msg.get('m')}")
+
+def watch_symbol(symbol):
+    # Подписка на bookTicker символа (один раз); до запуска потоков символ просто запоминается
+    with book_ticker_lock:
+        if symbol in book_ticker_symbols:
+            return
+        book_ticker_symbols.add(symbol)
+        if market_data_twm is None:
+            return
+    market_data_twm.start_futures_multiplex_socket(callback=handle_market_data, streams=[f"{symbol.lower()}@bookTicker"])
+
+def start_market_data():
+    global market_data_twm
+    twm = ThreadedWebsocketManager()
+    twm.start()
+    twm.start_all_mark_price_socket(callback=handle_market_data)
+    with book_ticker_lock:
+        market_data_twm = twm
+        symbols = list(book_ticker_symbols)
+    if symbols:
+        twm.start_futures_multiplex_socket(callback=handle_market_data, streams=[f"{s.lower()}@bookTicker" for s in symbols])
+    logging.info(f"📡 Потоки рыночных данных запущены (bookTicker: {len(symbols)} символов).")
+
+def get_mark_price(symbol):
+    cached = mark_prices.get(symbol)
+    if cached and time.monotonic() - cached[1] <= MARKET_DATA_MAX_AGE:
+        return cached[0]
+    return None
+
+def get_cached_price(symbol):
+    # Середина спреда, если bookTicker свежий, иначе марк-цена; None – данных нет или они устарели
+    ticker = book_tickers.get(symbol)
+    if ticker and time.monotonic() - ticker[2] <= MARKET_DATA_MAX_AGE:
+        return (ticker[0] + ticker[1]) / 2
+    return get_mark_price(symbol)
+
+def get_last_price(symbol):
+    price = get_cached_price(symbol)
+    if price is not None:
+        inc_counter("bot_price_cache_total", result="hit")
+        return price
+    inc_counter("bot_price_cache_total", result="miss")
+    logging.debug(f"DEBUG: Нет свежей цены {symbol} в кеше, запрашиваем REST.")
+    return float(current_account().client.futures_symbol_ticker(symbol=symbol)["price"])
+
+# --------------------------
+# Слой отправки ордеров.
+# Обычные ордера (MARKET/LIMIT) группируются по ORDER_BATCH_SIZE в batchOrders, условные
+# (TP/SL) уходят отдельными запросами – библиотека направляет их на algoOrder, который
+# не поддерживает пакеты. Все запросы выполняются параллельно, результат – по каждому ордеру.
+ORDER_BATCH_SIZE = 5  # лимит Binance для batchOrders
+ORDER_WORKERS = int(os.getenv("ORDER_WORKERS", 10))
+CONDITIONAL_ORDER_TYPES = ("STOP", "STOP_MARKET", "TAKE_PROFIT", "TAKE_PROFIT_MARKET", "TRAILING_STOP_MARKET")
+order_executor = ThreadPoolExecutor(max_workers=ORDER_WORKERS, thread_name_prefix="orders")
+
+def _batch_order_params(params):
+    # batchOrders передаётся как JSON, Binance ожидает значения строками
+    return {k: ("true" if v else "false") if isinstance(v, bool) else str(v) for k, v in params.items()}
+
+def _place_single_order(account, index, params):
+    try:
+        return [(index, account.client.futures_create_order(**params), None)]
+    except Exception as e:
+        return [(index, None, str(e))]
+
+def _place_order_batch(account, chunk):
+    if len(chunk) == 1:
+        return _place_single_order(account, *chunk[0])
+    try:
+        responses = account.client.futures_place_batch_order(
+            batchOrders=[_batch_order_params(params) for _, params in chunk]
+        )
+    except Exception as e:
+        return [(index, None, str(e)) for index, _ in chunk]
+    results = []
+    for (index, _), resp in zip(chunk, responses):
+        if "code" in resp and "orderId" not in resp:
+            results.append((index, None, f"{resp.get('code')}: {resp.get('msg')}"))
+        else:
+            results.append((index, resp, None))
+    return results
+
+def place_orders(orders):
+    """
+    Отправляет список ордеров (словари параметров futures_create_order) минимальным
+    числом параллельных запросов. Возвращает список {"params", "order", "error"}
+    в том же порядке, что и orders. Ордера уходят с текущего аккаунта потока.
+    """
+    account = current_account()
+    plain = [(i, params) for i, params in enumerate(orders) if params.get("type") not in CONDITIONAL_ORDER_TYPES]
+    conditional = [(i, params) for i, params in enumerate(orders) if params.get("type") in CONDITIONAL_ORDER_TYPES]
+    futures = [
+        order_executor.submit(_place_order_batch, account, plain[i:i + ORDER_BATCH_SIZE])
+        for i in range(0, len(plain), ORDER_BATCH_SIZE)
+    ]
+    futures += [order_executor.submit(_place_single_order, account, i, params) for i, params in conditional]
+    results = [None] * len(orders)
+    for future in futures:
+        for index, order, error in future.result():
+            results[index] = {"params": orders[index], "order": order, "error": error}
+    return results
+
+# --------------------------
+# Движок выходов на стороне бота: трейлинг-стоп, перенос стопа в безубыток и частичная фиксация.
+# Параметры приходят в сигнале: trail_perc (дистанция трейлинга, %), breakeven_perc (при движении
+# в плюс на столько % от цены безубыточности стоп переносится на неё), partial_tp_perc/partial_tp_size
+# (при движении на partial_tp_perc % закрывается доля partial_tp_size позиции).
+# Уровни всех позиций хранятся в колонках array('d') и пересчитываются одним проходом на каждый
+# тик марк-цен. Биржевой STOP_MARKET переставляется (отмена + новый) только при изменении уровня
+# после округления до tick size и не чаще раза в EXIT_AMEND_INTERVAL секунд на позицию.
+EXIT_AMEND_INTERVAL = float(os.getenv("EXIT_AMEND_INTERVAL", 2))
+EXIT_PARTIAL_PREFIX = "ptp_"   # clientOrderId частичной фиксации – такие исполнения не закрывают сделку
+EXIT_STOP_PREFIX = "xsl_"      # clientOrderId рыночного закрытия, когда цена уже прошла уровень стопа
+exit_keys = []                  # слот -> (account, symbol)
+exit_symbols = []               # слот -> symbol
+exit_slots = {}                 # (account.name, symbol) -> слот
+exit_direction = array.array("d")   # +1 long / -1 short
+exit_best = array.array("d")        # лучшая цена с момента входа
+exit_stop = array.array("d")        # желаемый уровень стопа (0 – нет)
+exit_trail = array.array("d")       # дистанция трейлинга (доля), 0 – без трейлинга
+exit_be_trigger = array.array("d")  # цена, после которой стоп переносится в безубыток (0 – нет/выполнено)
+exit_be_price = array.array("d")    # цена безубыточности
+exit_partial_price = array.array("d")  # цена частичной фиксации (0 – нет/выполнена)
+exit_lock = threading.Lock()
+pending_amends = {}             # (account, symbol) -> новый уровень стопа
+last_amend_at = {}              # (account.name, symbol) -> monotonic-время последней перестановки
+exit_partials = queue.Queue()
+
+def register_exit(account, symbol, entry_data):
+    trail_perc = float(entry_data.get("trail_perc", 0))
+    breakeven_perc = float(entry_data.get("breakeven_perc", 0))
+    partial_tp_perc = float(entry_data.get("partial_tp_perc", 0))
+    if entry_data.get("partial_tp_done") or not float(entry_data.get("partial_tp_size", 0)):
+        partial_tp_perc = 0
+    if not (trail_perc or breakeven_perc or partial_tp_perc):
+        return
+    direction = 1.0 if entry_data.get("signal") == "long" else -1.0
+    entry_price = float(entry_data.get("entry_price", 0))
+    be_price = float(entry_data.get("break_even_price") or entry_price)
+    if not entry_price or not be_price:
+        return
+    row = (
+        direction,
+        float(entry_data.get("best_price") or entry_price),
+        float(entry_data.get("stop_price") or 0),
+        trail_perc / 100,
+        be_price * (1 + direction * breakeven_perc / 100) if breakeven_perc and not entry_data.get("breakeven_done") else 0.0,
+        be_price,
+        be_price * (1 + direction * partial_tp_perc / 100) if partial_tp_perc else 0.0,
+    )
+    columns = (exit_direction, exit_best, exit_stop, exit_trail, exit_be_trigger, exit_be_price, exit_partial_price)
+    with exit_lock:
+        slot = exit_slots.get((account.name, symbol))
+        if slot is None:
+            slot = exit_slots[(account.name, symbol)] = len(exit_keys)
+            exit_keys.append((account, symbol))
+            exit_symbols.append(symbol)
+            for column, value in zip(columns, row):
+                column.append(value)
+        else:
+            for column, value in zip(columns, row):
+                column[slot] = value
+    logging.info(f"🎯 {symbol}: движок выходов включён (трейлинг {trail_perc}%, безубыток {breakeven_perc}%, частичная фиксация {partial_tp_perc}%).")
+
+def remove_exit(account, symbol):
+    columns = (exit_direction, exit_best, exit_stop, exit_trail, exit_be_trigger, exit_be_price, exit_partial_price)
+    with exit_lock:
+        slot = exit_slots.pop((account.name, symbol), None)
+        pending_amends.pop((account, symbol), None)
+        if slot is None:
+            return
+        # Удаление перестановкой последнего слота на место освободившегося
+        last = len(exit_keys) - 1
+        if slot != last:
+            exit_keys[slot] = exit_keys[last]
+            exit_symbols[slot] = exit_symbols[last]
+            for column in columns:
+                column[slot] = column[last]
+            moved_account, moved_symbol = exit_keys[slot]
+            exit_slots[(moved_account.name, moved_symbol)] = slot
+        exit_keys.pop()
+        exit_symbols.pop()
+        for column in columns:
+            column.pop()
+
+def evaluate_exits(prices):
+    # Один проход по всем позициям; prices – symbol -> марк-цена из текущего тика
+    if not exit_keys:
+        return
+    with exit_lock:
+        for i, symbol in enumerate(exit_symbols):
+            price = prices.get(symbol)
+            if price is None:
+                continue
+            d = exit_direction[i]
+            if d * (price - exit_best[i]) > 0:
+                exit_best[i] = price
+            stop = exit_stop[i]
+            if exit_trail[i]:
+                candidate = exit_best[i] * (1 - d * exit_trail[i])
+                if not stop or d * (candidate - stop) > 0:
+                    stop = candidate
+            if exit_be_trigger[i] and d * (price - exit_be_trigger[i]) >= 0:
+                exit_be_trigger[i] = 0.0
+                if not stop or d * (exit_be_price[i] - stop) > 0:
+                    stop = exit_be_price[i]
+            if stop != exit_stop[i]:
+                exit_stop[i] = stop
+                pending_amends[exit_keys[i]] = (stop, exit_best[i])
+            if exit_partial_price[i] and d * (price - exit_partial_price[i]) >= 0:
+                exit_partial_price[i] = 0.0
+                exit_partials.put(exit_keys[i])
+
+def _requeue_amend(account, symbol, stop_price, best_price):
+    # Неудавшаяся перестановка повторяется, пока позиция в движке (exit_stop уже сдвинут)
+    with exit_lock:
+        if (account.name, symbol) in exit_slots:
+            pending_amends.setdefault((account, symbol), (stop_price, best_price))
+
+def _stop_alert(symbol, entry_data, message):
+    # Оповещение о проблеме со стопом – один раз, а не на каждом повторе
+    if entry_data.get("stop_alerted"):
+        return
+    entry_data["stop_alerted"] = True
+    send_telegram_message(f"{account_label()}{message}")
+
+def _close_through_stop(symbol, entry_data, stop_price):
+    # Цена уже за уровнем стопа: стоп-ордер сработал бы сразу, закрываем позицию рыночным reduceOnly
+    account = current_account()
+    with account_state_lock:
+        pos = account.positions.get(symbol) or {}
+    quantity = abs(float(pos.get("positionAmt", 0))) or float(entry_data.get("quantity", 0))
+    try:
+        order = account.client.futures_create_order(
+            symbol=symbol,
+            side="SELL" if entry_data.get("signal") == "long" else "BUY",
+            type="MARKET",
+            quantity=quantity,
+            reduceOnly=True,
+            newClientOrderId=f"{EXIT_STOP_PREFIX}{symbol}_{int(time.time() * 1000)}"
+        )
+    except Exception as e:
+        logging.error(f"❌ Ошибка рыночного закрытия {symbol} за уровнем стопа {stop_price}: {e}")
+        _stop_alert(symbol, entry_data, f"❌ {symbol}: цена прошла стоп {stop_price}, закрыть позицию не удалось, повторяем.")
+        _requeue_amend(account, symbol, stop_price, entry_data.get("best_price"))
+        return
+    # Дальше позицию закроет событие исполнения, движку выходов она больше не нужна
+    remove_exit(account, symbol)
+    send_telegram_message(f"{account_label()}🛑 {symbol}: цена прошла стоп {stop_price}, позиция закрывается по рынку.")
+    log_event(logging.INFO, "🛑 Закрытие за уровнем стопа", symbol=symbol, order_id=order.get("orderId"), payload=order)
+
+def _amend_stop(symbol, stop_price, best_price):
+    account = current_account()
+    entry_data = account.positions_entry_data.get(symbol)
+    if not entry_data:
+        return
+    stop_price = round_price(symbol, stop_price)
+    entry_data["best_price"] = best_price
+    if stop_price == entry_data.get("stop_price") and entry_data.get("stop_order_id"):
+        return
+    side = "SELL" if entry_data.get("signal") == "long" else "BUY"
+    direction = 1 if entry_data.get("signal") == "long" else -1
+    price = get_cached_price(symbol)
+    if price is not None and direction * (price - stop_price) <= 0:
+        # Новый стоп был бы отклонён как сработавший – не снимаем старый, а закрываем по рынку
+        _close_through_stop(symbol, entry_data, stop_price)
+        return
+    # Binance допускает один closePosition-стоп на сторону, поэтому сначала отменяем старый
+    if entry_data.get("stop_order_id"):
+        try:
+            account.client.futures_cancel_order(symbol=symbol, algoId=entry_data["stop_order_id"])
+        except BinanceAPIException as e:
+            # -2011 – стопа на бирже уже нет, можно сразу ставить новый
+            if e.code != -2011:
+                logging.error(f"❌ Не удалось отменить стоп {symbol} для перестановки: {e}")
+                _requeue_amend(account, symbol, stop_price, best_price)
+                return
+        except Exception as e:
+            logging.error(f"❌ Не удалось отменить стоп {symbol} для перестановки: {e}")
+            _requeue_amend(account, symbol, stop_price, best_price)
+            return
+        entry_data["stop_order_id"] = None
+    try:
+        order = account.client.futures_create_order(
+            symbol=symbol,
+            side=side,
+            type="STOP_MARKET",
+            stopPrice=stop_price,
+            closePosition=True,
+            timeInForce="GTC"
+        )
+    except Exception as e:
+        logging.error(f"❌ Ошибка перестановки стопа {symbol} на {stop_price}: {e}")
+        # Старый стоп уже снят: если цена за новым уровнем, позиция без защиты – закрываем по рынку
+        try:
+            price = get_last_price(symbol)
+        except Exception as price_error:
+            logging.error(f"❌ Ошибка получения цены {symbol}: {price_error}")
+            price = None
+        if price is not None and direction * (price - stop_price) <= 0:
+            _close_through_stop(symbol, entry_data, stop_price)
+            return
+        _stop_alert(symbol, entry_data, f"❌ {symbol}: не удалось выставить стоп {stop_price}, позиция без стопа, повторяем.")
+        _requeue_amend(account, symbol, stop_price, best_price)
+        return
+    entry_data["stop_order_id"] = order.get("algoId", order.get("orderId"))
+    entry_data["stop_price"] = stop_price
+    entry_data.pop("stop_alerted", None)
+    be_price = float(entry_data.get("break_even_price") or entry_data.get("entry_price", 0))
+    if entry_data.get("breakeven_perc") and direction * (stop_price - round_price(symbol, be_price)) >= 0:
+        # Стоп в безубытке – после перезапуска register_exit не взводит перенос заново
+        entry_data["breakeven_done"] = True
+    persist_position(symbol, entry_data)
+    logging.info(f"🎯 Стоп {symbol} переставлен на {stop_price}.")
+
+def _take_partial_profit(symbol):
+    account = current_account()
+    entry_data = account.positions_entry_data.get(symbol)
+    if not entry_data or entry_data.get("partial_tp_done"):
+        return
+    quantity = round_quantity(symbol, float(entry_data["quantity"]) * float(entry_data.get("partial_tp_size", 0)))
+    if quantity <= 0:
+        return
+    try:
+        order = account.client.futures_create_order(
+            symbol=symbol,
+            side="SELL" if entry_data.get("signal") == "long" else "BUY",
+            type="MARKET",
+            quantity=quantity,
+            reduceOnly=True,
+            newClientOrderId=f"{EXIT_PARTIAL_PREFIX}{symbol}_{int(time.time() * 1000)}"
+        )
+    except Exception as e:
+        logging.error(f"❌ Ошибка частичной фиксации {symbol}: {e}")
+        return
+    entry_data["partial_tp_done"] = True
+    entry_data["quantity"] = round_quantity(symbol, float(entry_data["quantity"]) - quantity)
+    persist_position(symbol, entry_data)
+    send_telegram_message(f"{account_label()}💰 {symbol}: зафиксирована часть позиции {quantity} ({entry_data.get('partial_tp_perc')}%).")
+    log_event(logging.INFO, "💰 Частичная фиксация", symbol=symbol, order_id=order.get("orderId"), payload=order)
+
+def exit_engine_worker():
+    while True:
+        try:
+            account, symbol = exit_partials.get(timeout=0.25)
+            order_executor.submit(run_for_account, account, _take_partial_profit, symbol)
+        except queue.Empty:
+            pass
+        now = time.monotonic()
+        with exit_lock:
+            due = [(key, value) for key, value in pending_amends.items()
+                   if now - last_amend_at.get((key[0].name, key[1]), 0) >= EXIT_AMEND_INTERVAL]
+            for key, _ in due:
+                pending_amends.pop(key)
+                last_amend_at[(key[0].name, key[1])] = now
+        for (account, symbol), (stop_price, best_price) in due:
+            order_executor.submit(run_for_account, account, _amend_stop, symbol, stop_price, best_price)
+
+# --------------------------
+# Функция закрытия всех открытых позиций с использованием reduceOnly=True (на всех аккаунтах)
 def close_all_positions():
     logging.info("Начинается закрытие всех открытых позиций.")
+    if len(accounts) == 1:
+        _close_account_positions()
+        return
+    for future in [account_executor.submit(run_for_account, account, _close_account_positions) for account in accounts]:
+        future.result()
+
+def _close_account_positions():
+    account = current_account()
     try:
-        positions = binance_client.futures_position_information()
+        positions = account.client.futures_position_information()
     except Exception as e:
-        logging.error(f"❌ Ошибка получения позиций: {e}")
+        logging.error(f"❌ Ошибка получения позиций {account.name}: {e}")
         return
 
+    close_orders = [
+        {
+            "symbol": pos.get("symbol"),
+            "side": "SELL" if float(pos.get("positionAmt", 0)) > 0 else "BUY",
+            "type": "MARKET",
+            "quantity": abs(float(pos.get("positionAmt", 0))),
+            "reduceOnly": True
+        }
+        for pos in positions if abs(float(pos.get("positionAmt", 0))) > 0
+    ]
     closed_symbols = []
-    for pos in positions:
-        amt = float(pos.get("positionAmt", 0))
-        if abs(amt) > 0:
-            symbol = pos.get("symbol")
-            try:
-                order = binance_client.futures_create_order(
-                    symbol=symbol,
-                    side="SELL" if amt > 0 else "BUY",
-                    type="MARKET",
-                    quantity=abs(amt),
-                    reduceOnly=True
-                )
-                logging.info(f"✅ Позиция {symbol} закрыта: {order}")
-                closed_symbols.append(symbol)
-            except Exception as e:
-                logging.error(f"❌ Ошибка закрытия позиции для {symbol}: {e}")
+    failed_symbols = []
+    for result in place_orders(close_orders):
+        symbol = result["params"]["symbol"]
+        if result["error"]:
+            logging.error(f"❌ Ошибка закрытия позиции для {symbol}: {result['error']}")
+            failed_symbols.append(symbol)
+        else:
+            log_event(logging.INFO, "✅ Позиция закрыта", symbol=symbol, order_id=result["order"].get("orderId"), payload=result["order"])
+            closed_symbols.append(symbol)
+    if failed_symbols:
+        send_telegram_message(f"{account_label()}❌ Не удалось закрыть позиции по: {', '.join(failed_symbols)}")
     if closed_symbols:
-        send_telegram_message(f"🚫 Закрыты позиции по: {', '.join(closed_symbols)}")
-    else:
-        send_telegram_message("ℹ️ Нет открытых позиций для закрытия.")
+        send_telegram_message(f"{account_label()}🚫 Закрыты позиции по: {', '.join(closed_symbols)}")
+    elif not failed_symbols:
+        send_telegram_message(f"{account_label()}ℹ️ Нет открытых позиций для закрытия.")
 
 # --------------------------
 # Функция переключения позиции (switch_position)
@@ -120,6 +1928,7 @@ def switch_position(new_signal, symbol, leverage, quantity):
     закрываем текущую позицию и открываем новую с задержками для корректной установки TP/SL.
     Если позиция с тем же направлением уже открыта, сигнал игнорируется.
     """
+    account = current_account()
     current_position = get_position(symbol)
     if current_position:
         current_amt = abs(float(current_position.get("positionAmt", 0)))
@@ -129,77 +1938,115 @@ def switch_position(new_signal, symbol, leverage, quantity):
                 logging.info(f"Текущая позиция {current_direction.upper()} отличается от сигнала {new_signal.upper()}, переключаем позицию.")
                 # Закрываем текущую позицию (в режиме переключения не вызываем общий close_all_positions, чтобы не сработали TP/SL ордера)
                 try:
-                    order = binance_client.futures_create_order(
+                    order = account.client.futures_create_order(
                         symbol=symbol,
                         side="SELL" if current_direction=="long" else "BUY",
                         type="MARKET",
                         quantity=current_amt,
                         reduceOnly=True
                     )
-                    logging.info(f"✅ Позиция {symbol} закрыта для переключения: {order}")
+                    log_event(logging.INFO, "✅ Позиция закрыта для переключения", symbol=symbol, order_id=order.get("orderId"), payload=order)
                 except Exception as e:
                     err_msg = f"❌ Ошибка закрытия позиции для переключения {symbol}: {e}"
                     logging.error(err_msg)
                     return {"status": "error", "message": err_msg}
-                time.sleep(1)  # Задержка для обновления данных
+                # Ждём подтверждения исполнения закрывающего ордера
+                wait_for_fill(symbol, order)
             else:
-                msg = f"⚠️ Позиция уже открыта с направлением {current_direction.upper()}, сигнал {new_signal.upper()} игнорируется."
+                msg = f"{account_label()}⚠️ Позиция уже открыта с направлением {current_direction.upper()}, сигнал {new_signal.upper()} игнорируется."
                 logging.info(msg)
                 send_telegram_message(msg)
                 return {"status": "skipped", "message": "Position already open."}
     try:
-        leverage_resp = binance_client.futures_change_leverage(symbol=symbol, leverage=leverage)
-        logging.info(f"✅ Установлено плечо {leverage} для {symbol}: {leverage_resp}")
+        leverage_resp = account.client.futures_change_leverage(symbol=symbol, leverage=leverage)
+        account.symbol_leverage[symbol] = leverage
+        log_event(logging.INFO, f"✅ Установлено плечо {leverage}", symbol=symbol, payload=leverage_resp)
     except Exception as e:
         err_msg = f"❌ Ошибка установки плеча для {symbol}: {e}"
         logging.error(err_msg)
         return {"status": "error", "message": err_msg}
     side = "BUY" if new_signal == "long" else "SELL"
     try:
-        order = binance_client.futures_create_order(
+        order = account.client.futures_create_order(
             symbol=symbol,
             side=side,
             type="MARKET",
             quantity=quantity
         )
-        logging.info(f"✅ Ордер создан: {order}")
+        log_event(logging.INFO, "✅ Ордер создан", symbol=symbol, order_id=order.get("orderId"), payload=order)
     except Exception as e:
         err_msg = f"❌ Ошибка создания ордера для {symbol}: {e}"
         logging.error(err_msg)
         return {"status": "error", "message": err_msg}
-    # Добавляем задержку для корректной установки TP/SL после открытия новой позиции
-    time.sleep(2)
-    return {"status": "ok", "message": f"Opened {new_signal.upper()} position on {symbol}."}
+    # Ждём исполнения ордера для корректной установки TP/SL после открытия новой позиции
+    fill = wait_for_fill(symbol, order)
+    return {"status": "ok", "message": f"Opened {new_signal.upper()} position on {symbol}.", "order": order, "fill": fill}
 
 # --------------------------
 # Обработка закрытия позиции через Binance User Data Stream
 def handle_user_data(msg):
+    with timed(f"user_stream:{msg.get('e')}"):
+        _handle_user_data(msg)
+
+def _order_fill_totals(symbol, order_id, quantity):
+    totals = get_order_totals(symbol, order_id) or {}
+    if totals.get("qty", 0.0) + 1e-12 < quantity:
+        # Часть исполнений не пришла через стрим – догружаем только недостающие трейды
+        backfill_trade_ledger(symbol, order_id)
+        totals = get_order_totals(symbol, order_id) or {}
+    return totals
+
+def _record_partial_close(symbol, order):
+    account = current_account()
+    entry_data = account.positions_entry_data.get(symbol)
+    if entry_data is None or order.get('i') in entry_data.get("partial_order_ids", []):
+        return
+    totals = _order_fill_totals(symbol, order.get('i'), float(order.get('z', order.get('q', 0))))
+    entry_data["partial_pnl"] = entry_data.get("partial_pnl", 0.0) + totals.get("realized_pnl", float(order.get('rp', 0)))
+    entry_data["partial_commission"] = entry_data.get("partial_commission", 0.0) + totals.get("commission", 0.0)
+    entry_data.setdefault("partial_order_ids", []).append(order.get('i'))
+    persist_position(symbol, entry_data)
+
+def _handle_user_data(msg):
+    account = current_account()
+    update_account_state(msg)
     if msg.get('e') != 'ORDER_TRADE_UPDATE':
         return
     order = msg.get('o', {})
+    record_trade_event(order)
+    track_order_update(order)
+    side = 1 if order.get('S') == "BUY" else -1
+    if order.get('x') == "NEW":
+        journal_write(JOURNAL_ORDER, order.get('s', ''), side, order.get('i'), float(order.get('q', 0)),
+                      float(order.get('p', 0)) or float(order.get('sp', 0)), ts=msg.get('E'))
+    elif order.get('x') == "TRADE":
+        journal_write(JOURNAL_FILL, order.get('s', ''), side, order.get('i'), float(order.get('l', 0)), float(order.get('L', 0)),
+                      float(order.get('n', 0)), float(order.get('rp', 0)), ts=msg.get('E'))
     symbol = order.get('s', '')
-    if symbol not in positions_entry_data:
+    if symbol not in account.positions_entry_data:
+        return
+    if order.get('c', '').startswith(EXIT_PARTIAL_PREFIX):
+        # Частичная фиксация движком выходов не закрывает сделку: её PnL и комиссия копятся в данных входа
+        if order.get('X') == 'FILLED':
+            _record_partial_close(symbol, order)
+        return
+    if order.get('c', '').startswith(TARGET_ORDER_PREFIX):
+        # Ордер ребалансировки – данные входа обновляет rebalance_to_targets
         return
 
     if order.get('X') == 'FILLED' and order.get('ps', '') == 'BOTH':
-        time.sleep(2)  # время для обновления истории трейдов
         exit_price = float(order.get('avgPrice', order.get('ap', 0)))
-        quantity = float(order.get('q', 0))
-        pnl = float(order.get('rp', 0))
+        quantity = float(order.get('z', order.get('q', 0)))
         
-        commission_exit = 0.0
-        try:
-            trades = binance_client.futures_account_trades(symbol=symbol)
-            if trades:
-                last_trade = trades[-1]
-                commission_exit = float(last_trade.get('commission', 0))
-                logging.info("Последний трейд для закрытия: " + str(last_trade))
-            else:
-                logging.info("Трейдов для закрывающего ордера не найдено.")
-        except Exception as e:
-            logging.error(f"❌ Ошибка получения трейдов для закрывающей сделки: {e}")
+        # PnL и комиссия закрытия – суммы по всем исполнениям ордера из журнала трейдов
+        totals = _order_fill_totals(symbol, order.get('i'), quantity)
+        entry_data = account.positions_entry_data.pop(symbol, {})
+        # плюс частичные фиксации этой сделки
+        pnl = totals.get("realized_pnl", float(order.get('rp', 0))) + entry_data.get("partial_pnl", 0.0)
+        commission_exit = totals.get("commission", 0.0) + entry_data.get("partial_commission", 0.0)
         
-        entry_data = positions_entry_data.pop(symbol, {})
+        persist_position(symbol, None)
+        remove_exit(account, symbol)
         entry_price = entry_data.get("entry_price", 0)
         leverage = entry_data.get("leverage", 1)
         commission_entry = entry_data.get("commission_entry", 0)
@@ -208,9 +2055,10 @@ def handle_user_data(msg):
         sl_perc = entry_data.get("sl_perc", 0)
         signal = entry_data.get("signal", "N/A")
         
-        total_commission = commission_entry + commission_exit
-        net_pnl = pnl - total_commission
-        net_break_even = break_even_price + total_commission
+        summary = close_summary(pnl, commission_entry, commission_exit, break_even_price)
+        total_commission = summary["total_commission"]
+        net_pnl = summary["net_pnl"]
+        net_break_even = summary["net_break_even"]
         direction = "LONG" if order.get('S', '') == "SELL" else "SHORT"
         
         if tp_perc != 0 and sl_perc != 0:
@@ -226,15 +2074,18 @@ def handle_user_data(msg):
         closing_method = "MANUAL"
         if order.get("ot") == "TAKE_PROFIT_MARKET":
             closing_method = "TP"
-        elif order.get("ot") == "STOP_MARKET":
+        elif order.get("ot") == "STOP_MARKET" or order.get('c', '').startswith(EXIT_STOP_PREFIX):
             closing_method = "SL"
         
+        journal_write(JOURNAL_CLOSE, symbol, 1 if direction == "LONG" else -1, order.get('i'), quantity, exit_price,
+                      total_commission, pnl, net_pnl, method=closing_method, ts=msg.get('E'))
+
         balance = get_futures_balance()
         balance_message = f"\nFutures баланс: USDT {balance}" if balance is not None else ""
         
         result_indicator = "🟩" if net_pnl > 0 else "🟥"
         message = (
-            f"{result_indicator} Сделка закрыта!\n"
+            f"{account_label()}{result_indicator} Сделка закрыта!\n"
             f"Символ: {symbol}\n"
             f"Направление: {direction}\n"
             f"Количество: {quantity}\n"
@@ -252,141 +2103,536 @@ def handle_user_data(msg):
             f"{balance_message}"
         )
         send_telegram_message(message)
-        logging.info("DEBUG: Telegram сообщение о закрытии отправлено:")
-        logging.info(message)
+        log_event(logging.INFO, "🏁 Сделка закрыта", symbol=symbol, order_id=order.get('i'), method=closing_method,
+                  pnl=pnl, net_pnl=net_pnl, quantity=quantity, exit_price=exit_price)
+        logging.debug("DEBUG: Telegram сообщение о закрытии отправлено:\n%s", message)
         
-        try:
-            binance_client.futures_cancel_all_open_orders(symbol=symbol)
-            logging.info(f"🧹 Висячие ордера для {symbol} отменены.")
-        except Exception as e:
-            logging.error(f"❌ Ошибка отмены висячих ордеров для {symbol}: {e}")
+        # Условные TP/SL живут на algoOrder и снимаются отдельным запросом (conditional=True)
+        for kind in ({}, {"conditional": True}):
+            try:
+                account.client.futures_cancel_all_open_orders(symbol=symbol, **kind)
+                logging.info(f"🧹 Висячие ордера для {symbol} отменены.")
+            except Exception as e:
+                logging.error(f"❌ Ошибка отмены висячих ордеров для {symbol}: {e}")
 
 # --------------------------
 # Функция автоочистки ордеров (раз в 30 сек)
 def auto_cancel_worker():
+    account = current_account()
     while True:
         time.sleep(30)
         try:
-            open_orders = binance_client.futures_get_open_orders()
-            if open_orders:
-                for order in open_orders:
-                    symbol = order.get("symbol")
-                    pos = get_position(symbol)
-                    if pos is None or abs(float(pos.get("positionAmt", 0))) == 0:
-                        binance_client.futures_cancel_all_open_orders(symbol=symbol)
-                        logging.info(f"🧹 Автоочистка: Ордеры для {symbol} отменены, так как позиции нет.")
+            with account_state_lock:
+                order_symbols = {order.get("symbol") for order in account.open_orders.values()}
+            for symbol in order_symbols:
+                pos = get_position(symbol)
+                if pos is None or abs(float(pos.get("positionAmt", 0))) == 0:
+                    with api_priority(PRIORITY_LOW):
+                        account.client.futures_cancel_all_open_orders(symbol=symbol)
+                        account.client.futures_cancel_all_open_orders(symbol=symbol, conditional=True)
+                    log_sampled(("auto_cancel", account.name, symbol), logging.INFO, "🧹 Автоочистка: ордеры отменены, так как позиции нет", symbol=symbol)
         except Exception as e:
             logging.error(f"❌ Ошибка автоочистки ордеров: {e}")
 
 # --------------------------
-# Запуск потока Binance User Data Stream
-def start_userdata_stream():
-    global listen_key
-    twm = ThreadedWebsocketManager(api_key=BINANCE_API_KEY, api_secret=BINANCE_API_SECRET)
-    twm.start()
-    twm.start_futures_user_socket(callback=handle_user_data)
-    logging.info("📡 Binance User Data Stream запущен для отслеживания закрытия позиций.")
-    threading.Thread(target=auto_cancel_worker, daemon=True).start()
-    
-    listen_key = binance_client.futures_stream_get_listen_key()
-    
-    def keep_alive():
-        global listen_key
-        while True:
-            time.sleep(30 * 60)
+# Запуск потока Binance User Data Stream (по одному на аккаунт) и его супервизор.
+# Супервизор переподключает поток при ошибке сокета, событии listenKeyExpired, неудачном keepalive
+# или долгой тишине, за которой не подтвердился listenKey. После переподключения догружается только
+# пропущенное: трейды с момента последнего полученного события – по символам с позициями, данными
+# входа и открытыми ордерами; по затронутым ордерам и позициям – точечные запросы. Пропущенные
+# ордера прогоняются через handle_user_data, как если бы пришли из стрима, поэтому закрытия не теряются.
+USER_STREAM_KEEPALIVE_INTERVAL = 30 * 60
+USER_STREAM_CHECK_INTERVAL = float(os.getenv("USER_STREAM_CHECK_INTERVAL", 5))
+USER_STREAM_STALE_SECONDS = float(os.getenv("USER_STREAM_STALE_SECONDS", 300))
+USER_STREAM_RESYNC_SLACK_MS = 1000  # запас на расхождение часов при запросе трейдов по времени
+
+def _on_user_stream_message(account, msg):
+    if msg.get("e") == "error":
+        logging.error(f"❌ Ошибка User Data Stream ({account.name}): {msg.get('type')} {msg.get('m')}")
+        account.stream_broken.set()
+        return
+    if msg.get("e") == "listenKeyExpired":
+        logging.warning(f"⚠️ ListenKey ({account.name}) истёк.")
+        account.stream_broken.set()
+        return
+    account.stream_seen_at = time.monotonic()
+    account.stream_last_event_ms = max(account.stream_last_event_ms, msg.get("E", 0))
+    with account.user_data_lock:
+        run_for_account(account, handle_user_data, msg)
+
+def _open_user_socket(account):
+    account.listen_key = account.client.futures_stream_get_listen_key()
+    account.user_socket = account.user_twm.start_futures_user_socket(callback=lambda msg: _on_user_stream_message(account, msg))
+    account.stream_seen_at = time.monotonic()
+
+def _order_event_from_rest(order, trades):
+    # Ордер из REST в формате поля "o" события ORDER_TRADE_UPDATE
+    executed_qty = float(order.get("executedQty", 0))
+    return {
+        "s": order["symbol"],
+        "i": order["orderId"],
+        "c": order.get("clientOrderId", ""),
+        "S": order.get("side"),
+        "o": order.get("type"),
+        "ot": order.get("origType", order.get("type")),
+        "x": "TRADE" if trades else order.get("status"),
+        "X": order.get("status"),
+        "q": order.get("origQty", "0"),
+        "p": order.get("price", "0"),
+        "sp": order.get("stopPrice", "0"),
+        "ap": order.get("avgPrice", "0"),
+        "z": executed_qty,
+        "l": sum(float(t.get("qty", 0)) for t in trades),
+        "L": order.get("avgPrice", "0"),
+        "n": sum(float(t.get("commission", 0)) for t in trades),
+        "rp": sum(float(t.get("realizedPnl", 0)) for t in trades),
+        "t": max((int(t["id"]) for t in trades), default=0),
+        "ps": order.get("positionSide", "BOTH"),
+    }
+
+def resync_user_stream_gap(since_ms):
+    # Догрузка пропущенного с момента since_ms; возвращает счётчики пропущенных событий
+    account = current_account()
+    with account_state_lock:
+        symbols = set(account.positions_entry_data)
+        symbols.update(order.get("symbol") for order in account.open_orders.values())
+        symbols.update(s for s, p in account.positions.items() if float(p.get("positionAmt", 0)))
+    missed = {"trades": 0, "orders": 0, "positions": 0}
+    for symbol in sorted(s for s in symbols if s):
+        try:
+            trades = account.client.futures_account_trades(symbol=symbol, startTime=since_ms - USER_STREAM_RESYNC_SLACK_MS)
+        except Exception as e:
+            logging.error(f"❌ Ошибка догрузки трейдов {symbol} после переподключения: {e}")
+            continue
+        with trade_ledger_lock:
+            seen = account.trade_ledger.get(symbol, {}).get("seen", {})
+            new_trades = [t for t in trades if int(t["id"]) not in seen]
+        if not new_trades:
+            continue
+        missed["trades"] += len(new_trades)
+        _record_rest_trades(symbol, new_trades)
+        by_order = collections.defaultdict(list)
+        for t in new_trades:
+            by_order[t["orderId"]].append(t)
+        for order_id, order_trades in by_order.items():
             try:
-                binance_client.futures_stream_keepalive(listenKey=listen_key)
-                logging.info("✅ ListenKey keepalive выполнен успешно.")
+                order = account.client.futures_get_order(symbol=symbol, orderId=order_id)
             except Exception as e:
-                logging.error(f"❌ Ошибка keepalive: {e}")
-                try:
-                    listen_key = binance_client.futures_stream_get_listen_key()
-                    logging.info("✅ ListenKey обновлен.")
-                except Exception as ex:
-                    logging.error(f"❌ Ошибка обновления listenKey: {ex}")
-    threading.Thread(target=keep_alive, daemon=True).start()
+                logging.error(f"❌ Ошибка получения пропущенного ордера {order_id} ({symbol}): {e}")
+                continue
+            missed["orders"] += 1
+            handle_user_data({"e": "ORDER_TRADE_UPDATE", "E": order.get("updateTime", 0), "o": _order_event_from_rest(order, order_trades)})
+        before = (account.positions.get(symbol) or {}).get("positionAmt")
+        pos = get_position(symbol, fresh=True)
+        if float((pos or {}).get("positionAmt") or 0) != float(before or 0):
+            missed["positions"] += 1
+    if missed["trades"]:
+        # Баланс кошелька тоже мог измениться – одна выборка вместо полной сверки
+        try:
+            with account_state_lock:
+                for b in account.client.futures_account_balance():
+                    account.balances[b["asset"]] = b
+        except Exception as e:
+            logging.error(f"❌ Ошибка обновления баланса после переподключения: {e}")
+    return missed
+
+def _recover_user_stream(account, reason):
+    started_at = time.monotonic()
+    since_ms = account.stream_last_event_ms
+    logging.warning(f"🔌 Переподключение User Data Stream ({account.name}): {reason}")
+    inc_counter("bot_user_stream_reconnects_total", account=account.name, reason=reason)
+    account.stream_broken.clear()
+    if account.user_socket:
+        account.user_twm.stop_socket(account.user_socket)
+    opened_ms = int(time.time() * 1000)
+    try:
+        _open_user_socket(account)
+    except Exception as e:
+        logging.error(f"❌ Ошибка переподключения User Data Stream ({account.name}): {e}")
+        time.sleep(USER_STREAM_CHECK_INTERVAL)
+        account.stream_broken.set()
+        return
+    with account.user_data_lock, use_account(account):
+        missed = resync_user_stream_gap(since_ms)
+        label = account_label()
+    # Всё, что старше открытия нового сокета, уже догружено
+    account.stream_last_event_ms = max(account.stream_last_event_ms, opened_ms)
+    recovery = time.monotonic() - started_at
+    record_stage("user_stream_recovery", recovery)
+    for kind, count in missed.items():
+        inc_counter("bot_user_stream_missed_events_total", count, account=account.name, kind=kind)
+    message = (f"{label}🔌 User Data Stream восстановлен за {recovery:.1f} сек ({reason}).\n"
+               f"Пропущено: трейдов {missed['trades']}, ордеров {missed['orders']}, изменений позиций {missed['positions']}.")
+    logging.info(message)
+    if any(missed.values()):
+        send_telegram_message(message)
+
+def user_stream_supervisor(account):
+    keepalive_at = time.monotonic() + USER_STREAM_KEEPALIVE_INTERVAL
+    while True:
+        if account.stream_broken.wait(USER_STREAM_CHECK_INTERVAL):
+            _recover_user_stream(account, "ошибка потока")
+            continue
+        now = time.monotonic()
+        stale = now - account.stream_seen_at > USER_STREAM_STALE_SECONDS
+        if now < keepalive_at and not stale:
+            continue
+        # Тишина в стриме – норма для спокойного аккаунта, поэтому проверяем listenKey, а не рвём соединение сразу
+        try:
+            account.client.futures_stream_keepalive(listenKey=account.listen_key)
+            log_sampled(("keepalive", account.name), logging.INFO, f"✅ ListenKey keepalive ({account.name}) выполнен успешно.")
+            keepalive_at = now + USER_STREAM_KEEPALIVE_INTERVAL
+            account.stream_seen_at = now
+        except Exception as e:
+            logging.error(f"❌ Ошибка keepalive ({account.name}): {e}")
+            _recover_user_stream(account, "listenKey недействителен")
+
+def start_userdata_stream(account):
+    account.user_twm = ThreadedWebsocketManager(api_key=account.api_key, api_secret=account.api_secret)
+    account.user_twm.start()
+    account.stream_last_event_ms = int(time.time() * 1000)
+    _open_user_socket(account)
+    logging.info(f"📡 Binance User Data Stream запущен для аккаунта {account.name}.")
+    with use_account(account):
+        reconcile_account_state()
+        reconcile_entry_data()
+    threading.Thread(target=run_for_account, args=(account, account_reconcile_worker), daemon=True).start()
+    threading.Thread(target=run_for_account, args=(account, auto_cancel_worker), daemon=True).start()
+    threading.Thread(target=user_stream_supervisor, args=(account,), daemon=True).start()
 
 # --------------------------
-# Функция опроса Telegram для управления ботом (команды /pause, /resume, /close_orders, /close_orders_pause_trading, /balance, /active_trade)
+# Управление ботом через Telegram (команды /pause, /resume, /close_orders, /close_orders_pause_trading, /balance, /active_trade, /latency, /stats).
+# Обновления приходят long polling'ом getUpdates либо, если задан TELEGRAM_WEBHOOK_URL, через вебхук /telegram.
+# Команды регистрируются в таблице telegram_commands; быстрые выполняются сразу в потоке приёма,
+# долгие (массовое закрытие, запросы к бирже) – в отдельном пуле, чтобы /pause срабатывал мгновенно.
+TELEGRAM_POLL_TIMEOUT = int(os.getenv("TELEGRAM_POLL_TIMEOUT", 25))
+TELEGRAM_COMMAND_WORKERS = int(os.getenv("TELEGRAM_COMMAND_WORKERS", 4))
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL")  # публичный адрес бота, например https://bot.example.com
+# Секрет для заголовка X-Telegram-Bot-Api-Secret-Token; по умолчанию выводится из токена бота
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET") or hashlib.sha256(TELEGRAM_TOKEN.encode()).hexdigest()[:32]
+telegram_commands = {}  # команда -> (обработчик, выполнять ли в потоке приёма)
+command_executor = ThreadPoolExecutor(max_workers=TELEGRAM_COMMAND_WORKERS, thread_name_prefix="commands")
+# Отдельная сессия: long polling не должен попадать в метрики отправки сообщений
+telegram_poll_session = requests.Session()
+
+def telegram_command(name, inline=False):
+    def register(func):
+        telegram_commands[name] = (func, inline)
+        return func
+    return register
+
+def _run_command(name, func):
+    try:
+        with timed(f"command:{name}"):
+            func()
+    except Exception as e:
+        logging.error(f"❌ Ошибка выполнения команды {name}: {e}")
+
+def dispatch_telegram_update(update):
+    message = update.get("message")
+    if not message:
+        return
+    text = message.get("text", "").strip().lower()
+    if not text.startswith("/"):
+        return
+    # "/pause@my_bot args" -> "/pause"
+    name = text.split()[0].split("@")[0]
+    command = telegram_commands.get(name)
+    if command is None:
+        return
+    func, inline = command
+    if inline:
+        _run_command(name, func)
+    else:
+        command_executor.submit(_run_command, name, func)
+
+@telegram_command("/pause", inline=True)
+def _cmd_pause():
+    set_trading_enabled(False)
+    send_telegram_message("🚫 Бот приостановлен. Сигналы с TradingView игнорируются.")
+    logging.info("Получена команда /pause. Торговля отключена.")
+
+@telegram_command("/resume", inline=True)
+def _cmd_resume():
+    set_trading_enabled(True)
+    send_telegram_message("✅ Бот возобновил работу. Сигналы с TradingView принимаются.")
+    logging.info("Получена команда /resume. Торговля включена.")
+
+@telegram_command("/close_orders")
+def _cmd_close_orders():
+    close_all_positions()
+
+@telegram_command("/close_orders_pause_trading", inline=True)
+def _cmd_close_orders_pause_trading():
+    # Сначала останавливаем приём сигналов, затем закрываем позиции в фоне
+    set_trading_enabled(False)
+    logging.info("Получена команда /close_orders_pause_trading. Торговля отключена, закрываем позиции.")
+
+    def close_and_report():
+        close_all_positions()
+        send_telegram_message("🚫 Все позиции закрыты и торговля приостановлена.")
+    command_executor.submit(_run_command, "/close_orders_pause_trading", close_and_report)
+
+@telegram_command("/stats", inline=True)
+def _cmd_stats():
+    send_telegram_message(format_stats_report())
+
+@telegram_command("/latency", inline=True)
+def _cmd_latency():
+    send_telegram_message(format_latency_report())
+
+@telegram_command("/balance")
+def _cmd_balance():
+    for account in accounts:
+        with use_account(account):
+            balance = get_futures_balance()
+            if balance is not None:
+                send_telegram_message(f"{account_label()}💰 Текущий Futures баланс: USDT {balance}")
+            else:
+                send_telegram_message(f"{account_label()}❌ Не удалось получить баланс.")
+
+@telegram_command("/active_trade")
+def _cmd_active_trade():
+    active_trades = [(account, sym, info) for account in accounts for sym, info in list(account.positions_entry_data.items())]
+    if not active_trades:
+        send_telegram_message("ℹ️ Нет открытых позиций.")
+        return
+    for account, sym, info in active_trades:
+        label = f"[{account.name}] " if len(accounts) > 1 else ""
+        active_signal = info.get("signal", "N/A")
+        if info.get("tp_perc", 0) != 0 and info.get("sl_perc", 0) != 0:
+            if active_signal.lower() == "long":
+                tp_level = info["break_even_price"] * (1 + info["tp_perc"]/100)
+                sl_level = info["break_even_price"] * (1 - info["sl_perc"]/100)
+            else:
+                tp_level = info["break_even_price"] * (1 - info["tp_perc"]/100)
+                sl_level = info["break_even_price"] * (1 + info["sl_perc"]/100)
+            tp_sl_message = f"\nTP: {round_price(sym, tp_level)} ({info['tp_perc']}%)\nSL: {round_price(sym, sl_level)} ({info['sl_perc']}%)"
+        else:
+            tp_sl_message = ""
+        live_message = ""
+        mark_price = get_mark_price(sym)
+        entry_price = info.get("entry_price") or 0
+        if mark_price is not None and entry_price:
+            direction = 1 if active_signal.lower() == "long" else -1
+            unrealized_pnl = (mark_price - entry_price) * float(info.get("quantity", 0)) * direction
+            live_message = f"\nМарк-цена: {mark_price}\nНереализованный PnL: {round(unrealized_pnl, 4)}"
+            liq_price = info.get("liq_price") or 0
+            if liq_price:
+                live_message += f"\nДо ликвидации: {abs(mark_price - liq_price) / mark_price * 100:.2f}%"
+        active_message = (
+            f"{label}🚀 Активная сделка:\n"
+            f"Символ: {sym}\n"
+            f"Направление: {active_signal.upper()}\n"
+            f"Количество: {info.get('quantity', 'N/A')}\n"
+            f"Цена входа: {info.get('entry_price', 'N/A')}\n"
+            f"Плечо: {info.get('leverage', 'N/A')}\n"
+            f"Использованная маржа: {info.get('used_margin', 'N/A')}\n"
+            f"Цена ликвидации: {info.get('liq_price', 'N/A')}\n"
+            f"Комиссия входа: {info.get('commission_entry', 'N/A')}\n"
+            f"Цена безубыточности: {info.get('break_even_price', 'N/A')}"
+            f"{live_message}"
+            f"{tp_sl_message}"
+        )
+        send_telegram_message(active_message)
+
 def poll_telegram_commands():
-    global trading_enabled
+    # getUpdates не работает, пока у бота установлен вебхук
+    try:
+        telegram_poll_session.post(f"{TELEGRAM_API_URL}/deleteWebhook", timeout=10)
+    except Exception as e:
+        logging.error(f"❌ Ошибка удаления вебхука Telegram: {e}")
     offset = None
     while True:
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getUpdates"
-        params = {}
+        # Telegram держит запрос до TELEGRAM_POLL_TIMEOUT секунд и отвечает сразу при новой команде
+        params = {"timeout": TELEGRAM_POLL_TIMEOUT, "allowed_updates": json.dumps(["message"])}
         if offset:
             params["offset"] = offset
         try:
-            response = requests.get(url, params=params, timeout=30)
+            response = telegram_poll_session.get(f"{TELEGRAM_API_URL}/getUpdates", params=params, timeout=TELEGRAM_POLL_TIMEOUT + 10)
             data = response.json()
-            if data.get("ok") and data.get("result"):
-                for update in data["result"]:
-                    offset = update["update_id"] + 1
-                    message = update.get("message")
-                    if not message:
-                        continue
-                    text = message.get("text", "").strip().lower()
-                    if text == "/pause":
-                        trading_enabled = False
-                        send_telegram_message("🚫 Бот приостановлен. Сигналы с TradingView игнорируются.")
-                        logging.info("Получена команда /pause. Торговля отключена.")
-                    elif text == "/resume":
-                        trading_enabled = True
-                        send_telegram_message("✅ Бот возобновил работу. Сигналы с TradingView принимаются.")
-                        logging.info("Получена команда /resume. Торговля включена.")
-                    elif text == "/close_orders":
-                        close_all_positions()
-                    elif text == "/close_orders_pause_trading":
-                        close_all_positions()
-                        trading_enabled = False
-                        send_telegram_message("🚫 Все позиции закрыты и торговля приостановлена.")
-                        logging.info("Получена команда /close_orders_pause_trading. Позиции закрыты, торговля отключена.")
-                    elif text == "/balance":
-                        balance = get_futures_balance()
-                        if balance is not None:
-                            send_telegram_message(f"💰 Текущий Futures баланс: USDT {balance}")
-                        else:
-                            send_telegram_message("❌ Не удалось получить баланс.")
-                    elif text == "/active_trade":
-                        if len(positions_entry_data) == 0:
-                            send_telegram_message("ℹ️ Нет открытых позиций.")
-                        else:
-                            for sym, info in positions_entry_data.items():
-                                active_signal = info.get("signal", "N/A")
-                                if info.get("tp_perc", 0) != 0 and info.get("sl_perc", 0) != 0:
-                                    if active_signal.lower() == "long":
-                                        tp_level = info["break_even_price"] * (1 + info["tp_perc"]/100)
-                                        sl_level = info["break_even_price"] * (1 - info["sl_perc"]/100)
-                                    else:
-                                        tp_level = info["break_even_price"] * (1 - info["tp_perc"]/100)
-                                        sl_level = info["break_even_price"] * (1 + info["sl_perc"]/100)
-                                    tp_sl_message = f"\nTP: {round(tp_level,2)} ({info['tp_perc']}%)\nSL: {round(sl_level,2)} ({info['sl_perc']}%)"
-                                else:
-                                    tp_sl_message = ""
-                                active_message = (
-                                    f"🚀 Активная сделка:\n"
-                                    f"Символ: {sym}\n"
-                                    f"Направление: {active_signal.upper()}\n"
-                                    f"Количество: {info.get('quantity', 'N/A')}\n"
-                                    f"Цена входа: {info.get('entry_price', 'N/A')}\n"
-                                    f"Плечо: {info.get('leverage', 'N/A')}\n"
-                                    f"Использованная маржа: {info.get('used_margin', 'N/A')}\n"
-                                    f"Цена ликвидации: {info.get('liq_price', 'N/A')}\n"
-                                    f"Комиссия входа: {info.get('commission_entry', 'N/A')}\n"
-                                    f"Цена безубыточности: {info.get('break_even_price', 'N/A')}"
-                                    f"{tp_sl_message}"
-                                )
-                                send_telegram_message(active_message)
+            if not data.get("ok"):
+                logging.error(f"❌ Ошибка getUpdates: {data}")
+                time.sleep(2)
+                continue
+            for update in data["result"]:
+                offset = update["update_id"] + 1
+                dispatch_telegram_update(update)
         except Exception as e:
             logging.error(f"❌ Ошибка при опросе Telegram: {e}")
-        time.sleep(2)
+            time.sleep(2)
+
+def set_telegram_webhook():
+    try:
+        response = telegram_poll_session.post(f"{TELEGRAM_API_URL}/setWebhook", data={
+            "url": f"{TELEGRAM_WEBHOOK_URL.rstrip('/')}/telegram",
+            "secret_token": TELEGRAM_WEBHOOK_SECRET,
+            "allowed_updates": json.dumps(["message"]),
+        }, timeout=10)
+        logging.info(f"✅ Вебхук Telegram установлен: {response.json()}")
+    except Exception as e:
+        logging.error(f"❌ Ошибка установки вебхука Telegram: {e}")
+
+@app.route("/telegram", methods=["POST"])
+def telegram_webhook():
+    if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != TELEGRAM_WEBHOOK_SECRET:
+        return "Forbidden", 403
+    update = request.get_json(silent=True) or {}
+    if state_backend is not None:
+        # Команды выполняет лидер – у него торговое состояние
+        state_backend.push({"kind": "telegram", "update": update})
+    else:
+        dispatch_telegram_update(update)
+    return "OK", 200
+
+# --------------------------
+# Асинхронная обработка сигналов.
+# Вебхук только валидирует сигнал и кладёт его в очередь; исполнение идёт в пуле воркеров,
+# шардированном по символу: сигналы одного символа выполняются строго по порядку,
+# разные символы – параллельно. Число шардов SIGNAL_WORKERS задаётся вместе с account_executor.
+SIGNAL_QUEUE_SIZE = int(os.getenv("SIGNAL_QUEUE_SIZE", 100))
+signal_queues = [queue.Queue(maxsize=SIGNAL_QUEUE_SIZE) for _ in range(SIGNAL_WORKERS)]
+
+def _signal_shard(symbol):
+    return zlib.crc32(symbol.encode()) % SIGNAL_WORKERS
+
+# Блокировки по символам: сигнал из шарда и ребалансировка /targets не работают с одним символом одновременно
+symbol_locks = collections.defaultdict(threading.Lock)
+symbol_locks_guard = threading.Lock()
+
+@contextlib.contextmanager
+def hold_symbols(symbols):
+    # Захват в отсортированном порядке – без взаимных блокировок между пакетами
+    with symbol_locks_guard:
+        locks = [symbol_locks[symbol] for symbol in sorted(set(symbols))]
+    with contextlib.ExitStack() as stack:
+        for lock in locks:
+            stack.enter_context(lock)
+        yield
+
+def enqueue_signal(symbol, data):
+    try:
+        signal_queues[_signal_shard(symbol)].put_nowait((time.monotonic(), symbol, data))
+        return True
+    except queue.Full:
+        logging.error(f"❌ Очередь сигналов для {symbol} переполнена, сигнал отброшен.")
+        return False
+
+def signal_worker(shard):
+    q = signal_queues[shard]
+    while True:
+        enqueued_at, symbol, data = q.get()
+        started_at = time.monotonic()
+        record_stage("queue_wait", started_at - enqueued_at)
+        try:
+            if not trading_enabled:
+                logging.info("⚠️ Торговля отключена. Сигнал из очереди игнорируется.")
+                continue
+            with hold_symbols([symbol]):
+                result = process_signal(data)
+            log_event(logging.INFO, "Результат обработки сигнала", symbol=data.get("symbol"), payload=result)
+        except Exception as e:
+            logging.error(f"❌ Ошибка обработки сигнала {data}: {e}")
+        finally:
+            record_stage("execute", time.monotonic() - started_at)
+            q.task_done()
+
+def start_signal_workers():
+    for shard in range(SIGNAL_WORKERS):
+        threading.Thread(target=signal_worker, args=(shard,), daemon=True).start()
+
+# --------------------------
+# Защита от повторов и дребезга сигналов TradingView.
+# Ключ идемпотентности – alert_id из payload либо хэш (symbol, signal, time); повтор в
+# окне SIGNAL_DEDUP_WINDOW отбрасывается за O(1) до любых обращений к бирже. Сигналы без
+# alert_id и времени бара не дедуплицируются: по одним symbol+signal нельзя отличить повтор
+# от настоящей серии long→short→long.
+# При SIGNAL_DEBOUNCE_SECONDS > 0 сигналы по символу копятся это время и исполняется только последний.
+SIGNAL_DEDUP_WINDOW = float(os.getenv("SIGNAL_DEDUP_WINDOW", 60))
+SIGNAL_DEDUP_MAX = 10000
+SIGNAL_DEBOUNCE_SECONDS = float(os.getenv("SIGNAL_DEBOUNCE_SECONDS", 0))
+seen_signals = collections.OrderedDict()  # ключ -> время получения (monotonic)
+pending_signals = {}  # symbol -> последний сигнал, ожидающий окончания debounce
+signal_filter_lock = threading.Lock()
+# Журнал принятых сигналов для replay.py: JSON Lines {"ts": мс, "payload": тело вебхука}
+SIGNAL_LOG_PATH = os.getenv("SIGNAL_LOG_PATH")
+signal_log = open(SIGNAL_LOG_PATH, "a", encoding="utf-8") if SIGNAL_LOG_PATH else None
+signal_log_lock = threading.Lock()
+
+def _signal_key(symbol, data):
+    # None – идентифицировать сигнал не по чему
+    alert_id = data.get("alert_id") or data.get("id")
+    if alert_id:
+        return f"id:{alert_id}"
+    bar_time = data.get("time", data.get("bar_time"))
+    if bar_time in (None, ""):
+        return None
+    raw = f"{symbol}|{str(data.get('signal')).lower()}|{bar_time}"
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+def is_duplicate_signal(symbol, data, now=None):
+    # now – для прогона записанных сигналов (replay.py), по умолчанию текущее время
+    key = _signal_key(symbol, data)
+    if key is None:
+        return False
+    if state_backend is not None and now is None:
+        return not state_backend.claim_key(key, SIGNAL_DEDUP_WINDOW)
+    now = time.monotonic() if now is None else now
+    with signal_filter_lock:
+        # Записи упорядочены по времени – достаточно срезать устаревшие с начала
+        while seen_signals:
+            seen_at = next(iter(seen_signals.values()))
+            if now - seen_at <= SIGNAL_DEDUP_WINDOW and len(seen_signals) < SIGNAL_DEDUP_MAX:
+                break
+            seen_signals.popitem(last=False)
+        if key in seen_signals:
+            return True
+        seen_signals[key] = now
+        return False
+
+def record_signal(data):
+    if signal_log is None:
+        return
+    line = json.dumps({"ts": int(time.time() * 1000), "payload": data}, ensure_ascii=False)
+    with signal_log_lock:
+        signal_log.write(line + "\n")
+        signal_log.flush()
+
+def _flush_debounced_signal(symbol):
+    with signal_filter_lock:
+        data = pending_signals.pop(symbol, None)
+    if data is not None:
+        enqueue_signal(symbol, data)
+
+def submit_signal(symbol, data):
+    journal_write(JOURNAL_SIGNAL, symbol, 1 if data.get("signal") == "long" else -1, qty=float(data.get("quantity", DEFAULT_QUANTITY)))
+    if SIGNAL_DEBOUNCE_SECONDS <= 0:
+        return enqueue_signal(symbol, data)
+    with signal_filter_lock:
+        replaced = pending_signals.get(symbol)
+        pending_signals[symbol] = data
+    if replaced is not None:
+        logging.info(f"⏱ Сигнал {replaced.get('signal')} для {symbol} заменён более поздним {data.get('signal')}.")
+    else:
+        timer = threading.Timer(SIGNAL_DEBOUNCE_SECONDS, _flush_debounced_signal, args=(symbol,))
+        timer.daemon = True
+        timer.start()
+    return True
+
+# Состояние очередей и задержки по этапам (в миллисекундах)
+@app.route("/queues", methods=["GET"])
+def queues_status():
+    return {"queue_depth": [q.qsize() for q in signal_queues], "stages": latency_summary()}, 200
 
 # --------------------------
 # Вебхук для открытия позиции
 @app.route("/webhook", methods=["POST"])
 def webhook():
-    global trading_enabled
-    if not trading_enabled:
+    with timed("webhook:http"):
+        return _webhook()
+
+def _webhook():
+    if not is_trading_enabled():
         logging.info("⚠️ Торговля отключена. Сигналы игнорируются.")
         return {"status": "skipped", "message": "Trading is disabled."}, 200
 
@@ -396,86 +2642,115 @@ def webhook():
         logging.error(f"❌ Ошибка парсинга JSON: {e}")
         return {"status": "error", "message": "JSON parse error"}, 400
 
-    logging.debug(f"DEBUG: Получен JSON: {data}")
+    logging.debug("DEBUG: Получен JSON: %s", data)
     if not data or "signal" not in data:
         logging.error("❌ Нет поля 'signal' в полученных данных")
         return {"status": "error", "message": "No signal provided"}, 400
 
+    signal = str(data["signal"]).lower()
+    if signal not in ("long", "short"):
+        logging.error(f"❌ Неизвестный сигнал: {signal}")
+        return {"status": "error", "message": f"Unknown signal: {signal}"}, 400
+    try:
+        int(data.get("leverage", DEFAULT_LEVERAGE))
+        float(data.get("quantity", DEFAULT_QUANTITY))
+        float(data.get("tp_perc", 0))
+        float(data.get("sl_perc", 0))
+        for field in ("trail_perc", "breakeven_perc", "partial_tp_perc", "partial_tp_size"):
+            float(data.get(field, 0))
+    except (TypeError, ValueError) as e:
+        logging.error(f"❌ Некорректные параметры сигнала: {e}")
+        return {"status": "error", "message": "Invalid leverage/quantity/tp_perc/sl_perc/exit parameters"}, 400
+
+    symbol_fixed = data.get("symbol", "N/A").split('.')[0]
+    record_signal(data)
+    if is_duplicate_signal(symbol_fixed, data):
+        logging.info(f"♻️ Повторный сигнал {signal} для {symbol_fixed} отброшен.")
+        return {"status": "duplicate", "signal": signal, "symbol": symbol_fixed}, 200
+    if state_backend is not None:
+        # Исполняет лидер
+        state_backend.push({"kind": "signal", "symbol": symbol_fixed, "data": data})
+    elif not submit_signal(symbol_fixed, data):
+        return {"status": "error", "message": "Signal queue is full"}, 503
+    return {"status": "queued", "signal": signal, "symbol": symbol_fixed}, 202
+
+# Полный цикл сделки по сигналу (выполняется в воркере)
+# Исполнение сигнала: на одном аккаунте – в текущем потоке, на нескольких – параллельно,
+# чтобы входы по всем аккаунтам расходились по времени минимально
+def process_signal(data):
+    if len(accounts) == 1:
+        return execute_signal(data)
+    futures = {account.name: account_executor.submit(run_for_account, account, execute_signal, data) for account in accounts}
+    results = {}
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            logging.error(f"❌ Ошибка исполнения сигнала на аккаунте {name}: {e}")
+            results[name] = {"status": "error", "message": str(e)}
+    filled_at = [r["filled_at"] for r in results.values() if r.get("filled_at") is not None]
+    if len(filled_at) > 1:
+        spread = max(filled_at) - min(filled_at)
+        record_stage("fanout_spread", spread)
+        logging.info(f"⏱ Разброс входов по аккаунтам: {spread * 1000:.1f} мс")
+    statuses = {r.get("status") for r in results.values()}
+    return {"status": statuses.pop() if len(statuses) == 1 else "partial", "accounts": results}
+
+def execute_signal(data):
+    account = current_account()
     signal = data["signal"].lower()
     symbol_received = data.get("symbol", "N/A")
     symbol_fixed = symbol_received.split('.')[0]
 
-    # Динамические параметры: leverage и quantity (если не переданы, используются значения по умолчанию)
-    leverage = int(data.get("leverage", 20))
-    quantity = float(data.get("quantity", 0.02))
+    # Динамические параметры: leverage и quantity (если не переданы, используются значения по умолчанию),
+    # с учётом настроек аккаунта
+    leverage, quantity = account.size_signal(int(data.get("leverage", DEFAULT_LEVERAGE)), float(data.get("quantity", DEFAULT_QUANTITY)))
+    # После множителя аккаунта количество может не попадать в шаг LOT_SIZE
+    quantity = round_quantity(symbol_fixed, quantity)
+    if quantity <= 0:
+        msg = f"{account_label()}⚠️ Количество для {symbol_fixed} после округления по шагу лота равно 0. Сигнал {signal.upper()} отклонён."
+        logging.warning(msg)
+        send_telegram_message(msg)
+        return {"status": "rejected", "message": "Quantity rounds to zero."}
 
-    logging.info(f"📥 Получен сигнал: {signal}")
-    logging.info(f"📥 Символ: {symbol_received} -> {symbol_fixed}")
-    logging.info(f"📥 Leverage: {leverage}, Quantity: {quantity}")
+    log_event(logging.INFO, f"📥 {account_label()}Получен сигнал", signal=signal, symbol=symbol_fixed,
+              symbol_received=symbol_received, leverage=leverage, quantity=quantity)
 
+    stage_started = time.monotonic()
     current_pos = get_position(symbol_fixed)
-    # Если позиция открыта, проверяем направление
-    if current_pos and abs(float(current_pos.get("positionAmt", 0))) > 0:
-        current_direction = "long" if float(current_pos.get("positionAmt", 0)) > 0 else "short"
-        if current_direction != signal:
-            # Если сигнал противоположный, переключаем позицию
-            result = switch_position(signal, symbol_fixed, leverage, quantity)
-            if result["status"] != "ok":
-                return result
-            # НЕ возвращаем результат сразу – продолжаем выполнение для установки TP/SL
-            logging.info(f"Позиция переключена. Продолжаем установку TP/SL для нового сигнала {signal.upper()}.")
-        else:
-            msg = f"⚠️ Позиция уже открыта с направлением {current_direction.upper()}. Сигнал {signal.upper()} игнорируется."
-            logging.info(msg)
-            send_telegram_message(msg)
-            return {"status": "skipped", "message": "Position already open."}
-    else:
-        # Если позиции нет, открываем новую через switch_position
-        result = switch_position(signal, symbol_fixed, leverage, quantity)
-        if result["status"] != "ok":
-            return result
-        # Продолжаем выполнение для установки TP/SL
+    action = signal_action(float(current_pos.get("positionAmt", 0)) if current_pos else 0.0, signal)
+    if action == "skip":
+        msg = f"{account_label()}⚠️ Позиция уже открыта с направлением {signal.upper()}. Сигнал {signal.upper()} игнорируется."
+        logging.info(msg)
+        send_telegram_message(msg)
+        return {"status": "skipped", "message": "Position already open."}
+    # Размер входа доводится до MIN_NOTIONAL до риск-контроля, чтобы проверялся ровно отправляемый ордер
+    last_price = get_last_price(symbol_fixed)
+    quantity = size_entry_quantity(symbol_fixed, quantity, last_price)
+    leverage, quantity, risk_reasons = check_pre_trade_risk(account, symbol_fixed, leverage, quantity, price=last_price)
+    if risk_reasons:
+        rejected = quantity == 0
+        inc_counter("bot_risk_decisions_total", result="rejected" if rejected else "resized")
+        msg = (f"{account_label()}🛡 Риск-контроль {'отклонил' if rejected else 'уменьшил'} сигнал {signal.upper()} {symbol_fixed}"
+               f"{'' if rejected else f' (плечо {leverage}, количество {quantity})'}:\n" + "\n".join(risk_reasons))
+        logging.warning(msg)
+        send_telegram_message(msg)
+        if rejected:
+            return {"status": "rejected", "message": "Pre-trade risk check failed.", "reasons": risk_reasons}
+    # Нет позиции – открываем, противоположная – переключаем; в обоих случаях через switch_position,
+    # который и отправляет единственный входной ордер
+    result = switch_position(signal, symbol_fixed, leverage, quantity)
+    if result["status"] != "ok":
+        return result
+    if action == "switch":
+        # НЕ возвращаем результат сразу – продолжаем выполнение для установки TP/SL
+        logging.info(f"Позиция переключена. Продолжаем установку TP/SL для нового сигнала {signal.upper()}.")
+    record_stage("switch_position", time.monotonic() - stage_started)
 
     # Дальнейшая логика установки TP/SL и отправки сообщения об открытии позиции
-    ticker = binance_client.futures_symbol_ticker(symbol=symbol_fixed)
-    last_price = float(ticker["price"])
-
-    exchange_info = binance_client.futures_exchange_info()
-    symbol_info = next((s for s in exchange_info["symbols"] if s["symbol"] == symbol_fixed), None)
-    if symbol_info:
-        min_notional = None
-        for f in symbol_info["filters"]:
-            if f.get("filterType") == "MIN_NOTIONAL" and "minNotional" in f:
-                min_notional = float(f["minNotional"])
-                break
-        if min_notional is None:
-            min_notional = 20.0  # если фильтр не найден, используем 20 USDT по умолчанию
-        quantity_precision = int(symbol_info.get("quantityPrecision", 3))
-        min_qty_required = min_notional / last_price
-        min_qty_required = round(min_qty_required, quantity_precision)
-        if quantity < min_qty_required:
-            logging.info(f"Количество {quantity} слишком мало, минимальное требуемое: {min_qty_required:.6f}. Автоматически устанавливаем минимальное количество.")
-            quantity = min_qty_required
-
-    side = "BUY" if signal == "long" else "SELL"
-
-    # Округляем quantity до заданного количества знаков (например, 3 для ETHUSDT)
-    quantity = round(quantity, 3)
-
-    try:
-        order = binance_client.futures_create_order(
-            symbol=symbol_fixed,
-            side=side,
-            type="MARKET",
-            quantity=quantity
-        )
-        logging.info(f"✅ Ордер создан: {order}")
-    except Exception as e:
-        logging.error(f"❌ Ошибка создания ордера для {symbol_fixed}: {e}")
-        return {"status": "error", "message": f"Error creating order: {e}"}
-
-    time.sleep(0.5)
-    pos = get_position(symbol_fixed)
+    order, fill = result["order"], result["fill"]
+    filled_at = time.monotonic()
+    pos = get_position(symbol_fixed, fresh=True)
     if not pos:
         logging.error("❌ Не удалось получить информацию о позиции после ордера")
         return {"status": "error", "message": "Не удалось получить информацию о позиции"}
@@ -490,98 +2765,77 @@ def webhook():
         entry_price, used_margin, liq_price, break_even_price = 0, 0, 0, 0
 
     # Добавляем поддерживающую маржу (3x initial margin)
+    stage_started = time.monotonic()
     try:
         additional_margin = used_margin * 1
-        endpoint = "https://fapi.binance.com/fapi/v1/positionMargin"
-        timestamp = int(time.time() * 1000)
-        params = {
-            "symbol": symbol_fixed,
-            "amount": additional_margin,
-            "type": 1,
-            "timestamp": timestamp
-        }
-        import hmac, hashlib, urllib.parse
-        query_string = urllib.parse.urlencode(params)
-        signature = hmac.new(BINANCE_API_SECRET.encode(), query_string.encode(), hashlib.sha256).hexdigest()
-        params["signature"] = signature
-        headers = {"X-MBX-APIKEY": BINANCE_API_KEY}
-        response = requests.post(endpoint, headers=headers, params=params)
-        if response.status_code == 200:
-            logging.info(f"✅ Дополнительная маржа {additional_margin} добавлена для {symbol_fixed}: {response.json()}")
-        else:
-            logging.error(f"❌ Ошибка добавления маржи: {response.status_code} - {response.text}")
+        margin_resp = account.client.futures_change_position_margin(symbol=symbol_fixed, amount=additional_margin, type=1)
+        log_event(logging.INFO, f"✅ Дополнительная маржа {additional_margin} добавлена", symbol=symbol_fixed, payload=margin_resp)
+    except BinanceAPIException as e:
+        logging.error(f"❌ Ошибка добавления маржи: {e.status_code} - {e.message}")
     except Exception as e:
         logging.error(f"❌ Ошибка добавления дополнительной маржи: {e}")
+    record_stage("margin_topup", time.monotonic() - stage_started)
 
-    commission_entry = 0.0
-    try:
-        trades = binance_client.futures_account_trades(symbol=symbol_fixed)
-        for trade in reversed(trades):
-            if trade.get("orderId") == order.get("orderId"):
-                commission_entry = float(trade.get("commission", 0))
-                break
-    except Exception as e:
-        logging.error(f"❌ Ошибка получения комиссии: {e}")
+    commission_entry = fill["commission"] if fill else 0.0
 
     tp_perc = float(data.get("tp_perc", 0))
     sl_perc = float(data.get("sl_perc", 0))
     tp_sl_message = ""
+    sl_level = None
+    stop_order_id = None
     # Изменили условие: теперь, если хотя бы один из параметров не равен 0, выполняем расчет
     if tp_perc != 0 or sl_perc != 0:
-        if signal == "long":
-            tp_level = break_even_price * (1 + tp_perc/100) if tp_perc != 0 else None
-            sl_level = break_even_price * (1 - sl_perc/100) if sl_perc != 0 else None
-        else:
-            tp_level = break_even_price * (1 - tp_perc/100) if tp_perc != 0 else None
-            sl_level = break_even_price * (1 + sl_perc/100) if sl_perc != 0 else None
+        stage_started = time.monotonic()
+        tp_level, sl_level = protective_levels(signal, break_even_price, tp_perc, sl_perc)
         
-        # Создаем ордер TP, если tp_level определен
-        try:
-            if tp_level is not None:
-                tp_order = binance_client.futures_create_order(
-                    symbol=symbol_fixed,
-                    side="SELL" if signal=="long" else "BUY",
-                    type="TAKE_PROFIT_MARKET",
-                    stopPrice=round(tp_level, 2),
-                    closePosition=True,
-                    timeInForce="GTC"
-                )
-                logging.info(f"✅ TP ордер установлен для {symbol_fixed}: {tp_order}")
-            else:
-                logging.info("TP не указан, ордер не создается.")
-        except Exception as e:
-            logging.error(f"❌ Ошибка установки TP ордера для {symbol_fixed}: {e}")
-        
-        # Создаем ордер SL, если sl_level определен
-        try:
-            if sl_level is not None:
-                sl_order = binance_client.futures_create_order(
-                    symbol=symbol_fixed,
-                    side="SELL" if signal=="long" else "BUY",
-                    type="STOP_MARKET",
-                    stopPrice=round(sl_level, 2),
-                    closePosition=True,
-                    timeInForce="GTC"
-                )
-                logging.info(f"✅ SL ордер установлен для {symbol_fixed}: {sl_order}")
+        # TP и SL отправляются параллельно одним заходом
+        protective_orders = []
+        if tp_level is not None:
+            protective_orders.append({
+                "symbol": symbol_fixed,
+                "side": "SELL" if signal=="long" else "BUY",
+                "type": "TAKE_PROFIT_MARKET",
+                "stopPrice": round_price(symbol_fixed, tp_level),
+                "closePosition": True,
+                "timeInForce": "GTC"
+            })
+        else:
+            logging.info("TP не указан, ордер не создается.")
+        if sl_level is not None:
+            protective_orders.append({
+                "symbol": symbol_fixed,
+                "side": "SELL" if signal=="long" else "BUY",
+                "type": "STOP_MARKET",
+                "stopPrice": round_price(symbol_fixed, sl_level),
+                "closePosition": True,
+                "timeInForce": "GTC"
+            })
+        else:
+            logging.info("SL не указан, ордер не создается.")
+        for result in place_orders(protective_orders):
+            kind = "TP" if result["params"]["type"] == "TAKE_PROFIT_MARKET" else "SL"
+            if result["error"]:
+                logging.error(f"❌ Ошибка установки {kind} ордера для {symbol_fixed}: {result['error']}")
             else:
-                logging.info("SL не указан, ордер не создается.")
-        except Exception as e:
-            logging.error(f"❌ Ошибка установки SL ордера для {symbol_fixed}: {e}")
+                log_event(logging.INFO, f"✅ {kind} ордер установлен", symbol=symbol_fixed,
+                          order_id=result["order"].get("algoId", result["order"].get("orderId")), payload=result["order"])
+                if kind == "SL":
+                    stop_order_id = result["order"].get("algoId", result["order"].get("orderId"))
+        record_stage("tp_sl", time.monotonic() - stage_started)
         
         # Формирование строки уведомления
         if tp_level is not None:
-            tp_msg = f"TP: {round(tp_level,2)} ({tp_perc}%)"
+            tp_msg = f"TP: {round_price(symbol_fixed, tp_level)} ({tp_perc}%)"
         else:
             tp_msg = ""
         if sl_level is not None:
-            sl_msg = f"SL: {round(sl_level,2)} ({sl_perc}%)"
+            sl_msg = f"SL: {round_price(symbol_fixed, sl_level)} ({sl_perc}%)"
         else:
             sl_msg = ""
         tp_sl_message = f"\n{tp_msg}\n{sl_msg}"
 
     open_message = (
-        f"🚀 Сделка открыта!\n"
+        f"{account_label()}🚀 Сделка открыта!\n"
         f"Символ: {symbol_fixed}\n"
         f"Направление: {signal.upper()}\n"
         f"Количество: {quantity}\n"
@@ -593,11 +2847,15 @@ def webhook():
         f"Цена безубыточности: {break_even_price}"
         f"{tp_sl_message}"
     )
+    stage_started = time.monotonic()
     send_telegram_message(open_message)
-    logging.info("DEBUG: Telegram сообщение об открытии отправлено:")
-    logging.info(open_message)
+    record_stage("notify", time.monotonic() - stage_started)
+    log_event(logging.INFO, "🚀 Сделка открыта", symbol=symbol_fixed, order_id=order.get("orderId"), signal=signal,
+              quantity=quantity, entry_price=entry_price, leverage=leverage, liq_price=liq_price)
+    logging.debug("DEBUG: Telegram сообщение об открытии отправлено:\n%s", open_message)
 
-    positions_entry_data[symbol_fixed] = {
+    watch_symbol(symbol_fixed)
+    entry_data = account.positions_entry_data[symbol_fixed] = {
         "signal": signal,
         "entry_price": entry_price,
         "quantity": quantity,
@@ -607,13 +2865,314 @@ def webhook():
         "used_margin": used_margin,
         "liq_price": liq_price,
         "tp_perc": tp_perc,
-        "sl_perc": sl_perc
+        "sl_perc": sl_perc,
+        "stop_order_id": stop_order_id,
+        "stop_price": round_price(symbol_fixed, sl_level) if stop_order_id else 0,
+        "trail_perc": float(data.get("trail_perc", 0)),
+        "breakeven_perc": float(data.get("breakeven_perc", 0)),
+        "partial_tp_perc": float(data.get("partial_tp_perc", 0)),
+        "partial_tp_size": float(data.get("partial_tp_size", 0))
     }
+    persist_position(symbol_fixed, entry_data)
+    register_exit(account, symbol_fixed, entry_data)
+
+    return {"status": "ok", "signal": signal, "symbol": symbol_fixed, "filled_at": filled_at}
 
-    return {"status": "ok", "signal": signal, "symbol": symbol_fixed}
+# --------------------------
+# Ребалансировка по целевым позициям (/targets).
+# Стратегии портфеля присылают цели сразу по многим символам:
+# {"targets": [{"symbol", "side": "long"|"short"|"flat", "size", "leverage"}, ...]}.
+# Разница с текущими позициями из локального зеркала считается одним проходом по колонкам, символы,
+# уже стоящие на цели, пропускаются. Смена плеча, рыночные ордера (пакетами через place_orders),
+# ожидание исполнений и отмена старых TP/SL идут параллельными заходами, итог – один отчёт в ответе
+# и одно сообщение в Telegram. Ордера ребалансировки помечены префиксом clientOrderId, чтобы
+# handle_user_data не принимал их за закрытие сделки: данные входа и журнал закрытий обновляются здесь.
+TARGET_ORDER_PREFIX = "tgt_"
+TARGET_SIDES = {"long": 1.0, "short": -1.0, "flat": 0.0}
+
+def parse_targets(data):
+    # Проверка и нормализация вектора целей; ValueError – некорректный запрос
+    targets = data.get("targets") if isinstance(data, dict) else None
+    if not isinstance(targets, list) or not targets:
+        raise ValueError("No targets provided")
+    parsed = []
+    seen = set()
+    for t in targets:
+        side = str(t.get("side", "")).lower()
+        if side not in TARGET_SIDES:
+            raise ValueError(f"Unknown side: {side}")
+        symbol = str(t.get("symbol", "")).split('.')[0]
+        if not symbol or symbol in seen:
+            raise ValueError(f"Missing or duplicate symbol: {symbol}")
+        seen.add(symbol)
+        size = float(t.get("size", 0)) if side != "flat" else 0.0
+        if size < 0 or (side != "flat" and not size):
+            raise ValueError(f"Invalid size for {symbol}")
+        parsed.append({"symbol": symbol, "side": side, "size": size, "leverage": int(t.get("leverage", DEFAULT_LEVERAGE))})
+    return parsed
+
+def _plan_target_orders(account, targets, current, target, leverages, report):
+    # Ордер на символ: рыночный на разницу; уменьшение – reduceOnly, переворот – одним ордером через ноль
+    batch_id = int(time.time() * 1000)
+    plans = []
+    for i, t in enumerate(targets):
+        symbol, cur, tgt, leverage = t["symbol"], current[i], target[i], leverages[i]
+        if not round_quantity(symbol, abs(tgt - cur)):
+            report[symbol] = {"status": "on_target", "position": cur}
+            continue
+        flips = cur * tgt < 0
+        reduces = not flips and abs(tgt) < abs(cur)
+        reasons = []
+        if reduces:
+            quantity = round_quantity(symbol, abs(tgt - cur))
+        else:
+            try:
+                price = get_last_price(symbol)
+            except Exception as e:
+                report[symbol] = {"status": "error", "position": cur, "message": f"Error getting price: {e}"}
+                continue
+            opening = abs(tgt) if flips else abs(tgt) - abs(cur)
+            leverage, opening, reasons = check_pre_trade_risk(account, symbol, leverage, opening,
+                                                              adds_to_position=bool(cur) and not flips, price=price)
+            opening = round_quantity(symbol, opening)
+            filters = get_symbol_filters(symbol)
+            if opening and price and filters and opening * price < filters["min_notional"]:
+                reasons.append(f"вход {opening} ниже минимального номинала {filters['min_notional']} USDT")
+                opening = 0.0
+            if not opening:
+                report[symbol] = {"status": "rejected", "position": cur, "reasons": reasons}
+                continue
+            quantity = round_quantity(symbol, abs(cur) + opening) if flips else opening
+        params = {
+            "symbol": symbol,
+            "side": "BUY" if tgt > cur else "SELL",
+            "type": "MARKET",
+            "quantity": quantity,
+            "newClientOrderId": f"{TARGET_ORDER_PREFIX}{batch_id}_{i}",
+        }
+        if reduces:
+            params["reduceOnly"] = True
+        plans.append({"symbol": symbol, "from": cur, "target": tgt, "flips": flips, "reduces": reduces,
+                      "leverage": leverage, "params": params, "reasons": reasons})
+    return plans
+
+def _apply_target_fill(account, plan, fill, pos):
+    # Данные входа после исполнения ордера ребалансировки
+    symbol = plan["symbol"]
+    amount = float(pos.get("positionAmt", 0)) if pos else 0.0
+    previous = account.positions_entry_data.get(symbol)
+    commission = fill.get("commission", 0.0)
+    # При перевороте комиссия ордера делится по количеству: abs(from) – закрытие, остаток – новый вход
+    close_commission = commission * min(abs(plan["from"]) / plan["params"]["quantity"], 1.0) if plan["flips"] else commission
+    if previous and (plan["flips"] or not amount):
+        direction = 1 if previous.get("signal") == "long" else -1
+        # Частичные уменьшения этой сделки входят в итог закрытия
+        pnl = fill.get("realized_pnl", 0.0) + previous.get("partial_pnl", 0.0)
+        total_commission = close_commission + previous.get("partial_commission", 0.0) + previous.get("commission_entry", 0)
+        journal_write(JOURNAL_CLOSE, symbol, direction, plan["order_id"], abs(plan["from"]),
+                      fill.get("avg_price", 0.0), total_commission, pnl, pnl - total_commission, method="TARGET")
+        remove_exit(account, symbol)
+        previous = None
+    if not amount:
+        account.positions_entry_data.pop(symbol, None)
+        persist_position(symbol, None)
+        return
+    entry_data = dict(previous or {"tp_perc": 0, "sl_perc": 0, "commission_entry": 0.0})
+    entry_data.update({
+        "signal": "long" if amount > 0 else "short",
+        "entry_price": float(pos.get("entryPrice", 0)),
+        "quantity": abs(amount),
+        "leverage": entry_data.get("leverage", plan["leverage"]) if plan["reduces"] else plan["leverage"],
+        "break_even_price": float(pos.get("breakEvenPrice", 0)),
+        "used_margin": float(pos.get("initialMargin", 0)),
+        "liq_price": float(pos.get("liquidationPrice", 0)),
+    })
+    if plan["reduces"]:
+        # Уменьшение без закрытия: PnL и комиссия копятся до закрытия сделки, как у частичной фиксации
+        entry_data["partial_pnl"] = entry_data.get("partial_pnl", 0.0) + fill.get("realized_pnl", 0.0)
+        entry_data["partial_commission"] = entry_data.get("partial_commission", 0.0) + commission
+    else:
+        entry_data["commission_entry"] = entry_data.get("commission_entry", 0.0) + (commission - close_commission if plan["flips"] else commission)
+    account.positions_entry_data[symbol] = entry_data
+    persist_position(symbol, entry_data)
+    watch_symbol(symbol)
+    register_exit(account, symbol, entry_data)
+
+def rebalance_to_targets(targets):
+    account = current_account()
+    started_at = time.monotonic()
+    if not account.synced:
+        reconcile_account_state()
+    symbols = [t["symbol"] for t in targets]
+    sized = [account.size_signal(t["leverage"], t["size"]) for t in targets]
+    with account_state_lock:
+        current = array.array("d", (float((account.positions.get(s) or {}).get("positionAmt", 0)) for s in symbols))
+    target = array.array("d", (TARGET_SIDES[t["side"]] * quantity for t, (_, quantity) in zip(targets, sized)))
+    report = {}
+    plans = _plan_target_orders(account, targets, current, target, [leverage for leverage, _ in sized], report)
+
+    # Плечо меняется только там, где позиция открывается или растёт и плечо отличается от известного
+    leverage_changes = {
+        plan["symbol"]: order_executor.submit(account.client.futures_change_leverage, symbol=plan["symbol"], leverage=plan["leverage"])
+        for plan in plans
+        if not plan["reduces"] and account.symbol_leverage.get(plan["symbol"]) != plan["leverage"]
+    }
+    ready = []
+    for plan in plans:
+        future = leverage_changes.get(plan["symbol"])
+        if future is not None:
+            try:
+                future.result()
+                account.symbol_leverage[plan["symbol"]] = plan["leverage"]
+            except Exception as e:
+                report[plan["symbol"]] = {"status": "error", "position": plan["from"], "message": f"Error setting leverage: {e}"}
+                continue
+        ready.append(plan)
+
+    results = place_orders([plan["params"] for plan in ready])
+    fills = {}
+    for plan, result in zip(ready, results):
+        if result["error"]:
+            report[plan["symbol"]] = {"status": "error", "position": plan["from"], "message": result["error"]}
+            continue
+        plan["order_id"] = result["order"].get("orderId")
+        fills[plan["symbol"]] = result["order"]
+    executed = [plan for plan in ready if plan["symbol"] in fills]
+    # Исполнения приходят из стрима параллельно – ждём их событий с одним общим дедлайном
+    fills = dict(zip(fills, (fill or {} for fill in wait_for_fills(list(fills.items())))))
+
+    # Старые TP/SL с closePosition закрыли бы перевёрнутую позицию – снимаем их там, где направление сменилось
+    # Условные ордера живут на algoOrder и снимаются отдельным запросом (conditional=True)
+    cancels = [order_executor.submit(account.client.futures_cancel_all_open_orders, symbol=plan["symbol"], **kind)
+               for plan in executed if plan["flips"] or not plan["target"]
+               for kind in ({}, {"conditional": True})]
+    positions = None
+    if executed:
+        try:
+            info = account.client.futures_position_information()
+            positions = {p["symbol"]: p for p in info if p.get("positionSide", "BOTH") == "BOTH"}
+            with account_state_lock:
+                for plan in executed:
+                    # Position Information V3 не возвращает закрытые символы
+                    if plan["symbol"] in positions:
+                        account.positions[plan["symbol"]] = positions[plan["symbol"]]
+                    else:
+                        account.positions.pop(plan["symbol"], None)
+                    _update_exposure(account, plan["symbol"])
+        except Exception as e:
+            logging.error(f"❌ Ошибка обновления позиций после ребалансировки: {e}")
+    for future in cancels:
+        try:
+            future.result()
+        except Exception as e:
+            logging.error(f"❌ Ошибка отмены ордеров при ребалансировке: {e}")
+
+    for plan in executed:
+        symbol, fill = plan["symbol"], fills[plan["symbol"]]
+        pos = (positions or {}).get(symbol)
+        if positions is not None:
+            _apply_target_fill(account, plan, fill, pos)
+        report[symbol] = {
+            "status": "filled" if fill.get("status") == "FILLED" else (fill.get("status") or "unknown").lower(),
+            "position": plan["from"],
+            "target": plan["target"],
+            "new_position": float((pos or {}).get("positionAmt", 0)) if positions is not None else None,
+            "side": plan["params"]["side"],
+            "quantity": plan["params"]["quantity"],
+            "order_id": plan["order_id"],
+            "avg_price": fill.get("avg_price"),
+            "commission": fill.get("commission"),
+            "realized_pnl": fill.get("realized_pnl"),
+            "reasons": plan["reasons"],
+        }
+    record_stage("rebalance", time.monotonic() - started_at)
+
+    changed = [s for s in symbols if report.get(s, {}).get("status") != "on_target"]
+    if changed:
+        lines = []
+        for symbol in changed:
+            r = report[symbol]
+            if r["status"] == "filled":
+                lines.append(f"{symbol}: {r['position']} → {r['new_position']} ({r['side']} {r['quantity']} @ {r['avg_price']})")
+            else:
+                lines.append(f"{symbol}: {r['status']} {r.get('message') or '; '.join(r.get('reasons', []))}")
+        send_telegram_message(
+            f"{account_label()}🎯 Ребалансировка: {len(executed)} ордеров, на цели {len(symbols) - len(changed)} из {len(symbols)}, "
+            f"{time.monotonic() - started_at:.1f} сек\n" + "\n".join(lines)
+        )
+    errors = any(r["status"] in ("error", "rejected") for r in report.values())
+    return {"status": "partial" if errors else "ok", "orders": len(executed), "symbols": report}
+
+def process_targets(targets):
+    # Как process_signal: на нескольких аккаунтах ребалансировка идёт параллельно.
+    # Символы пакета заняты на всё время ребалансировки, сигналы по ним ждут в своих шардах
+    with hold_symbols(t["symbol"] for t in targets):
+        return _process_targets(targets)
+
+def _process_targets(targets):
+    if len(accounts) == 1:
+        return rebalance_to_targets(targets)
+    futures = {account.name: account_executor.submit(run_for_account, account, rebalance_to_targets, targets) for account in accounts}
+    results = {}
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            logging.error(f"❌ Ошибка ребалансировки на аккаунте {name}: {e}")
+            results[name] = {"status": "error", "message": str(e)}
+    statuses = {r.get("status") for r in results.values()}
+    return {"status": statuses.pop() if len(statuses) == 1 else "partial", "accounts": results}
+
+@app.route("/targets", methods=["POST"])
+def targets_webhook():
+    with timed("targets:http"):
+        return _targets()
+
+def _targets():
+    if not is_trading_enabled():
+        logging.info("⚠️ Торговля отключена. Цели позиций игнорируются.")
+        return {"status": "skipped", "message": "Trading is disabled."}, 200
+    try:
+        target_list = parse_targets(request.get_json(force=True))
+    except Exception as e:
+        logging.error(f"❌ Некорректный запрос целей позиций: {e}")
+        return {"status": "error", "message": str(e)}, 400
+    if state_backend is not None:
+        # Исполняет лидер, отчёт придёт в Telegram
+        state_backend.push({"kind": "targets", "targets": target_list})
+        return {"status": "queued", "targets": len(target_list)}, 202
+    return process_targets(target_list), 200
+
+# Фоновые сервисы и торговое состояние (в многопроцессном режиме – только у лидера)
+def start_services():
+    global trading_enabled
+    load_state()
+    if state_backend is not None:
+        trading_enabled = state_backend.get_value("trading_enabled", trading_enabled)
+        state_backend.set_value("trading_enabled", trading_enabled)
+    threading.Thread(target=state_writer_worker, daemon=True).start()
+    prewarm_connections()
+    threading.Thread(target=time_sync_worker, daemon=True).start()
+    refresh_symbol_filters()
+    threading.Thread(target=symbol_filters_worker, daemon=True).start()
+    start_signal_workers()
+    threading.Thread(target=telegram_sender_worker, daemon=True).start()
+    if TELEGRAM_WEBHOOK_URL:
+        set_telegram_webhook()
+    else:
+        threading.Thread(target=poll_telegram_commands, daemon=True).start()
+    for account in accounts:
+        for symbol, entry_data in account.positions_entry_data.items():
+            watch_symbol(symbol)
+            register_exit(account, symbol, entry_data)
+        threading.Thread(target=start_userdata_stream, args=(account,), daemon=True).start()
+    threading.Thread(target=start_market_data, daemon=True).start()
+    threading.Thread(target=exit_engine_worker, daemon=True).start()
 
 if __name__ == "__main__":
-    threading.Thread(target=poll_telegram_commands, daemon=True).start()
-    threading.Thread(target=start_userdata_stream, daemon=True).start()
+    if state_backend is not None:
+        start_worker()
+    else:
+        start_services()
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,289 @@
+# Прогон записанных сигналов TradingView по историческим свечам (бэктест без торговли).
+# Сигналы – JSON Lines из SIGNAL_LOG_PATH бота ({"ts": мс, "payload": тело /webhook}); строки без "ts"
+# берут время из поля "time" тела (мс или ISO 8601). Цены – CSV свечей Binance Futures
+# (klines или markPriceKlines с data.binance.vision), файлы <SYMBOL>*.csv в каталоге --klines.
+# Решения принимаются теми же функциями, что и в bot.py: дедупликация, signal_action,
+# size_entry_quantity (минимальный notional и LOT_SIZE из --exchange-info), protective_levels,
+# close_summary. Исполнение симулируется: вход и переворот – по open следующей свечи с проскальзыванием,
+# TP/SL/ликвидация – по high/low свечей (внутри свечи сначала неблагоприятный исход), комиссия taker.
+# Маржа – изолированная с доливкой, как в bot.py (positionMargin на размер начальной маржи).
+#
+# Пример: python replay.py signals.jsonl --klines data/ --exchange-info exchangeInfo.json --leverage 10 --trades trades.csv
+import argparse
+import array
+import bisect
+import csv
+import datetime
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+
+
+def parse_time(value):
+    if isinstance(value, (int, float)) or str(value).isdigit():
+        value = int(value)
+        return value // 1000 if value > 10 ** 14 else value
+    return int(datetime.datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp() * 1000)
+
+
+def load_signals(path):
+    signals = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            payload = record.get("payload", record)
+            ts = record.get("ts", payload.get("time"))
+            if ts is None:
+                continue
+            signals.append((parse_time(ts), payload))
+    signals.sort(key=lambda s: s[0])
+    return signals
+
+
+# --------------------------
+# Свечи символа в колонках array: время открытия и OHLC
+class Candles:
+    def __init__(self):
+        self.times = array.array("q")
+        self.open = array.array("d")
+        self.high = array.array("d")
+        self.low = array.array("d")
+        self.close = array.array("d")
+
+    def load_csv(self, path):
+        with open(path, newline="") as f:
+            for row in csv.reader(f):
+                if not row or not row[0].isdigit():
+                    continue  # заголовок
+                self.times.append(parse_time(row[0]))
+                self.open.append(float(row[1]))
+                self.high.append(float(row[2]))
+                self.low.append(float(row[3]))
+                self.close.append(float(row[4]))
+
+
+def load_candles(directory, symbols):
+    candles = {}
+    for symbol in symbols:
+        files = sorted(glob.glob(os.path.join(directory, f"{symbol}*.csv")))
+        if not files:
+            continue
+        c = candles[symbol] = Candles()
+        for path in files:
+            c.load_csv(path)
+    return candles
+
+
+# --------------------------
+# Симуляция сделок
+class Replay:
+    def __init__(self, bot, candles, args):
+        self.bot = bot
+        self.candles = candles
+        self.args = args
+        self.positions = {}  # symbol -> открытая позиция
+        self.trades = []
+        self.stats = {"signals": 0, "duplicates": 0, "skipped": 0, "no_data": 0, "liquidations": 0}
+
+    def fill_price(self, price, direction):
+        # Проскальзывание рыночного ордера – всегда против нас
+        return price * (1 + direction * self.args.slippage_bps / 10000)
+
+    def open_position(self, symbol, signal, data, index):
+        c = self.candles[symbol]
+        direction = 1 if signal == "long" else -1
+        fee = self.args.taker_fee
+        leverage = self.args.leverage or int(data.get("leverage", self.bot.DEFAULT_LEVERAGE))
+        quantity = self.args.quantity or float(data.get("quantity", self.bot.DEFAULT_QUANTITY))
+        quantity = self.bot.size_entry_quantity(symbol, quantity, c.open[index])
+        entry_price = self.fill_price(c.open[index], direction)
+        break_even_price = entry_price * (1 + direction * fee) / (1 - direction * fee)
+        margin_ratio = (1 + self.args.margin_topup) / leverage
+        tp_perc = self.args.tp_perc if self.args.tp_perc is not None else float(data.get("tp_perc", 0))
+        sl_perc = self.args.sl_perc if self.args.sl_perc is not None else float(data.get("sl_perc", 0))
+        tp_level, sl_level = self.bot.protective_levels(signal, break_even_price, tp_perc, sl_perc)
+        self.positions[symbol] = {
+            "direction": direction,
+            "signal": signal,
+            "quantity": quantity,
+            "entry_price": entry_price,
+            "entry_time": c.times[index],
+            "leverage": leverage,
+            "commission_entry": quantity * entry_price * fee,
+            "break_even_price": break_even_price,
+            "liq_price": entry_price * (1 - direction * (margin_ratio - self.args.mmr)),
+            "tp_level": tp_level,
+            "sl_level": sl_level,
+            "cursor": index - 1,  # последняя проверенная свеча; свеча входа целиком после входа
+        }
+
+    def close_position(self, symbol, exit_price, exit_time, method):
+        pos = self.positions.pop(symbol)
+        pnl = pos["direction"] * (exit_price - pos["entry_price"]) * pos["quantity"]
+        commission_exit = pos["quantity"] * exit_price * self.args.taker_fee
+        summary = self.bot.close_summary(pnl, pos["commission_entry"], commission_exit, pos["break_even_price"])
+        self.trades.append({
+            "symbol": symbol,
+            "direction": pos["signal"].upper(),
+            "entry_time": pos["entry_time"],
+            "exit_time": exit_time,
+            "quantity": pos["quantity"],
+            "entry_price": pos["entry_price"],
+            "exit_price": exit_price,
+            "leverage": pos["leverage"],
+            "commission_entry": pos["commission_entry"],
+            "commission_exit": commission_exit,
+            "total_commission": summary["total_commission"],
+            "pnl": pnl,
+            "net_pnl": summary["net_pnl"],
+            "break_even_price": pos["break_even_price"],
+            "net_break_even": summary["net_break_even"],
+            "method": method,
+        })
+
+    def advance(self, symbol, until_index):
+        # Проверяет ликвидацию, SL и TP открытой позиции на свечах после cursor до until_index (не включая)
+        pos = self.positions.get(symbol)
+        if pos is None:
+            return
+        c = self.candles[symbol]
+        d, liq, sl, tp = pos["direction"], pos["liq_price"], pos["sl_level"], pos["tp_level"]
+        for i in range(pos["cursor"] + 1, until_index):
+            adverse = c.low[i] if d > 0 else c.high[i]
+            favorable = c.high[i] if d > 0 else c.low[i]
+            if d * (adverse - liq) <= 0:
+                self.stats["liquidations"] += 1
+                self.close_position(symbol, liq, c.times[i], "LIQUIDATION")
+                return
+            if sl is not None and d * (adverse - sl) <= 0:
+                # Гэп через стоп исполняется по open
+                price = c.open[i] if d * (c.open[i] - sl) < 0 else sl
+                self.close_position(symbol, price, c.times[i], "SL")
+                return
+            if tp is not None and d * (favorable - tp) >= 0:
+                self.close_position(symbol, tp, c.times[i], "TP")
+                return
+        pos["cursor"] = max(pos["cursor"], until_index - 1)
+
+    def on_signal(self, ts, data):
+        self.stats["signals"] += 1
+        signal = str(data.get("signal", "")).lower()
+        symbol = str(data.get("symbol", "N/A")).split(".")[0]
+        if signal not in ("long", "short"):
+            return
+        if self.bot.is_duplicate_signal(symbol, data, now=ts / 1000):
+            self.stats["duplicates"] += 1
+            return
+        c = self.candles.get(symbol)
+        # Сигнал исполняется на open первой свечи, открывшейся не раньше сигнала
+        index = bisect.bisect_left(c.times, ts) if c else 0
+        if c is None or index >= len(c.times):
+            self.stats["no_data"] += 1
+            return
+        self.advance(symbol, index)
+        pos = self.positions.get(symbol)
+        action = self.bot.signal_action(pos["direction"] * pos["quantity"] if pos else 0.0, signal)
+        if action == "skip":
+            self.stats["skipped"] += 1
+            return
+        if action == "switch":
+            self.close_position(symbol, self.fill_price(c.open[index], -pos["direction"]), c.times[index], "MANUAL")
+        self.open_position(symbol, signal, data, index)
+
+    def finish(self):
+        # Открытые к концу данных позиции закрываются по последнему close
+        for symbol in list(self.positions):
+            c = self.candles[symbol]
+            self.advance(symbol, len(c.times))
+            if symbol in self.positions:
+                self.close_position(symbol, c.close[-1], c.times[-1], "END")
+
+
+def report(replay, elapsed):
+    trades = replay.trades
+    net = [t["net_pnl"] for t in trades]
+    equity = peak = max_drawdown = 0.0
+    for value in net:
+        equity += value
+        peak = max(peak, equity)
+        max_drawdown = max(max_drawdown, peak - equity)
+    wins = sum(1 for value in net if value > 0)
+    by_method = {}
+    for t in trades:
+        by_method[t["method"]] = by_method.get(t["method"], 0) + 1
+    stats = replay.stats
+    print(f"Сигналов: {stats['signals']} (дубликатов {stats['duplicates']}, пропущено {stats['skipped']}, "
+          f"без свечей {stats['no_data']}) за {elapsed:.2f} сек ({stats['signals'] / max(elapsed, 1e-9):.0f} сигн./сек)")
+    print(f"Сделок: {len(trades)}; прибыльных: {wins} ({wins / max(len(trades), 1) * 100:.1f}%); закрытия: {by_method}")
+    print(f"PnL: {sum(t['pnl'] for t in trades):.4f}; комиссии: {sum(t['total_commission'] for t in trades):.4f}; "
+          f"чистый PnL: {sum(net):.4f}; макс. просадка: {max_drawdown:.4f}")
+    if trades:
+        print(f"Средний чистый PnL сделки: {sum(net) / len(trades):.4f}; средняя чистая цена безубыточности / вход: "
+              f"{sum(t['net_break_even'] / t['entry_price'] for t in trades) / len(trades):.6f}")
+
+
+# --------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Бэктест записанных сигналов на логике bot.py")
+    parser.add_argument("signals", help="JSON Lines с сигналами (SIGNAL_LOG_PATH)")
+    parser.add_argument("--klines", required=True, help="каталог с CSV свечей <SYMBOL>*.csv")
+    parser.add_argument("--exchange-info", help="JSON ответа /fapi/v1/exchangeInfo для LOT_SIZE и MIN_NOTIONAL")
+    parser.add_argument("--leverage", type=int, help="плечо вместо значения из сигнала")
+    parser.add_argument("--quantity", type=float, help="количество вместо значения из сигнала")
+    parser.add_argument("--tp-perc", type=float, help="TP, %% вместо значения из сигнала")
+    parser.add_argument("--sl-perc", type=float, help="SL, %% вместо значения из сигнала")
+    parser.add_argument("--taker-fee", type=float, default=0.0005, help="комиссия taker (доля)")
+    parser.add_argument("--slippage-bps", type=float, default=1.0, help="проскальзывание рыночных ордеров, б.п.")
+    parser.add_argument("--mmr", type=float, default=0.004, help="ставка поддерживающей маржи")
+    parser.add_argument("--margin-topup", type=float, default=1.0, help="доливка маржи в долях начальной (как в bot.py)")
+    parser.add_argument("--trades", help="CSV для списка сделок")
+    args = parser.parse_args()
+
+    # bot.py импортируется без сети: ключи-заглушки и недоступный адрес биржи
+    os.environ.update({
+        "TELEGRAM_TOKEN": "replay",
+        "TELEGRAM_CHAT_ID": "0",
+        "BINANCE_API_KEY": "replay",
+        "BINANCE_API_SECRET": "replay",
+        "BINANCE_FUTURES_URL": "http://127.0.0.1:9",
+        "STATE_DB_PATH": os.path.join(tempfile.mkdtemp(prefix="bot-replay-"), "state.db"),
+    })
+    os.environ.pop("SIGNAL_LOG_PATH", None)
+    os.environ.pop("BINANCE_ACCOUNTS", None)
+    import logging
+    logging.disable(logging.CRITICAL)  # ошибка пинга биржи при импорте ожидаема
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+    logging.disable(logging.INFO)
+
+    if args.exchange_info:
+        with open(args.exchange_info) as f:
+            bot.symbol_filters = {s["symbol"]: bot._parse_symbol_filters(s) for s in json.load(f).get("symbols", [])}
+    # Реестр символов не обновляется из сети
+    bot.symbol_filters_updated_at = float("inf")
+
+    started_at = time.perf_counter()
+    signals = load_signals(args.signals)
+    symbols = {str(data.get("symbol", "N/A")).split(".")[0] for _, data in signals}
+    candles = load_candles(args.klines, symbols)
+    replay = Replay(bot, candles, args)
+    for ts, data in signals:
+        replay.on_signal(ts, data)
+    replay.finish()
+    report(replay, time.perf_counter() - started_at)
+
+    if args.trades:
+        with open(args.trades, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(replay.trades[0]) if replay.trades else ["symbol"])
+            writer.writeheader()
+            writer.writerows(replay.trades)
+
+
+if __name__ == "__main__":
+    main()
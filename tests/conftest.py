@@ -0,0 +1,45 @@
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+# bot.py импортируется без сети, как в replay.py: ключи-заглушки и недоступный адрес биржи
+os.environ.update({
+    "TELEGRAM_TOKEN": "test",
+    "TELEGRAM_CHAT_ID": "0",
+    "BINANCE_API_KEY": "test",
+    "BINANCE_API_SECRET": "test",
+    "BINANCE_FUTURES_URL": "http://127.0.0.1:9",
+    "STATE_DB_PATH": os.path.join(tempfile.mkdtemp(prefix="bot-test-"), "state.db"),
+})
+os.environ.pop("SIGNAL_LOG_PATH", None)
+os.environ.pop("BINANCE_ACCOUNTS", None)
+os.environ.pop("STATE_BACKEND", None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+SYMBOL_FILTERS = {
+    "BTCUSDT": {"step_size": 0.001, "min_qty": 0.001, "tick_size": 0.1, "min_notional": 5.0,
+                "quantity_precision": 3, "price_precision": 1},
+}
+
+
+@pytest.fixture
+def account():
+    # Отдельный аккаунт с пустым зеркалом, текущий для потока теста
+    account = bot.Account("test", "test", "test")
+    with bot.use_account(account):
+        yield account
+
+
+@pytest.fixture
+def filters(monkeypatch):
+    # Фильтры символов без exchangeInfo; кеш цен пуст
+    monkeypatch.setattr(bot, "symbol_filters", dict(SYMBOL_FILTERS))
+    monkeypatch.setattr(bot, "symbol_filters_updated_at", time.time())
+    monkeypatch.setattr(bot, "mark_prices", {})
+    monkeypatch.setattr(bot, "book_tickers", {})
+    return SYMBOL_FILTERS
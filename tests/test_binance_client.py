@@ -0,0 +1,39 @@
+import hashlib
+import hmac
+import json
+from urllib.parse import urlencode
+
+import bot
+
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.text = json.dumps(body)
+        self.headers = {}
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def test_retry_after_time_drift_is_signed_again_from_clean_params(monkeypatch):
+    client = bot.accounts[0].client
+    sent = []
+    responses = [FakeResponse(400, {"code": -1021, "msg": "Timestamp outside recvWindow"}), FakeResponse(200, {})]
+
+    def post(uri, headers=None, data=None, **kwargs):
+        sent.append(list(data))
+        return responses.pop(0)
+
+    monkeypatch.setattr(client.session, "post", post)
+    monkeypatch.setattr(client, "sync_server_time", lambda: setattr(client, "timestamp_offset", 1000))
+    client.futures_change_leverage(symbol="BTCUSDT", leverage=5)
+
+    assert len(sent) == 2
+    retried = sent[1]
+    assert [key for key, _ in retried].count("signature") == 1
+    params = [(key, value) for key, value in retried if key != "signature"]
+    signature = dict(retried)["signature"]
+    expected = hmac.new(b"test", urlencode(params).encode(), hashlib.sha256).hexdigest()
+    assert signature == expected
+    assert dict(retried)["timestamp"] != dict(sent[0])["timestamp"]
@@ -0,0 +1,118 @@
+import pytest
+
+import bot
+
+
+@pytest.fixture(autouse=True)
+def clean_exit_engine(account):
+    yield
+    bot.remove_exit(account, "BTCUSDT")
+    bot.pending_amends.clear()
+    while not bot.exit_partials.empty():
+        bot.exit_partials.get_nowait()
+
+
+def entry(**params):
+    data = {"signal": "long", "entry_price": 100.0, "break_even_price": 100.0, "quantity": 1.0}
+    data.update(params)
+    return data
+
+
+def test_trailing_stop_follows_best_price_only(account):
+    bot.register_exit(account, "BTCUSDT", entry(trail_perc=1))
+
+    bot.evaluate_exits({"BTCUSDT": 110.0})
+    stop, best = bot.pending_amends.pop((account, "BTCUSDT"))
+    assert stop == pytest.approx(108.9)
+    assert best == 110.0
+
+    bot.evaluate_exits({"BTCUSDT": 105.0})
+    assert not bot.pending_amends
+
+
+def test_trailing_stop_for_short_moves_down(account):
+    bot.register_exit(account, "BTCUSDT", entry(signal="short", trail_perc=2))
+
+    bot.evaluate_exits({"BTCUSDT": 90.0})
+    stop, _ = bot.pending_amends.pop((account, "BTCUSDT"))
+    assert stop == pytest.approx(91.8)
+
+
+def test_breakeven_moves_stop_once_trigger_is_reached(account):
+    bot.register_exit(account, "BTCUSDT", entry(breakeven_perc=1))
+
+    bot.evaluate_exits({"BTCUSDT": 100.5})
+    assert not bot.pending_amends
+
+    bot.evaluate_exits({"BTCUSDT": 101.0})
+    assert bot.pending_amends.pop((account, "BTCUSDT")) == (100.0, 101.0)
+
+    bot.evaluate_exits({"BTCUSDT": 102.0})
+    assert not bot.pending_amends
+
+
+def test_breakeven_is_not_rearmed_when_done(account):
+    bot.register_exit(account, "BTCUSDT", entry(breakeven_perc=1, breakeven_done=True, stop_price=100.0))
+
+    bot.evaluate_exits({"BTCUSDT": 101.0})
+    assert not bot.pending_amends
+
+
+def test_partial_take_profit_fires_once(account):
+    bot.register_exit(account, "BTCUSDT", entry(partial_tp_perc=2, partial_tp_size=0.5))
+
+    bot.evaluate_exits({"BTCUSDT": 101.0})
+    assert bot.exit_partials.empty()
+
+    bot.evaluate_exits({"BTCUSDT": 102.0})
+    bot.evaluate_exits({"BTCUSDT": 103.0})
+    assert bot.exit_partials.get_nowait() == (account, "BTCUSDT")
+    assert bot.exit_partials.empty()
+
+
+class FailingStopClient:
+    def __init__(self):
+        self.orders = []
+
+    def futures_cancel_order(self, **params):
+        pass
+
+    def futures_create_order(self, **params):
+        self.orders.append(params)
+        if params["type"] == "STOP_MARKET":
+            raise Exception("stop rejected")
+        return {"orderId": 1}
+
+
+def test_amend_closes_at_market_when_price_is_through_stop(account, filters, monkeypatch):
+    client = account.client = FailingStopClient()
+    messages = []
+    monkeypatch.setattr(bot, "send_telegram_message", messages.append)
+    account.positions["BTCUSDT"] = {"symbol": "BTCUSDT", "positionAmt": "0.5"}
+    account.positions_entry_data["BTCUSDT"] = entry(stop_price=95.0, stop_order_id=7)
+    bot.mark_prices["BTCUSDT"] = (99.0, bot.time.monotonic())
+
+    bot._amend_stop("BTCUSDT", 100.0, 101.0)
+
+    assert [order["type"] for order in client.orders] == ["MARKET"]
+    assert client.orders[0]["reduceOnly"] is True
+    assert client.orders[0]["quantity"] == 0.5
+    assert client.orders[0]["newClientOrderId"].startswith(bot.EXIT_STOP_PREFIX)
+    assert len(messages) == 1
+
+
+def test_failed_stop_alerts_once_and_retries(account, filters, monkeypatch):
+    client = account.client = FailingStopClient()
+    messages = []
+    monkeypatch.setattr(bot, "send_telegram_message", messages.append)
+    bot.register_exit(account, "BTCUSDT", entry(trail_perc=1))
+    account.positions_entry_data["BTCUSDT"] = entry(trail_perc=1, stop_price=95.0, stop_order_id=7)
+    bot.mark_prices["BTCUSDT"] = (105.0, bot.time.monotonic())
+
+    bot._amend_stop("BTCUSDT", 100.0, 105.0)
+    retry = bot.pending_amends.pop((account, "BTCUSDT"))
+    bot._amend_stop("BTCUSDT", *retry)
+
+    assert [order["type"] for order in client.orders] == ["STOP_MARKET", "STOP_MARKET"]
+    assert (account, "BTCUSDT") in bot.pending_amends
+    assert len(messages) == 1
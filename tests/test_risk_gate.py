@@ -0,0 +1,71 @@
+import bot
+
+
+def test_order_notional_limit_resizes_entry(account, filters, monkeypatch):
+    monkeypatch.setattr(bot, "RISK_MAX_ORDER_NOTIONAL", 1000.0)
+
+    leverage, quantity, reasons = bot.check_pre_trade_risk(account, "BTCUSDT", 10, 20.0, price=100.0)
+
+    assert (leverage, quantity) == (10, 10.0)
+    assert len(reasons) == 1
+
+
+def test_leverage_is_capped(account, filters, monkeypatch):
+    monkeypatch.setattr(bot, "RISK_MAX_LEVERAGE", 5)
+
+    leverage, quantity, reasons = bot.check_pre_trade_risk(account, "BTCUSDT", 20, 1.0, price=100.0)
+
+    assert (leverage, quantity) == (5, 1.0)
+    assert reasons
+
+
+def test_entry_below_min_notional_after_resize_is_rejected(account, filters, monkeypatch):
+    monkeypatch.setattr(bot, "RISK_MAX_ORDER_NOTIONAL", 3.0)
+
+    _, quantity, reasons = bot.check_pre_trade_risk(account, "BTCUSDT", 10, 1.0, price=100.0)
+
+    assert quantity == 0.0
+    assert reasons
+
+
+def test_near_liquidation_rejects_entry(account, filters, monkeypatch):
+    monkeypatch.setattr(bot, "RISK_MIN_LIQ_DISTANCE_PERC", 5.0)
+    account.near_liquidation.add("ETHUSDT")
+
+    _, quantity, _ = bot.check_pre_trade_risk(account, "BTCUSDT", 10, 1.0, price=100.0)
+
+    assert quantity == 0.0
+
+
+def test_symbol_limit_counts_held_exposure_only_when_adding(account, filters, monkeypatch):
+    monkeypatch.setattr(bot, "RISK_MAX_SYMBOL_NOTIONAL", 1000.0)
+    account.exposure["BTCUSDT"] = (600.0, 60.0)
+    account.total_notional = 600.0
+
+    _, replaced, _ = bot.check_pre_trade_risk(account, "BTCUSDT", 10, 10.0, price=100.0)
+    _, added, _ = bot.check_pre_trade_risk(account, "BTCUSDT", 10, 10.0, adds_to_position=True, price=100.0)
+
+    assert replaced == 10.0
+    assert added == 4.0
+
+
+def test_total_limit_frees_exposure_of_replaced_position(account, filters, monkeypatch):
+    monkeypatch.setattr(bot, "RISK_MAX_TOTAL_NOTIONAL", 1500.0)
+    account.exposure["BTCUSDT"] = (600.0, 60.0)
+    account.total_notional = 1200.0
+
+    _, replaced, _ = bot.check_pre_trade_risk(account, "BTCUSDT", 10, 10.0, price=100.0)
+    _, added, _ = bot.check_pre_trade_risk(account, "BTCUSDT", 10, 10.0, adds_to_position=True, price=100.0)
+
+    assert replaced == 9.0
+    assert added == 3.0
+
+
+def test_cold_cache_uses_given_price(account, filters, monkeypatch):
+    monkeypatch.setattr(bot, "RISK_MAX_ORDER_NOTIONAL", 1000.0)
+
+    _, quantity, _ = bot.check_pre_trade_risk(account, "BTCUSDT", 10, 20.0)
+    assert quantity == 20.0
+
+    _, quantity, _ = bot.check_pre_trade_risk(account, "BTCUSDT", 10, 20.0, price=100.0)
+    assert quantity == 10.0
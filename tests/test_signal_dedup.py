@@ -0,0 +1,24 @@
+import bot
+
+
+def setup_function():
+    bot.seen_signals.clear()
+
+
+def test_signals_without_id_or_time_are_not_deduplicated():
+    sequence = ["long", "short", "long"]
+    results = [bot.is_duplicate_signal("BTCUSDT", {"signal": signal}, now=i) for i, signal in enumerate(sequence)]
+    assert results == [False, False, False]
+
+
+def test_repeated_alert_id_is_deduplicated():
+    data = {"signal": "long", "alert_id": "a1"}
+    assert not bot.is_duplicate_signal("BTCUSDT", data, now=0)
+    assert bot.is_duplicate_signal("BTCUSDT", data, now=1)
+
+
+def test_same_bar_time_is_deduplicated_until_window_ends():
+    data = {"signal": "short", "time": "2024-01-01T00:00:00Z"}
+    assert not bot.is_duplicate_signal("ETHUSDT", data, now=0)
+    assert bot.is_duplicate_signal("ETHUSDT", data, now=1)
+    assert not bot.is_duplicate_signal("ETHUSDT", data, now=bot.SIGNAL_DEDUP_WINDOW + 2)
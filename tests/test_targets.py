@@ -0,0 +1,98 @@
+import array
+
+import pytest
+
+import bot
+
+
+@pytest.fixture(autouse=True)
+def last_price(monkeypatch, filters):
+    monkeypatch.setattr(bot, "get_last_price", lambda symbol: 100.0)
+
+
+def plan(account, current, target):
+    report = {}
+    plans = bot._plan_target_orders(account, [{"symbol": "BTCUSDT"}], array.array("d", [current]),
+                                    array.array("d", [target]), [10], report)
+    return plans, report
+
+
+def test_position_on_target_places_no_order(account):
+    plans, report = plan(account, 1.0, 1.0004)
+
+    assert plans == []
+    assert report["BTCUSDT"]["status"] == "on_target"
+
+
+def test_reduce_is_reduce_only_for_the_difference(account):
+    plans, _ = plan(account, 2.0, 0.5)
+
+    assert len(plans) == 1
+    assert plans[0]["reduces"] and not plans[0]["flips"]
+    assert plans[0]["params"]["side"] == "SELL"
+    assert plans[0]["params"]["quantity"] == 1.5
+    assert plans[0]["params"]["reduceOnly"] is True
+
+
+def test_flip_goes_through_zero_in_one_order(account):
+    plans, _ = plan(account, 1.0, -2.0)
+
+    assert plans[0]["flips"] and not plans[0]["reduces"]
+    assert plans[0]["params"]["side"] == "SELL"
+    assert plans[0]["params"]["quantity"] == 3.0
+    assert "reduceOnly" not in plans[0]["params"]
+
+
+def test_entry_below_min_notional_is_rejected(account):
+    plans, report = plan(account, 0.0, 0.01)
+
+    assert plans == []
+    assert report["BTCUSDT"]["status"] == "rejected"
+
+
+def test_risk_gate_sees_price_with_cold_cache(account, monkeypatch):
+    monkeypatch.setattr(bot, "RISK_MAX_ORDER_NOTIONAL", 100.0)
+
+    plans, _ = plan(account, 0.0, 5.0)
+
+    assert plans[0]["params"]["quantity"] == 1.0
+
+
+def test_flip_commission_is_split_between_close_and_new_entry(account, monkeypatch):
+    closes = []
+    monkeypatch.setattr(bot, "journal_write", lambda *args, **kwargs: closes.append(args))
+    monkeypatch.setattr(bot, "watch_symbol", lambda symbol: None)
+    account.positions_entry_data["BTCUSDT"] = {"signal": "long", "entry_price": 100.0, "quantity": 1.0,
+                                               "commission_entry": 0.2, "leverage": 10}
+    plans, _ = plan(account, 1.0, -3.0)
+    plans[0]["order_id"] = 1
+
+    bot._apply_target_fill(account, plans[0], {"commission": 0.4, "realized_pnl": 2.0, "avg_price": 102.0},
+                           {"positionAmt": "-3", "entryPrice": "102"})
+
+    commission, pnl, net_pnl = closes[0][6:9]
+    assert commission == pytest.approx(0.3)
+    assert (pnl, net_pnl) == (2.0, pytest.approx(1.7))
+    assert account.positions_entry_data["BTCUSDT"]["commission_entry"] == pytest.approx(0.3)
+    bot.remove_exit(account, "BTCUSDT")
+
+
+def test_partial_reduce_is_carried_to_the_close(account, monkeypatch):
+    closes = []
+    monkeypatch.setattr(bot, "journal_write", lambda *args, **kwargs: closes.append(args))
+    monkeypatch.setattr(bot, "watch_symbol", lambda symbol: None)
+    account.positions_entry_data["BTCUSDT"] = {"signal": "long", "entry_price": 100.0, "quantity": 2.0,
+                                               "commission_entry": 0.2, "leverage": 10}
+    reduce, _ = plan(account, 2.0, 1.0)
+    reduce[0]["order_id"] = 1
+    bot._apply_target_fill(account, reduce[0], {"commission": 0.1, "realized_pnl": 4.0}, {"positionAmt": "1", "entryPrice": "100"})
+    assert closes == []
+
+    close, _ = plan(account, 1.0, 0.0)
+    close[0]["order_id"] = 2
+    bot._apply_target_fill(account, close[0], {"commission": 0.1, "realized_pnl": 3.0}, None)
+
+    commission, pnl, net_pnl = closes[0][6:9]
+    assert commission == pytest.approx(0.4)
+    assert (pnl, net_pnl) == (7.0, pytest.approx(6.6))
+    assert "BTCUSDT" not in account.positions_entry_data
@@ -0,0 +1,6 @@
+# Многопроцессный запуск: STATE_BACKEND=sqlite (или redis) gunicorn -w 4 -b 0.0.0.0:5000 wsgi:app
+# Без --preload: каждый рабочий процесс импортирует бот сам и участвует в выборе лидера.
+import bot
+
+bot.start_worker()
+app = bot.app